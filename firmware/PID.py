@@ -24,7 +24,8 @@ class PID(object):
         output_limits=[None, None],
         auto_mode=True,
         proportional_on_measurement=False,
-        error_map=None
+        error_map=None,
+        timebase=None
     ):
         """
         Initialize a new PID controller.
@@ -51,8 +52,13 @@ class PID(object):
             the input directly rather than on the error (which is the traditional way). Using
             proportional-on-measurement avoids overshoot for some types of systems.
         :param error_map: Function to transform the error value in another constrained value.
+        :param timebase: Clock used to measure time between updates independently of the scale,
+            accepted values are 'ms' for ticks_ms and 'us' for ticks_us. Measured time is converted
+            to the scale units, so sample_time and tunings keep their meaning while dt gets
+            sub-second resolution. Ticks counters wrap around, keep the interval between calls
+            well below half of the ticks period (about 6 days for 'ms', 9 minutes for 'us').
+            If set to None, the scale clock is used.
         """
-        self.Kp, self.Ki, self.Kd = Kp, Ki, Kd
         self.setpoint = setpoint
         self.sample_time = sample_time
 
@@ -79,6 +85,18 @@ class PID(object):
         if hasattr(utime, self.scale) and callable(func := getattr(utime, self.scale)):
             self.time = func
 
+        # Ticks of the timebase per scale unit
+        self._ticks_to_unit = None
+        if timebase == 'ms':
+            self.time = utime.ticks_ms
+            self._ticks_to_unit = 1e-3 / self.unit
+        elif timebase == 'us':
+            self.time = utime.ticks_us
+            self._ticks_to_unit = 1e-6 / self.unit
+
+        self._Kp, self._Ki, self._Kd = Kp, Ki, Kd
+        self._update_gains()
+
         self._min_output, self._max_output = None, None
         self._auto_mode = auto_mode
         self.proportional_on_measurement = proportional_on_measurement
@@ -111,7 +129,11 @@ class PID(object):
 
         now = self.time()
         if dt is None:
-            dt = utime.ticks_diff(now,self._last_time) if (utime.ticks_diff(now,self._last_time)) else 1e-16
+            dt = utime.ticks_diff(now, self._last_time)
+            if self._ticks_to_unit is not None:
+                dt *= self._ticks_to_unit
+            if not dt:
+                dt = 1e-16
         elif dt <= 0:
             raise ValueError('dt has negative value {}, must be positive'.format(dt))
 
@@ -133,13 +155,13 @@ class PID(object):
             self._proportional = self.Kp * error
         else:
             # Add the proportional error on measurement to error_sum
-            self._proportional -= self.Kp * self.unit * d_input
+            self._proportional -= self._kp_unit * d_input
 
         # Compute integral and derivative terms
-        self._integral += (self.Ki * self.unit) * error * dt
+        self._integral += self._ki_unit * error * dt
         self._integral = _clamp(self._integral, self.output_limits)  # Avoid integral windup
 
-        self._derivative = -(self.Kd / self.unit) * d_input / dt
+        self._derivative = -self._kd_unit * d_input / dt
 
         # Compute final output
         output = self._proportional + self._integral + self._derivative
@@ -174,12 +196,64 @@ class PID(object):
     @property
     def tunings(self):
         """The tunings used by the controller as a tuple: (Kp, Ki, Kd)."""
-        return self.Kp, self.Ki, self.Kd
+        return self._Kp, self._Ki, self._Kd
 
     @tunings.setter
     def tunings(self, tunings):
         """Set the PID tunings."""
-        self.Kp, self.Ki, self.Kd = tunings
+        self._Kp, self._Ki, self._Kd = tunings
+        self._update_gains()
+
+    def set_tunings_bumpless(self, tunings):
+        """
+        Set the PID tunings without a step in the output.
+
+        Change of Kp is compensated in the integral term using the error from the last
+        computation, so the sum of P- and I-terms stays the same. Changes of Ki and Kd do not
+        produce a step by themselves since they only affect following updates.
+        """
+        Kp = tunings[0]
+        if self._last_input is not None and not self.proportional_on_measurement:
+            error = self.setpoint - self._last_input
+            if self.error_map is not None:
+                error = self.error_map(error)
+            self._integral += (self._Kp - Kp) * error
+            self._integral = _clamp(self._integral, self.output_limits)
+
+        self.tunings = tunings
+
+    @property
+    def Kp(self):
+        return self._Kp
+
+    @Kp.setter
+    def Kp(self, value):
+        self._Kp = value
+        self._update_gains()
+
+    @property
+    def Ki(self):
+        return self._Ki
+
+    @Ki.setter
+    def Ki(self, value):
+        self._Ki = value
+        self._update_gains()
+
+    @property
+    def Kd(self):
+        return self._Kd
+
+    @Kd.setter
+    def Kd(self, value):
+        self._Kd = value
+        self._update_gains()
+
+    def _update_gains(self):
+        """Precompute gain products used on every update, call after any tunings change."""
+        self._kp_unit = self._Kp * self.unit
+        self._ki_unit = self._Ki * self.unit
+        self._kd_unit = self._Kd / self.unit
 
     @property
     def auto_mode(self):
@@ -0,0 +1,137 @@
+import math
+import time
+
+AUTOTUNE_RUNNING = 0
+AUTOTUNE_DONE = 1
+AUTOTUNE_FAILED = 2
+
+
+class RelayAutotuner:
+    """
+    Astrom-Hagglund relay experiment.
+
+    Heater is switched between `output_high` and `output_low` around setpoint
+    with hysteresis. After oscillation settles, ultimate gain and period are
+    estimated from the last cycles and converted to PID gains.
+    """
+
+    def __init__(
+        self,
+        setpoint: float,
+        output_high=100,
+        output_low=0,
+        hysteresis=0.5,
+        cycles=4,
+        max_duration_ms=4 * 60 * 60 * 1000,
+    ):
+        self.setpoint = setpoint
+        self.output_high = output_high
+        self.output_low = output_low
+        self.hysteresis = hysteresis
+        self.cycles = cycles
+        self.max_duration_ms = max_duration_ms
+
+        self.state = AUTOTUNE_RUNNING
+        self.message = ""
+        self.ultimate_gain = None
+        self.ultimate_period_s = None
+
+        self._start_ticks = time.ticks_ms()
+        self._output = output_high
+        self._cycle_start_ticks = None
+        self._cycle_max = None
+        self._cycle_min = None
+        self._periods_ms = []
+        self._amplitudes = []
+
+    @property
+    def completed_cycles(self):
+        return len(self._periods_ms)
+
+    def update(self, temperature: float):
+        if self.state != AUTOTUNE_RUNNING:
+            return self.output_low
+
+        current_ticks = time.ticks_ms()
+        if time.ticks_diff(current_ticks, self._start_ticks) > self.max_duration_ms:
+            self._fail("Oscillation not detected in time")
+            return self.output_low
+
+        if self._cycle_start_ticks is not None:
+            if self._cycle_max is None or temperature > self._cycle_max:
+                self._cycle_max = temperature
+            if self._cycle_min is None or temperature < self._cycle_min:
+                self._cycle_min = temperature
+
+        if self._output == self.output_high:
+            if temperature > self.setpoint + self.hysteresis:
+                self._output = self.output_low
+        elif temperature < self.setpoint - self.hysteresis:
+            self._output = self.output_high
+            self._start_cycle(current_ticks)
+
+        return self._output
+
+    def _start_cycle(self, current_ticks):
+        # Cycle is measured from one switch to high output to the next one
+        if self._cycle_start_ticks is not None:
+            self._periods_ms.append(
+                time.ticks_diff(current_ticks, self._cycle_start_ticks)
+            )
+            self._amplitudes.append((self._cycle_max - self._cycle_min) / 2)
+
+            if len(self._periods_ms) >= self.cycles:
+                self._finish()
+                return
+
+        self._cycle_start_ticks = current_ticks
+        self._cycle_max = None
+        self._cycle_min = None
+
+    def _finish(self):
+        # First cycle starts from cold tank, it is not representative
+        periods = self._periods_ms[1:]
+        amplitudes = self._amplitudes[1:]
+        amplitude = sum(amplitudes) / len(amplitudes)
+
+        if amplitude <= self.hysteresis:
+            self._fail("Oscillation amplitude is below hysteresis")
+            return
+
+        relay_amplitude = (self.output_high - self.output_low) / 2
+        self.ultimate_gain = (4 * relay_amplitude) / (
+            math.pi * math.sqrt(amplitude**2 - self.hysteresis**2)
+        )
+        self.ultimate_period_s = sum(periods) / len(periods) / 1000
+        self.state = AUTOTUNE_DONE
+
+    def _fail(self, message):
+        self.state = AUTOTUNE_FAILED
+        self.message = message
+
+    def ziegler_nichols_gains(self):
+        kp = 0.6 * self.ultimate_gain
+        ti = self.ultimate_period_s / 2
+        td = self.ultimate_period_s / 8
+        return {"pid_p": kp, "pid_i": kp / ti, "pid_d": kp * td}
+
+    def tyreus_luyben_gains(self):
+        kp = self.ultimate_gain / 2.2
+        ti = 2.2 * self.ultimate_period_s
+        td = self.ultimate_period_s / 6.3
+        return {"pid_p": kp, "pid_i": kp / ti, "pid_d": kp * td}
+
+    def to_dict(self):
+        result = {
+            "state": self.state,
+            "message": self.message,
+            "cycles": self.completed_cycles,
+            "ultimate_gain": self.ultimate_gain,
+            "ultimate_period": self.ultimate_period_s,
+        }
+        if self.state == AUTOTUNE_DONE:
+            result["gains"] = {
+                "zn": self.ziegler_nichols_gains(),
+                "tl": self.tyreus_luyben_gains(),
+            }
+        return result
@@ -2,16 +2,36 @@ from heater import Heater
 from parameter_manager import MODE_AUTO, MODE_OFF, MODE_REMOTE, ParameterManager
 from wifi_manager import WifiManager
 from sensors import (
+    BulkTemperatureSensor,
     CalibratedSensor,
     DS18B20Sensor,
+    EnergySensor,
+    EvaporationRateSensor,
     FreeMemorySensor,
     HX711Sensor,
     IPAddressSensor,
+    StratificationSensor,
     UptimeSensor,
     WeightSensor,
+    WeightSetpointETASensor,
     HeaterOutputPowerSensor,
+    HeaterPowerSensor,
+    TemperatureCompensatedSensor,
 )
+from evaporation import EvaporationEstimator
 from PID import PID
+from gain_schedule import GainSchedule
+from safety import (
+    ConfigurationErrorRule,
+    ParameterLimitRule,
+    SafetyEngine,
+    SensorFaultRule,
+    make_rules,
+)
+from plausibility import PlausibilityFilter
+from fusion import TemperatureFusion
+from energy import EnergyMeter
+from recipe import RecipeEngine, make_steps
 
 
 class Device:
@@ -30,20 +50,33 @@ class Device:
             "top_temperature", pin_number=33, blocking_first_read=True
         )
 
+        # Load cells are read once per second, average is updated every ~50 s
         load_cell_1_sensor = HX711Sensor(
-            "load_cell_1", dout_pin_number=36, sck_pin_number=25
+            "load_cell_1",
+            dout_pin_number=36,
+            sck_pin_number=25,
+            readings_for_averaging=50,
         )
         load_cell_2_sensor = HX711Sensor(
-            "load_cell_2", dout_pin_number=39, sck_pin_number=26
+            "load_cell_2",
+            dout_pin_number=39,
+            sck_pin_number=26,
+            readings_for_averaging=50,
         )
         load_cell_3_sensor = HX711Sensor(
-            "load_cell_3", dout_pin_number=34, sck_pin_number=27
+            "load_cell_3",
+            dout_pin_number=34,
+            sck_pin_number=27,
+            readings_for_averaging=50,
         )
         load_cell_4_sensor = HX711Sensor(
-            "load_cell_4", dout_pin_number=22, sck_pin_number=21
+            "load_cell_4",
+            dout_pin_number=22,
+            sck_pin_number=21,
+            readings_for_averaging=50,
         )
         self.weight_sensor = WeightSensor(
-            "weight",
+            "weight_uncompensated",
             load_cell_1_sensor,
             load_cell_2_sensor,
             load_cell_3_sensor,
@@ -57,15 +90,47 @@ class Device:
             "heater_output_power", self.heater
         )
 
+        self.energy_meter = EnergyMeter(parameters.heater_rated_power)
+        self.heater_power_sensor = HeaterPowerSensor(
+            "heater_power", self.heater, self.energy_meter
+        )
+        self.batch_energy_sensor = EnergySensor(
+            "batch_energy", self.energy_meter, "batch"
+        )
+        self.lifetime_energy_sensor = EnergySensor(
+            "lifetime_energy", self.energy_meter, "lifetime", unit_wh=1000
+        )
+
         self.bottom_temperature_sensor_calibrated = CalibratedSensor(
             self.bottom_temperature_sensor,
-            *parameters.bottom_temperature_calibration_points
+            *parameters.bottom_temperature_calibration_points,
+            degree=parameters.bottom_temperature_calibration_degree
         )
         self.top_temperature_sensor_calibrated = CalibratedSensor(
-            self.top_temperature_sensor, *parameters.top_temperature_calibration_points
+            self.top_temperature_sensor,
+            *parameters.top_temperature_calibration_points,
+            degree=parameters.top_temperature_calibration_degree
         )
+        self.weight_sensor_compensated = TemperatureCompensatedSensor(
+            "weight",
+            self.weight_sensor,
+            self.top_temperature_sensor_calibrated,
+            parameters.weight_temperature_compensation,
+        )
+        self.weight_compensation_calibration = None
+
         self.wight_sensor_calibrated = CalibratedSensor(
-            self.weight_sensor, *parameters.weight_calibration_points
+            self.weight_sensor_compensated,
+            *parameters.weight_calibration_points,
+            degree=parameters.weight_calibration_degree
+        )
+
+        self.temperature_fusion = TemperatureFusion(parameters.temperature_fusion)
+        self.bulk_temperature_sensor = BulkTemperatureSensor(
+            "bulk_temperature", self.temperature_fusion
+        )
+        self.stratification_sensor = StratificationSensor(
+            "stratification", self.temperature_fusion
         )
 
         self.temperature_regulator = PID(
@@ -74,30 +139,167 @@ class Device:
             parameters.pid_d,
             setpoint=parameters.bottom_temperature_sp,
             scale="s",
+            timebase="ms",
             sample_time=5,
             output_limits=[0, 100],
             auto_mode=False,
         )
-        self.sensors_data = {}
+        self.gain_schedule = GainSchedule(parameters.pid_gain_schedule)
+        self.recipe = RecipeEngine(make_steps(parameters.recipe))
+
+        self.evaporation_estimator = EvaporationEstimator()
+        self.evaporation_rate_sensor = EvaporationRateSensor(
+            "evaporation_rate", self.evaporation_estimator
+        )
+        self.weight_sp_eta_sensor = WeightSetpointETASensor(
+            "weight_sp_eta", self.evaporation_estimator, parameters
+        )
+
+        # Stored rules which are not valid any more keep device disabled until
+        # they are replaced
+        try:
+            rules = make_rules(parameters.safety_rules, self.sensor_names())
+        except Exception as e:
+            rules = [ConfigurationErrorRule()]
+
+        self.safety = SafetyEngine(
+            [
+                SensorFaultRule(
+                    self.bottom_temperature_sensor_calibrated.name,
+                    "bottom_temperature_sensor",
+                    "Bottom temperature sensor malfunction.",
+                ),
+                ParameterLimitRule(
+                    self.bottom_temperature_sensor_calibrated.name,
+                    parameters,
+                    "bottom_temperature_ah",
+                    "Bottom temperature above AH setpoint.",
+                ),
+                ParameterLimitRule(
+                    self.top_temperature_sensor_calibrated.name,
+                    parameters,
+                    "top_temperature_ah",
+                    "Top temperature above AH setpoint.",
+                ),
+            ],
+            rules,
+        )
+
+        # Raw DS18B20 values, 85 °C is power-on value of the scratchpad,
+        # -127 °C is returned by some drivers on CRC errors
+        self.bottom_temperature_plausibility = PlausibilityFilter(
+            max_step=5, min_std=0.0625, known_bad_values=(85, -127)
+        )
+        self.top_temperature_plausibility = PlausibilityFilter(
+            max_step=5, min_std=0.0625, known_bad_values=(85, -127)
+        )
+        # Calibrated weight, grams. HX711 average is updated every 50 readings
+        # (~50 s), so exactly equal averages for 5 minutes mean stuck converter.
+        self.weight_plausibility = PlausibilityFilter(
+            max_step=500, min_std=20, flatline_samples=300
+        )
 
-    def read_sensors_data(self):
         self.sensors_data = {}
+        # Last raw DS18B20 measurements, a new object means a new conversion
+        self._raw_temperatures = {}
 
-        for sensor in [
+        self._plain_sensors = (
             self.free_memory_sensor,
             self.uptime_sensor,
             self.ip_address_sensor,
             self.heater_output_power_sensor,
-        ]:
+            self.heater_power_sensor,
+        )
+
+    def sensor_names(self):
+        """Names of all measurements published in sensors_data."""
+        return (
+            self.free_memory_sensor.name,
+            self.uptime_sensor.name,
+            self.ip_address_sensor.name,
+            self.heater_output_power_sensor.name,
+            self.heater_power_sensor.name,
+            self.bottom_temperature_sensor.name,
+            self.bottom_temperature_sensor_calibrated.name,
+            self.top_temperature_sensor.name,
+            self.top_temperature_sensor_calibrated.name,
+            self.bulk_temperature_sensor.name,
+            self.stratification_sensor.name,
+            self.weight_sensor.name,
+            self.weight_sensor_compensated.name,
+            self.wight_sensor_calibrated.name,
+            self.evaporation_rate_sensor.name,
+            self.weight_sp_eta_sensor.name,
+            self.batch_energy_sensor.name,
+            self.lifetime_energy_sensor.name,
+        )
+
+    def read_sensors_data(self):
+        # Dictionary is updated in place, keys are the same on every read
+        for sensor in self._plain_sensors:
             self.sensors_data[sensor.name] = sensor.get_measurement()
 
-        for sensor, calibrated_sensor in [
-            (self.bottom_temperature_sensor, self.bottom_temperature_sensor_calibrated),
-            (self.top_temperature_sensor, self.top_temperature_sensor_calibrated),
-            (self.weight_sensor, self.wight_sensor_calibrated),
-        ]:
-            m = sensor.get_measurement()
+        new_temperatures = {}
+        for sensor, calibrated_sensor, plausibility in (
+            (
+                self.bottom_temperature_sensor,
+                self.bottom_temperature_sensor_calibrated,
+                self.bottom_temperature_plausibility,
+            ),
+            (
+                self.top_temperature_sensor,
+                self.top_temperature_sensor_calibrated,
+                self.top_temperature_plausibility,
+            ),
+        ):
+            # Calibrated value inherits quality of the checked raw value
+            raw = sensor.get_measurement()
+            m = plausibility.check(raw)
+            self.sensors_data[sensor.name] = m
+            m = calibrated_sensor.get_measurement(m)
+            self.sensors_data[calibrated_sensor.name] = m
+            if raw is not self._raw_temperatures.get(sensor.name):
+                self._raw_temperatures[sensor.name] = raw
+                new_temperatures[sensor.name] = m
+
+        # Fusion is updated once per conversion, repeated values would look
+        # like a noiseless probe
+        if new_temperatures:
+            self.temperature_fusion.update(
+                new_temperatures.get(self.bottom_temperature_sensor.name),
+                new_temperatures.get(self.top_temperature_sensor.name),
+            )
+        for sensor in (self.bulk_temperature_sensor, self.stratification_sensor):
             self.sensors_data[sensor.name] = sensor.get_measurement()
-            self.sensors_data[calibrated_sensor.name] = (
-                calibrated_sensor.get_measurement(m)
+
+        # Weight is compensated with top temperature, top probe is the closest
+        # one to load cells
+        m = self.weight_sensor.get_measurement()
+        self.sensors_data[self.weight_sensor.name] = m
+        top_temperature = self.sensors_data[self.top_temperature_sensor_calibrated.name]
+        if self.weight_compensation_calibration and m.is_good and top_temperature.is_good:
+            self.weight_compensation_calibration.add_sample(
+                m.value, top_temperature.value
+            )
+
+        m = self.weight_sensor_compensated.get_measurement(m, top_temperature)
+        self.sensors_data[self.weight_sensor_compensated.name] = m
+        self.sensors_data[self.wight_sensor_calibrated.name] = (
+            self.weight_plausibility.check(
+                self.wight_sensor_calibrated.get_measurement(m)
             )
+        )
+
+        weight = self.sensors_data[self.wight_sensor_calibrated.name]
+        if weight.is_good:
+            self.evaporation_estimator.update(weight.value)
+
+        for sensor in (self.evaporation_rate_sensor, self.weight_sp_eta_sensor):
+            self.sensors_data[sensor.name] = sensor.get_measurement()
+
+        # Batch is the time device is enabled
+        self.energy_meter.update(
+            self.heater.take_on_time_ms(), self.parameters.mode != MODE_OFF
+        )
+        for sensor in (self.batch_energy_sensor, self.lifetime_energy_sensor):
+            self.sensors_data[sensor.name] = sensor.get_measurement()
@@ -0,0 +1,161 @@
+import time
+import ujson
+
+
+class StageStatistics:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total_us = 0
+        self.min_us = 0
+        self.max_us = 0
+
+    def add(self, duration_us: int):
+        if not self.count or duration_us < self.min_us:
+            self.min_us = duration_us
+        if duration_us > self.max_us:
+            self.max_us = duration_us
+        self.total_us += duration_us
+        self.count += 1
+
+    def to_dict(self):
+        return {
+            "min": self.min_us,
+            "avg": self.total_us // self.count if self.count else 0,
+            "max": self.max_us,
+        }
+
+
+# Command handling time histogram upper bucket edges, last bucket is unbounded
+COMMAND_BUCKETS_US = (500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+
+class CommandStatistics:
+    """Handling time histogram of one command type, accumulated since boot."""
+
+    def __init__(self):
+        self.count = 0
+        self.max_us = 0
+        self.buckets = [0] * (len(COMMAND_BUCKETS_US) + 1)
+
+    def add(self, duration_us: int):
+        index = 0
+        for edge in COMMAND_BUCKETS_US:
+            if duration_us <= edge:
+                break
+            index += 1
+        self.buckets[index] += 1
+        if duration_us > self.max_us:
+            self.max_us = duration_us
+        self.count += 1
+
+    def to_dict(self):
+        return {"count": self.count, "max": self.max_us, "buckets": self.buckets}
+
+
+class Diagnostics:
+
+    def __init__(
+        self,
+        stage_names,
+        schedulers,
+        mqtt,
+        memory,
+        watchdog_timeout_ms=0,
+        wifi=None,
+        queues=(),
+    ):
+        self.stages = [StageStatistics(name) for name in stage_names]
+        self.schedulers = schedulers
+        self.mqtt = mqtt
+        self.memory = memory
+        self.watchdog_timeout_ms = watchdog_timeout_ms
+        self.wifi = wifi
+        self.queues = queues
+
+        # Milliseconds since boot, ticks_ms() starts from zero on reset
+        self.first_publish_ms = None
+
+        self.commands = {}  # command type -> CommandStatistics
+
+        self.watchdog_feeds = 0
+        self.watchdog_max_interval_ms = 0
+
+        self._iterations = 0
+        self._window_start_ticks = time.ticks_ms()
+        self._last_feed_ticks = self._window_start_ticks
+
+    def begin_iteration(self):
+        self._iterations += 1
+        self.memory.check_automatic_collection()
+        return time.ticks_us()
+
+    def stage_done(self, stage_index: int, start_ticks_us: int):
+        current_ticks = time.ticks_us()
+        self.stages[stage_index].add(time.ticks_diff(current_ticks, start_ticks_us))
+        return current_ticks
+
+    def watchdog_fed(self):
+        current_ticks = time.ticks_ms()
+        interval = time.ticks_diff(current_ticks, self._last_feed_ticks)
+        if interval > self.watchdog_max_interval_ms:
+            self.watchdog_max_interval_ms = interval
+        self._last_feed_ticks = current_ticks
+        self.watchdog_feeds += 1
+
+    def command_done(self, command_type: str, duration_us: int):
+        statistics = self.commands.get(command_type)
+        if statistics is None:
+            statistics = self.commands[command_type] = CommandStatistics()
+        statistics.add(duration_us)
+
+    def publish_done(self):
+        if self.first_publish_ms is None:
+            self.first_publish_ms = time.ticks_ms()
+
+    def to_dict(self):
+        window_ms = time.ticks_diff(time.ticks_ms(), self._window_start_ticks)
+
+        return {
+            "loop_rate": self._iterations * 1000 / window_ms if window_ms else 0,
+            "stages": {s.name: s.to_dict() for s in self.stages},
+            "overruns": {name: s.overruns for name, s in self.schedulers},
+            "dropped": {name: q.dropped for name, q in self.queues},
+            "memory": self.memory.to_dict(),
+            "mqtt": {
+                "connect_attempts": self.mqtt.connect_attempts,
+                "connections": self.mqtt.connections,
+                "disconnects": self.mqtt.disconnects,
+            },
+            "commands": {
+                "buckets_us": COMMAND_BUCKETS_US,
+                "handling": {
+                    name: statistics.to_dict()
+                    for name, statistics in self.commands.items()
+                },
+            },
+            "watchdog": {
+                "timeout_ms": self.watchdog_timeout_ms,
+                "feeds": self.watchdog_feeds,
+                "max_interval_ms": self.watchdog_max_interval_ms,
+            },
+            "boot": {
+                "wifi_connect_ms": self.wifi.connect_ms if self.wifi else None,
+                "wifi_connect_method": self.wifi.connect_method if self.wifi else None,
+                "first_publish_ms": self.first_publish_ms,
+            },
+        }
+
+    def to_json(self):
+        return ujson.dumps(self.to_dict())
+
+    def reset_window(self):
+        for stage in self.stages:
+            stage.reset()
+        self._iterations = 0
+        self._window_start_ticks = time.ticks_ms()
+        self.watchdog_max_interval_ms = 0
@@ -0,0 +1,71 @@
+import _thread
+
+
+class MessageQueue:
+    """
+    Bounded queue between control and network threads. Items are put one by
+    one and taken all at once, so the lock is held only for list swaps.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.dropped = 0
+        self._items = []
+        self._lock = _thread.allocate_lock()
+
+    def put(self, item) -> bool:
+        with self._lock:
+            if len(self._items) >= self.size:
+                self.dropped += 1
+                return False
+            self._items.append(item)
+            return True
+
+    def take_all(self):
+        with self._lock:
+            items = self._items
+            self._items = []
+        return items
+
+
+class Outbox:
+    """
+    Publisher for the control thread with MQTTConnectionManager interface.
+    Messages are queued and sent by the network thread from `flush()`, so
+    control never waits for the socket.
+    """
+
+    def __init__(self, mqtt, size=16):
+        self.mqtt = mqtt
+        self.queue = MessageQueue(size)
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        return self.queue.put((topic, msg, retain, qos))
+
+    def flush(self):
+        for topic, msg, retain, qos in self.queue.take_all():
+            self.mqtt.publish(topic, msg, retain, qos)
+
+
+class SensorsSnapshot:
+    """
+    Copy of Device.sensors_data handed from control to network thread.
+    Dictionaries are updated in place under the lock, keys are the same on
+    every read, so no allocations are done while the lock is held.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._data = {}
+        self._lock = _thread.allocate_lock()
+
+    def store(self, sensors_data):
+        with self._lock:
+            self._data.update(sensors_data)
+            self.version += 1
+
+    def load(self, target) -> int:
+        """Copies the last stored measurements to `target`, returns version."""
+        with self._lock:
+            target.update(self._data)
+            return self.version
@@ -0,0 +1,120 @@
+import time
+import ujson
+
+ENERGY_FILE_NAMES = ("energy_a.json", "energy_b.json")
+SAVE_INTERVAL_MS = 15 * 60 * 1000
+
+
+class EnergyCounter:
+    """
+    Energy counter, whole watt-hours are integer, so small increments are not
+    lost in single precision floats of the MCU on large lifetime values.
+    """
+
+    def __init__(self, wh: int = 0, joules: float = 0):
+        self.wh = wh
+        self.joules = joules
+
+    def add(self, joules: float):
+        self.joules += joules
+        if self.joules >= 3600:
+            whole_wh = int(self.joules // 3600)
+            self.wh += whole_wh
+            self.joules -= whole_wh * 3600
+
+    @property
+    def value_wh(self):
+        return self.wh + self.joules / 3600
+
+    def to_dict(self):
+        return {"wh": self.wh, "joules": self.joules}
+
+
+class EnergyMeter:
+    """
+    Heater energy integrated from actual output on-time and rated heater
+    power, watts.
+
+    Batch counter restarts when device is enabled and stops when it is
+    disabled, lifetime counter is never reset. Batch interrupted by reset
+    continues if device is still enabled after it. Counters are saved
+    alternately to two files with a sequence number and the newest readable
+    copy is loaded on power on, so a write torn by reset damages only the
+    older copy. Saves are done every `save_interval_ms` only while energy is
+    counted and when batch ends, an idle device does not write flash at all.
+    """
+
+    def __init__(
+        self,
+        rated_power: float,
+        file_names=ENERGY_FILE_NAMES,
+        save_interval_ms=SAVE_INTERVAL_MS,
+    ):
+        self.rated_power = rated_power
+        self.file_names = file_names
+        self.save_interval_ms = save_interval_ms
+
+        self.lifetime = EnergyCounter()
+        self.batch = EnergyCounter()
+        self._sequence = 0
+        self._armed = False
+        self._changed = False
+        self._saved_ticks = time.ticks_ms()
+        self.load()
+
+    def load(self):
+        newest = None
+        for file_name in self.file_names:
+            try:
+                with open(file_name) as f:
+                    state = ujson.loads(f.read())
+                if newest is None or state["sequence"] > newest["sequence"]:
+                    newest = state
+            except Exception as e:
+                # Missing file or copy torn by reset during write
+                pass
+
+        if newest:
+            self._sequence = newest["sequence"]
+            self.lifetime = EnergyCounter(**newest["lifetime"])
+            self.batch = EnergyCounter(**newest["batch"])
+            self._armed = newest["armed"]
+
+    def save(self):
+        self._sequence += 1
+        state = {
+            "sequence": self._sequence,
+            "lifetime": self.lifetime.to_dict(),
+            "batch": self.batch.to_dict(),
+            "armed": self._armed,
+        }
+        try:
+            with open(self.file_names[self._sequence % len(self.file_names)], "w") as f:
+                f.write(ujson.dumps(state))
+        except Exception as e:
+            if __debug__:
+                print(f"Energy counters are not saved: {e}")
+        self._saved_ticks = time.ticks_ms()
+        self._changed = False
+
+    def update(self, on_time_ms: int, armed: bool):
+        """Adds heater on-time, `armed` is True while device is enabled."""
+        if armed and not self._armed:
+            self.batch = EnergyCounter()
+            self._changed = True
+
+        if on_time_ms and self.rated_power:
+            joules = self.rated_power * on_time_ms / 1000
+            self.lifetime.add(joules)
+            if armed:
+                self.batch.add(joules)
+            self._changed = True
+
+        batch_ended = self._armed and not armed
+        self._armed = armed
+        if batch_ended or (
+            self._changed
+            and time.ticks_diff(time.ticks_ms(), self._saved_ticks)
+            >= self.save_interval_ms
+        ):
+            self.save()
@@ -0,0 +1,73 @@
+import time
+
+
+class EvaporationEstimator:
+    """
+    Online weight trend estimator.
+
+    Recursive least squares line fit with exponential forgetting, effective
+    window is `window_s` seconds of 1 second samples. Line reference is moved
+    to the last sample on every update, so fitted level is the smoothed
+    current weight and values stay small enough for single precision floats.
+    Estimator restarts when weight jumps (product added or removed).
+    """
+
+    def __init__(self, window_s=600, jump_threshold=500):
+        self.forgetting_factor = 1 - 1 / window_s
+        self.window_s = window_s
+        self.jump_threshold = jump_threshold
+        self.reset()
+
+    def reset(self):
+        self.level = None
+        self.slope = 0
+        self._p00 = 1e4
+        self._p01 = 0
+        self._p11 = 1
+        self._samples = 0
+        self._last_ticks = None
+
+    @property
+    def is_ready(self):
+        return self._samples >= self.window_s // 2
+
+    @property
+    def evaporation_rate(self):
+        """Weight decrease rate, g/min."""
+        return -self.slope * 60
+
+    def seconds_to(self, weight: float):
+        """Time until fitted weight reaches `weight`, None if it is not decreasing."""
+        if self.slope >= 0:
+            return None
+        return max(0, (self.level - weight) / -self.slope)
+
+    def update(self, weight: float):
+        current_ticks = time.ticks_ms()
+        if self.level is None or abs(weight - self.level) > self.jump_threshold:
+            self.reset()
+            self.level = weight
+            self._last_ticks = current_ticks
+            return
+
+        dt = time.ticks_diff(current_ticks, self._last_ticks) / 1000
+        self._last_ticks = current_ticks
+
+        # Move line reference to the new sample time
+        self.level += self.slope * dt
+        p00 = self._p00 + dt * (2 * self._p01 + dt * self._p11)
+        p01 = self._p01 + dt * self._p11
+        p11 = self._p11
+
+        # Correct with the new sample, regressor is [1, 0] at the reference
+        error = weight - self.level
+        denominator = self.forgetting_factor + p00
+        k0 = p00 / denominator
+        k1 = p01 / denominator
+        self.level += k0 * error
+        self.slope += k1 * error
+
+        self._p00 = (p00 - k0 * p00) / self.forgetting_factor
+        self._p01 = (p01 - k0 * p01) / self.forgetting_factor
+        self._p11 = (p11 - k1 * p01) / self.forgetting_factor
+        self._samples += 1
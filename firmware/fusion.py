@@ -0,0 +1,166 @@
+import time
+
+from plausibility import RunningStatistics
+from sensors import QUALITY_BAD, Measurement
+
+# DS18B20 0.0625 °C quantization noise variance
+MIN_MEASUREMENT_VARIANCE = 0.0625**2 / 12
+
+
+class TemperatureFusionSettings:
+
+    def __init__(self, bottom_lag: float = 0, top_lag: float = 0):
+        # Probe time constants, seconds. Probe reading lags behind the
+        # liquid for about lag * heating rate.
+        self.bottom_lag = bottom_lag
+        self.top_lag = top_lag
+
+    def to_dict(self):
+        return {"bottom_lag": self.bottom_lag, "top_lag": self.top_lag}
+
+
+class _Probe:
+
+    def __init__(self, lag: float, sign: float):
+        # Measurement model row: T - lag * rate + sign * S / 2
+        self.h = (1, -lag, sign / 2)
+        self.variance = 0.01
+        self.innovations = RunningStatistics(60)
+
+
+class TemperatureFusion:
+    """
+    Kalman filter fusing bottom and top temperature probes.
+
+    State is bulk (mean) temperature T, its rate of change, °C/s, and
+    stratification S = top - bottom. Bottom probe measures T - S / 2, top
+    probe T + S / 2, both lagging behind the liquid for their time constant
+    times the rate. Stratification changes slowly, so fast changes seen by
+    either probe are attributed to T. Probes are weighted by their noise,
+    which is estimated online from innovation variance. Each probe is a
+    scalar update, no matrix inversion is needed.
+
+    Only good measurements update the state, uncertain ones are skipped.
+    Without top probe the estimate is filtered and lag compensated bottom
+    temperature, stratification is unknown.
+    """
+
+    def __init__(
+        self,
+        settings: TemperatureFusionSettings,
+        temperature_noise=1e-4,
+        rate_noise=1e-6,
+        stratification_noise=1e-4,
+    ):
+        self.temperature_noise = temperature_noise
+        self.rate_noise = rate_noise
+        self.stratification_noise = stratification_noise
+        self.configure(settings)
+
+    def configure(self, settings: TemperatureFusionSettings):
+        self.settings = settings
+        self._bottom = _Probe(settings.bottom_lag, -1)
+        self._top = _Probe(settings.top_lag, 1)
+        self.bottom_quality = QUALITY_BAD
+        self.top_quality = QUALITY_BAD
+        self.reset()
+
+    def reset(self):
+        self.x = None
+        self.P = None
+        self.has_stratification = False
+        self._last_ticks = None
+
+    @property
+    def temperature(self):
+        return self.x[0] if self.x else None
+
+    @property
+    def rate(self):
+        return self.x[1] if self.x else None
+
+    @property
+    def stratification(self):
+        return self.x[2] if self.x else None
+
+    def _predict(self, dt):
+        x = self.x
+        P = self.P
+        x[0] += x[1] * dt
+
+        # P = F P F^T + Q, F = [[1, dt, 0], [0, 1, 0], [0, 0, 1]]
+        P[0][0] += dt * (P[1][0] + P[0][1]) + dt * dt * P[1][1]
+        P[0][1] += dt * P[1][1]
+        P[0][2] += dt * P[1][2]
+        P[1][0] = P[0][1]
+        P[2][0] = P[0][2]
+
+        P[0][0] += self.temperature_noise * dt
+        P[1][1] += self.rate_noise * dt
+        if self.has_stratification:
+            P[2][2] += self.stratification_noise * dt
+
+    def _update(self, probe, z):
+        x = self.x
+        P = self.P
+        h = probe.h
+        innovation = z - (h[0] * x[0] + h[1] * x[1] + h[2] * x[2])
+        Ph = [P[i][0] * h[0] + P[i][1] * h[1] + P[i][2] * h[2] for i in range(3)]
+        hPh = h[0] * Ph[0] + h[1] * Ph[1] + h[2] * Ph[2]
+
+        # Innovation variance is hPh + R, measurement noise is what remains
+        probe.innovations.add(innovation)
+        if probe.innovations.count >= 10:
+            probe.variance = max(
+                MIN_MEASUREMENT_VARIANCE, probe.innovations.variance - hPh
+            )
+
+        s = hPh + probe.variance
+        K = [v / s for v in Ph]
+        for i in range(3):
+            x[i] += K[i] * innovation
+            for j in range(3):
+                P[i][j] -= K[i] * Ph[j]
+
+    def _start_stratification(self, top):
+        # Stratification was held at zero, first top value sets it and T is
+        # moved to the middle keeping the bottom estimate
+        x = self.x
+        bottom = x[0] - x[2] / 2
+        x[2] = top - bottom
+        x[0] = bottom + x[2] / 2
+        self.P[2][2] = 1
+        self.has_stratification = True
+
+    def update(self, bottom: Measurement = None, top: Measurement = None):
+        """Adds new probe measurements, None if probe has no new conversion."""
+        if bottom:
+            self.bottom_quality = bottom.quality
+            if bottom.is_bad:
+                self.reset()
+                return
+        if top:
+            self.top_quality = top.quality
+        bottom = bottom.value if bottom and bottom.is_good else None
+        top = top.value if top and top.is_good else None
+
+        current_ticks = time.ticks_ms()
+        if self.x is None:
+            if bottom is None:
+                return
+            self.x = [bottom, 0, 0]
+            self.P = [[1, 0, 0], [0, 0.01, 0], [0, 0, 0]]
+            self._last_ticks = current_ticks
+            if top is not None:
+                self._start_stratification(top)
+            return
+
+        self._predict(time.ticks_diff(current_ticks, self._last_ticks) / 1000)
+        self._last_ticks = current_ticks
+        if bottom is not None:
+            self._update(self._bottom, bottom)
+        if top is not None:
+            if self.has_stratification:
+                self._update(self._top, top)
+            else:
+                self._start_stratification(top)
@@ -0,0 +1,68 @@
+import ujson
+
+
+class GainSchedulePoint:
+
+    def __init__(self, weight: float, pid_p: float, pid_i: float, pid_d: float):
+        self.weight = weight
+        self.pid_p = pid_p
+        self.pid_i = pid_i
+        self.pid_d = pid_d
+
+    def to_dict(self):
+        return {
+            "weight": self.weight,
+            "pid_p": self.pid_p,
+            "pid_i": self.pid_i,
+            "pid_d": self.pid_d,
+        }
+
+    def to_json(self):
+        return ujson.dumps(self.to_dict())
+
+
+class GainSchedule:
+    """
+    PID gains table keyed on product weight.
+
+    Gains are linearly interpolated between table points and held constant
+    outside of the table range. Empty table disables scheduling.
+    """
+
+    def __init__(self, points):
+        points = sorted(points, key=lambda p: p.weight)
+        for i in range(1, len(points)):
+            if points[i].weight == points[i - 1].weight:
+                raise ValueError("Gain schedule weights should be unique")
+
+        self._weights = [p.weight for p in points]
+        self._gains = [(p.pid_p, p.pid_i, p.pid_d) for p in points]
+
+    @property
+    def is_enabled(self):
+        return len(self._weights) > 0
+
+    def gains(self, weight: float):
+        weights = self._weights
+        if weight <= weights[0]:
+            return self._gains[0]
+        if weight >= weights[-1]:
+            return self._gains[-1]
+
+        # Binary search for the segment weights[i - 1] < weight <= weights[i]
+        low, high = 1, len(weights) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if weights[middle] < weight:
+                low = middle + 1
+            else:
+                high = middle
+
+        ratio = (weight - weights[low - 1]) / (weights[low] - weights[low - 1])
+        gains_1 = self._gains[low - 1]
+        gains_2 = self._gains[low]
+        return (
+            gains_1[0] + (gains_2[0] - gains_1[0]) * ratio,
+            gains_1[1] + (gains_2[1] - gains_1[1]) * ratio,
+            gains_1[2] + (gains_2[2] - gains_1[2]) * ratio,
+        )
@@ -14,6 +14,8 @@ class Heater:
         self._current_power_percent = 0
         self._prev_ticks = 0
         self._output_state = 0
+        self._output_ticks = time.ticks_ms()
+        self._on_time_ms = 0
         self._output_pin = machine.Pin(output_pin_number, machine.Pin.OUT)
 
     def set_power(self, new_power_percent: int):
@@ -36,10 +38,30 @@ class Heater:
     def get_power(self) -> int:
         return self._current_power_percent
 
+    def get_duty_cycle(self) -> float:
+        """Actual output duty cycle after power limit and 50 Hz rounding, 0..1."""
+        return self._current_pulse_width / self.pwm_interval_ms
+
+    def take_on_time_ms(self) -> int:
+        """Output on-time since the previous call, milliseconds."""
+        on_time_ms = self._on_time_ms
+        self._on_time_ms = 0
+        return on_time_ms
+
+    def ms_until_next_edge(self) -> int:
+        spent_ticks = time.ticks_diff(time.ticks_ms(), self._prev_ticks)
+
+        if self._output_state and spent_ticks < self._current_pulse_width:
+            return int(self._current_pulse_width) - spent_ticks
+        return self.pwm_interval_ms - spent_ticks
+
     def handle_output(self):
         current_ticks = time.ticks_ms()
-        spent_ticks = time.ticks_diff(current_ticks, self._prev_ticks)
+        if self._output_state:
+            self._on_time_ms += time.ticks_diff(current_ticks, self._output_ticks)
+        self._output_ticks = current_ticks
 
+        spent_ticks = time.ticks_diff(current_ticks, self._prev_ticks)
         if spent_ticks >= self.pwm_interval_ms:
             self._output_state = 1 if self._current_pulse_width > 0 else 0
             self._prev_ticks = current_ticks
@@ -0,0 +1,121 @@
+ENCODING = "utf-8"
+
+
+def url_decode(url_string):
+    if not url_string:
+        return b""
+
+    if isinstance(url_string, str):
+        url_string = url_string.encode(ENCODING)
+
+    bits = url_string.split(b"%")
+
+    if len(bits) == 1:
+        return url_string
+
+    res = [bits[0]]
+    appnd = res.append
+    hextobyte_cache = {}
+
+    for item in bits[1:]:
+        try:
+            code = item[:2]
+            char = hextobyte_cache.get(code)
+            if char is None:
+                char = hextobyte_cache[code] = bytes([int(code, 16)])
+            appnd(char)
+            appnd(item[2:])
+        except Exception as error:
+            if __debug__:
+                print(error)
+            appnd(b"%")
+            appnd(item)
+
+    return b"".join(res)
+
+
+def parse_form(data):
+    """Parses application/x-www-form-urlencoded data, fields may come in any order."""
+    fields = {}
+    for field in data.split(b"&"):
+        if not field:
+            continue
+        name, _, value = field.partition(b"=")
+        fields[url_decode(name.replace(b"+", b" ")).decode(ENCODING)] = url_decode(
+            value.replace(b"+", b" ")
+        ).decode(ENCODING)
+    return fields
+
+
+class HTTPRequest:
+    """
+    Incremental HTTP request parser. Data received from socket is passed to
+    feed() in chunks of any size, request is complete when the header and
+    Content-Length bytes of body are received.
+    """
+
+    def __init__(self, max_header_size=2048, max_body_size=4096):
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+
+        self.method = None
+        self.path = None
+        self.query = b""
+        self.version = None
+        self.headers = {}
+        self.body = bytearray()
+        self.is_complete = False
+
+        self._header = b""
+        self._content_length = None
+
+    def feed(self, data) -> bool:
+        """Returns True when request is complete, raises ValueError for malformed request."""
+        if self._content_length is None:
+            self._header += data
+            end = self._header.find(b"\r\n\r\n")
+            if end < 0:
+                if len(self._header) > self.max_header_size:
+                    raise ValueError("Request header is too large")
+                return False
+
+            data = self._header[end + 4 :]
+            self._parse_header(self._header[:end])
+            self._header = b""
+
+        self.body.extend(data[: self._content_length - len(self.body)])
+        self.is_complete = len(self.body) >= self._content_length
+        return self.is_complete
+
+    def _parse_header(self, header):
+        lines = header.split(b"\r\n")
+        request_line = lines[0].split(b" ")
+        if len(request_line) != 3:
+            raise ValueError("Malformed request line")
+
+        self.method = request_line[0].decode(ENCODING)
+        self.version = request_line[2].decode(ENCODING)
+        path, _, self.query = request_line[1].partition(b"?")
+        self.path = url_decode(path).decode(ENCODING)
+
+        for line in lines[1:]:
+            name, _, value = line.partition(b":")
+            self.headers[name.strip().lower().decode(ENCODING)] = value.strip().decode(
+                ENCODING
+            )
+
+        self._content_length = int(self.headers.get("content-length", 0))
+        if self._content_length < 0 or self._content_length > self.max_body_size:
+            raise ValueError("Request body is too large")
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def form(self):
+        if self.method == "POST":
+            return parse_form(bytes(self.body))
+        return parse_form(self.query)
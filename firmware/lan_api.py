@@ -0,0 +1,179 @@
+import errno
+import socket
+import time
+
+from http_request import ENCODING, HTTPRequest
+
+MAX_CONNECTIONS = 4
+REQUEST_TIMEOUT_MS = 5000
+# Slow event stream clients are dropped instead of buffering without limit
+MAX_STREAM_BACKLOG = 4096
+RECV_SIZE = 512
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found"}
+
+
+class _Connection:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.request = HTTPRequest(max_body_size=0)
+        self.output = b""
+        self.is_stream = False
+        self.is_responded = False
+        self.accepted_ticks = time.ticks_ms()
+
+
+class LanApi:
+    """
+    Read-only HTTP API for the local network, works while MQTT broker is
+    unreachable:
+
+    - GET /sensors - current measurements as in from_device/sensors;
+    - GET /parameters - parameters as in from_device/parameters;
+    - GET /events - Server-Sent Events stream of measurements.
+
+    All sockets are non-blocking, `poll()` is called from the main loop and
+    does at most one accept, one receive and one send per connection.
+    """
+
+    def __init__(self, sensors_data, parameters, port=80):
+        self.sensors_data = sensors_data
+        self.parameters = parameters
+        self.port = port
+        self.requests = 0
+        self._connections = []
+        self._server = None
+
+    def start(self):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("", self.port))
+        self._server.listen(MAX_CONNECTIONS)
+        self._server.setblocking(False)
+
+    @property
+    def stream_clients(self):
+        return sum(1 for c in self._connections if c.is_stream)
+
+    def poll(self):
+        if not self._server:
+            return
+
+        if len(self._connections) < MAX_CONNECTIONS:
+            self._accept()
+
+        for connection in self._connections[:]:
+            try:
+                self._poll_connection(connection)
+            except OSError as e:
+                if __debug__:
+                    print(f"LAN API connection error: {e}")
+                self._close(connection)
+
+    def send_event(self, event: str, data: str):
+        """Queues SSE message for every stream client, `data` is a single line."""
+        message = f"event: {event}\ndata: {data}\n\n".encode(ENCODING)
+        for connection in self._connections[:]:
+            if not connection.is_stream:
+                continue
+            if len(connection.output) > MAX_STREAM_BACKLOG:
+                self._close(connection)
+            else:
+                connection.output += message
+
+    def _accept(self):
+        try:
+            sock, _ = self._server.accept()
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return
+
+        sock.setblocking(False)
+        self._connections.append(_Connection(sock))
+
+    def _poll_connection(self, connection):
+        if not connection.is_stream and not connection.is_responded:
+            try:
+                data = connection.sock.recv(RECV_SIZE)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                data = None
+
+            if data is not None:
+                if not data:
+                    self._close(connection)
+                    return
+                try:
+                    if connection.request.feed(data):
+                        self._handle_request(connection)
+                except ValueError:
+                    self._respond(connection, 400, '{"error": "Bad request"}')
+            elif (
+                time.ticks_diff(time.ticks_ms(), connection.accepted_ticks)
+                > REQUEST_TIMEOUT_MS
+            ):
+                self._close(connection)
+                return
+
+        if connection.output:
+            try:
+                sent = connection.sock.send(connection.output)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                sent = 0
+            connection.output = connection.output[sent:]
+
+        if connection.is_responded and not connection.output:
+            self._close(connection)
+
+    def _handle_request(self, connection):
+        self.requests += 1
+        path = connection.request.path.rstrip("/")
+        if connection.request.method != "GET":
+            self._respond(connection, 400, '{"error": "Only GET is supported"}')
+        elif path == "/sensors":
+            self._respond(
+                connection,
+                200,
+                "{"
+                + ", ".join(
+                    f'"{name}": {m.to_json()}' for name, m in self.sensors_data.items()
+                )
+                + "}",
+            )
+        elif path == "/parameters":
+            self._respond(connection, 200, self.parameters.to_json())
+        elif path == "/events":
+            connection.is_stream = True
+            connection.output = (
+                "HTTP/1.1 200 OK\r\n"
+                "Content-Type: text/event-stream\r\n"
+                "Cache-Control: no-cache\r\n"
+                "Access-Control-Allow-Origin: *\r\n"
+                "Connection: keep-alive\r\n\r\n"
+            ).encode(ENCODING)
+        else:
+            self._respond(connection, 404, '{"error": "Not found"}')
+
+    def _respond(self, connection, status_code, body):
+        body = body.encode(ENCODING)
+        connection.is_responded = True
+        connection.output = (
+            f"HTTP/1.1 {status_code} {STATUS_TEXT[status_code]}\r\n"
+            "Content-Type: application/json\r\n"
+            "Access-Control-Allow-Origin: *\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode(ENCODING) + body
+
+    def _close(self, connection):
+        try:
+            connection.sock.close()
+        except OSError:
+            pass
+        if connection in self._connections:
+            self._connections.remove(connection)
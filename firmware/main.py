@@ -1,24 +1,78 @@
+import _thread
 import re
 import time
 
-import machine
 import scheduler
 import ubinascii
 import ujson
+from autotune import AUTOTUNE_DONE, AUTOTUNE_RUNNING, RelayAutotuner
 from heater import Heater
-from machine import Pin, Signal, freq, unique_id
+from machine import WDT, Pin, Signal, freq, unique_id
+from micropython import const
 from device import Device
-from parameter_manager import MODE_AUTO, MODE_OFF, MODE_REMOTE, ParameterManager
+from gain_schedule import GainSchedule, GainSchedulePoint
+from diagnostics import Diagnostics
+from dual_core import MessageQueue, Outbox, SensorsSnapshot
+from memory import MemoryManager
+from parameter_manager import (
+    MODE_AUTO,
+    MODE_AUTOTUNE,
+    MODE_OFF,
+    MODE_REMOTE,
+    PID_INPUT_BOTTOM,
+    PID_INPUT_BULK,
+    ParameterManager,
+)
+from fusion import TemperatureFusionSettings
+from recipe import RECIPE_DONE, make_steps
+from power_profile import PowerProfile
+from safety import make_rules
 from sensors import CalibrationPoint, CalibratedSensor
+from weight_compensation import (
+    CALIBRATION_SPAN,
+    CALIBRATION_ZERO,
+    WeightCompensation,
+    WeightCompensationCalibration,
+)
 
-from umqtt.robust import MQTTClient
+from lan_api import LanApi
+from mqtt_manager import MQTTConnectionManager
+from umqtt.simple import MQTTClient
 from wifi_manager import WifiManager
 
+# Set to 0 to compile out loop instrumentation, watchdog and scheduled GC
+_DIAGNOSTICS = const(1)
+_WATCHDOG = const(1)
+_MEMORY_MANAGEMENT = const(1)
+# Local HTTP API, works while MQTT broker is unreachable
+_LAN_API = const(1)
+_WATCHDOG_TIMEOUT_MS = const(10000)
+# Control (sensors, alarms, regulators, heater output) and network (MQTT,
+# publishing, LAN API) run in separate threads, so network stalls do not delay
+# safety shutdowns
+_DUAL_CORE = const(0)
+_CONTROL_PERIOD_MS = const(5)
+_NETWORK_IDLE_MS = const(2)
+_NETWORK_STACK_SIZE = const(16384)
+_COMMAND_QUEUE_SIZE = const(8)
+_OUTBOX_SIZE = const(16)
+
+_STAGE_MQTT = const(0)
+_STAGE_READ_SENSORS = const(1)
+_STAGE_PUBLISH_SENSORS = const(2)
+_STAGE_SAFETY = const(3)
+_STAGE_MODES = const(4)
+_STAGE_OUTPUT = const(5)
+_STAGE_LAN_API = const(6)
+
 configuration_mode_signal = Signal(Pin(23, Pin.IN, Pin.PULL_UP), invert=True)
 
 mqtt_client_id = ubinascii.hexlify(unique_id())
 parameters = None
 mqtt_client = None
+# Publisher of control code, outbox of network thread in dual core mode
+mqtt = None
+mqtt_connection = None
 
 wifi_manager = WifiManager(
     ssid="smart_tank",
@@ -27,9 +81,63 @@ wifi_manager = WifiManager(
 )
 
 device = None
+memory = MemoryManager()
+lan_api = None
+diagnostics = None
+watchdog = None
+
+# Dual core mode queues, commands are handled by control thread
+commands = None
+sensors_snapshot = None
+# Measurements published by network code, copy of Device.sensors_data in dual
+# core mode
+network_sensors_data = None
 
 ping_sheduler = scheduler.Scheduler(30000)
+recipe_progress_scheduler = scheduler.Scheduler(10000)
 weight_sp_count = 0
+# Remote mode heater power profile, None if power is set by single commands
+power_profile = None
+
+# Calibration parameters prefix: (raw sensor, calibrated sensor) Device attributes
+CALIBRATED_SENSORS = {
+    "weight": ("weight_sensor_compensated", "wight_sensor_calibrated"),
+    "bottom_temperature": (
+        "bottom_temperature_sensor",
+        "bottom_temperature_sensor_calibrated",
+    ),
+    "top_temperature": ("top_temperature_sensor", "top_temperature_sensor_calibrated"),
+}
+
+# Regulated temperature source names for status messages
+PID_INPUT_NAMES = {
+    PID_INPUT_BOTTOM: "Bottom temperature sensor",
+    PID_INPUT_BULK: "Bulk temperature estimate",
+}
+
+# Heater output floor while approaching weight setpoint, evaporation must go on
+WEIGHT_SP_RAMP_MIN_OUTPUT = 20
+
+AUTOTUNE_HYSTERESIS = 0.5
+autotuner = None
+
+# Command types with handling time statistics, other topics are counted as "other"
+COMMAND_TYPES = (
+    "parameters",
+    "ping",
+    "heater_power",
+    "heater_power_profile",
+    "autotune",
+    "weight_compensation",
+    "recipe",
+)
+# Request of the command being handled, status and pong replies echo it
+current_request = None
+
+# Topics are built once and reused, client id does not change after boot
+mqtt_input_topics = {}
+mqtt_output_topics = {}
+parameters_topic_regex = None
 
 
 def make_mqtt_topic(path):
@@ -37,25 +145,104 @@ def make_mqtt_topic(path):
 
 
 def make_mqtt_input_topic(path):
-    return make_mqtt_topic(f"/to_device{path}")
+    topic = mqtt_input_topics.get(path)
+    if topic is None:
+        topic = mqtt_input_topics[path] = make_mqtt_topic(f"/to_device{path}")
+    return topic
 
 
 def make_mqtt_output_topic(path):
-    return make_mqtt_topic(f"/from_device{path}")
+    topic = mqtt_output_topics.get(path)
+    if topic is None:
+        topic = mqtt_output_topics[path] = make_mqtt_topic(f"/from_device{path}")
+    return topic
+
+
+def send_status(status_code=200, message="ok", reason=None):
+    status = {"status": status_code, "message": message}
+    if reason:
+        status["reason"] = reason
+    if current_request:
+        status.update(request_reply(current_request))
+    mqtt.publish(make_mqtt_output_topic("/status"), ujson.dumps(status))
+
+
+def parse_command_envelope(bmsg, start_ticks_us):
+    """
+    Command payload may be wrapped as
+    {"request_id": ..., "client_time": ..., "value": ...}, returns
+    (bare payload, request) or (bmsg, None) for plain payloads.
+    """
+    if not bmsg.startswith(b"{"):
+        return bmsg, None
+    try:
+        envelope = ujson.loads(bmsg)
+    except ValueError:
+        return bmsg, None
+    # JSON object parameters, e.g. weight_temperature_compensation, have no request_id
+    if "request_id" not in envelope:
+        return bmsg, None
+
+    value = envelope.get("value", "")
+    if isinstance(value, str):
+        payload = value.encode()
+    elif isinstance(value, (int, float)):
+        payload = str(value).encode()
+    else:
+        payload = ujson.dumps(value).encode()
 
+    return payload, {
+        "request_id": envelope["request_id"],
+        "client_time": envelope.get("client_time"),
+        "device_ticks_ms": time.ticks_ms(),
+        "start_ticks_us": start_ticks_us,
+    }
+
+
+def request_reply(request):
+    return {
+        "request_id": request["request_id"],
+        "client_time": request["client_time"],
+        "device_ticks_ms": request["device_ticks_ms"],
+        "handling_us": time.ticks_diff(time.ticks_us(), request["start_ticks_us"]),
+    }
+
+
+def command_type(btopic):
+    path = btopic[len(make_mqtt_input_topic("/")) :]
+    name = path.split(b"/", 1)[0].decode()
+    return name if name in COMMAND_TYPES else "other"
+
+
+def queue_command(btopic, bmsg):
+    if not commands.put((btopic, bmsg, time.ticks_us())):
+        mqtt_connection.publish(
+            make_mqtt_output_topic("/status"),
+            ujson.dumps({"status": 503, "message": "Device busy"}),
+        )
 
-def send_status(status_code=200, message="ok"):
-    mqtt_client.publish(
-        make_mqtt_output_topic("/status"),
-        ujson.dumps({"status": status_code, "message": message}),
-    )
 
+def mqtt_message_handler(btopic, bmsg, start_ticks_us=None):
+    global current_request
+    if start_ticks_us is None:
+        start_ticks_us = time.ticks_us()
+    bmsg, current_request = parse_command_envelope(bmsg, start_ticks_us)
+    try:
+        handle_command(btopic, bmsg)
+    finally:
+        current_request = None
 
-def mqtt_message_handler(btopic, bmsg):
+    if _DIAGNOSTICS:
+        diagnostics.command_done(
+            command_type(btopic), time.ticks_diff(time.ticks_us(), start_ticks_us)
+        )
+
+
+def handle_command(btopic, bmsg):
     if __debug__:
         print(f"Recieved MQTT message '{bmsg.decode()}' from topic '{btopic.decode()}'")
 
-    if m := re.search(make_mqtt_input_topic("/parameters/(.+)"), btopic):
+    if m := parameters_topic_regex.search(btopic):
         parameter_name = m.group(1)
         try:
             if parameter_name in [
@@ -63,6 +250,7 @@ def mqtt_message_handler(btopic, bmsg):
                 b"bottom_temperature_ah",
                 b"top_temperature_ah",
                 b"weight_sp",
+                b"weight_sp_lead_time",
             ]:
                 if parameter_name == b"mode":
                     parameter_value = int(bmsg)
@@ -73,7 +261,9 @@ def mqtt_message_handler(btopic, bmsg):
             elif parameter_name == b"bottom_temperature_sp":
                 new_setpoint = float(bmsg)
                 device.parameters.bottom_temperature_sp = new_setpoint
-                device.temperature_regulator.setpoint = new_setpoint
+                # Running recipe owns the setpoint, new one is used after it
+                if not device.recipe.is_running:
+                    device.temperature_regulator.setpoint = new_setpoint
                 send_status()
             elif parameter_name == b"pid_p":
                 new_p = float(bmsg)
@@ -90,53 +280,133 @@ def mqtt_message_handler(btopic, bmsg):
                 device.parameters.pid_d = new_d
                 device.temperature_regulator.Kd = new_d
                 send_status()
+            elif parameter_name == b"pid_gain_schedule":
+                points = [GainSchedulePoint(**p) for p in ujson.loads(bmsg)]
+                gain_schedule = GainSchedule(points)
+                device.parameters.pid_gain_schedule = points
+                device.gain_schedule = gain_schedule
+                if not gain_schedule.is_enabled:
+                    device.temperature_regulator.set_tunings_bumpless(
+                        (
+                            device.parameters.pid_p,
+                            device.parameters.pid_i,
+                            device.parameters.pid_d,
+                        )
+                    )
+                send_status()
+            elif parameter_name == b"pid_input":
+                new_input = int(bmsg)
+                if new_input not in (PID_INPUT_BOTTOM, PID_INPUT_BULK):
+                    raise ValueError("Unknown PID input")
+                device.parameters.pid_input = new_input
+                # Regulator restarts from the current power on the new input
+                device.temperature_regulator.auto_mode = False
+                send_status()
+            elif parameter_name == b"temperature_fusion":
+                settings = TemperatureFusionSettings(**ujson.loads(bmsg))
+                device.parameters.temperature_fusion = settings
+                device.temperature_fusion.configure(settings)
+                send_status()
             elif parameter_name == b"output_max_power":
                 new_limit = int(bmsg)
                 device.parameters.output_max_power = new_limit
                 device.heater.power_limit_percent = new_limit
                 send_status()
+            elif parameter_name == b"heater_rated_power":
+                new_rated_power = float(bmsg)
+                device.parameters.heater_rated_power = new_rated_power
+                device.energy_meter.rated_power = new_rated_power
+                send_status()
             elif parameter_name == b"output_pwm_interval_ms":
                 new_interval = int(bmsg)
                 device.parameters.output_pwm_interval_ms = new_interval
                 device.heater.pwm_interval_ms = new_interval
                 send_status()
 
-            elif parameter_name in [
-                b"weight_calibration_points",
-                b"bottom_temperature_calibration_points",
-                b"top_temperature_calibration_points",
-            ]:
-                cp = [CalibrationPoint(**p) for p in ujson.loads(bmsg)]
-
-                if parameter_name == b"weight_calibration_points":
-                    device.parameters.weight_calibration_points = cp
-                    device.wight_sensor_calibrated = CalibratedSensor(
-                        device.weight_sensor,
-                        *device.parameters.weight_calibration_points,
-                    )
-                elif parameter_name == b"bottom_temperature_calibration_points":
-                    device.parameters.bottom_temperature_calibration_points = cp
-                    device.bottom_temperature_sensor_calibrated = CalibratedSensor(
-                        device.bottom_temperature_sensor,
-                        *device.parameters.bottom_temperature_calibration_points,
-                    )
-                elif parameter_name == b"top_temperature_calibration_points":
-                    device.parameters.top_temperature_calibration_points = cp
-                    device.top_temperature_sensor_calibrated = CalibratedSensor(
-                        device.top_temperature_sensor,
-                        *device.parameters.top_temperature_calibration_points,
-                    )
+            elif parameter_name == b"recipe":
+                if device.recipe.is_running:
+                    send_status(400, "Recipe is running")
+                    return
+                config = ujson.loads(bmsg)
+                steps = make_steps(config)
+                device.parameters.recipe = config
+                device.recipe.configure(steps)
+                send_status()
+            elif parameter_name == b"safety_rules":
+                config = ujson.loads(bmsg)
+                rules = make_rules(config, device.sensor_names())
+                device.parameters.safety_rules = config
+                device.safety.configure(rules)
+                send_status()
+            elif parameter_name == b"weight_temperature_compensation":
+                compensation = WeightCompensation(**ujson.loads(bmsg))
+                device.parameters.weight_temperature_compensation = compensation
+                device.weight_sensor_compensated.compensation = compensation
+                send_status()
+            elif parameter_name.endswith(
+                b"_calibration_points"
+            ) or parameter_name.endswith(b"_calibration_degree"):
+                sensor_name, _, field = parameter_name.decode().rpartition(
+                    "_calibration_"
+                )
+                sensor_attribute, calibrated_sensor_attribute = CALIBRATED_SENSORS[
+                    sensor_name
+                ]
+                points = getattr(device.parameters, f"{sensor_name}_calibration_points")
+                degree = getattr(device.parameters, f"{sensor_name}_calibration_degree")
+                if field == "points":
+                    points = [CalibrationPoint(**p) for p in ujson.loads(bmsg)]
+                else:
+                    degree = int(bmsg)
+                    if degree < 0 or degree >= len(points):
+                        raise ValueError("Wrong calibration degree")
+
+                # Sensor is built first, invalid calibration is not persisted
+                calibrated_sensor = CalibratedSensor(
+                    getattr(device, sensor_attribute), *points, degree=degree
+                )
+                setattr(
+                    device.parameters,
+                    parameter_name.decode(),
+                    points if field == "points" else degree,
+                )
+                setattr(device, calibrated_sensor_attribute, calibrated_sensor)
                 send_status()
 
         except Exception as e:
             send_status(400, "Bad parameter name or parameter value")
     elif btopic == make_mqtt_input_topic("/ping"):
         ping_sheduler.reset()
-        mqtt_client.publish(make_mqtt_output_topic("/pong"), "")
+        mqtt.publish(
+            make_mqtt_output_topic("/pong"),
+            ujson.dumps(request_reply(current_request)) if current_request else "",
+        )
+    elif btopic == make_mqtt_input_topic("/autotune/apply"):
+        if not autotuner or autotuner.state != AUTOTUNE_DONE:
+            send_status(400, "No autotune results")
+        elif device.gain_schedule.is_enabled:
+            # Schedule would overwrite applied gains on the next sensors read
+            send_status(400, "PID gain schedule is enabled")
+        elif bmsg == b"zn":
+            apply_pid_gains(autotuner.ziegler_nichols_gains())
+            send_status()
+        elif bmsg == b"tl":
+            apply_pid_gains(autotuner.tyreus_luyben_gains())
+            send_status()
+        else:
+            send_status(400, "Wrong tuning rule")
+    elif btopic == make_mqtt_input_topic("/weight_compensation"):
+        handle_weight_compensation_command(bmsg)
+    elif btopic == make_mqtt_input_topic("/recipe"):
+        handle_recipe_command(bmsg)
+    elif btopic == make_mqtt_input_topic("/heater_power_profile"):
+        handle_power_profile_command(bmsg)
     elif btopic == make_mqtt_input_topic("/heater_power"):
         try:
             if device.parameters.mode == MODE_REMOTE:
                 new_power = int(bmsg)
+                # Single power command cancels running profile
+                set_power_profile(None)
                 device.heater.set_power(new_power)
                 send_status()
             else:
@@ -145,49 +415,170 @@ def mqtt_message_handler(btopic, bmsg):
             send_status(400, "Wrong power value")
 
 
-def read_sensors_data():
-    device.read_sensors_data()
-
+def set_power_profile(profile):
+    global power_profile
+    power_profile = profile
 
-def publish_sensors_data():
-    sensors_data = {k: v.to_dict() for k, v in device.sensors_data.items()}
-    mqtt_client.publish(make_mqtt_output_topic("/sensors"), ujson.dumps(sensors_data))
 
+def handle_power_profile_command(bmsg):
+    if device.parameters.mode != MODE_REMOTE:
+        send_status(400, "Wrong device mode")
+        return
 
-def handle_ah():
-    if device.parameters.mode == MODE_OFF:
+    try:
+        command = ujson.loads(bmsg)
+        profile = PowerProfile(command["points"], command["expires"])
+    except Exception as e:
+        send_status(400, "Wrong power profile")
         return
 
-    top_temperature_measurement = device.sensors_data.get(
-        device.top_temperature_sensor_calibrated.name
+    # New profile replaces running one, power is applied by handle_remote_mode
+    set_power_profile(profile)
+    ping_sheduler.reset()
+    send_status()
+
+
+def apply_pid_gains(gains):
+    device.parameters.pid_p = gains["pid_p"]
+    device.parameters.pid_i = gains["pid_i"]
+    device.parameters.pid_d = gains["pid_d"]
+    device.temperature_regulator.tunings = (
+        gains["pid_p"],
+        gains["pid_i"],
+        gains["pid_d"],
+    )
+
+
+def handle_weight_compensation_command(command):
+    calibration = device.weight_compensation_calibration
+    if command in (b"zero", b"span"):
+        if not calibration:
+            calibration = WeightCompensationCalibration()
+            device.weight_compensation_calibration = calibration
+        calibration.start_phase(
+            CALIBRATION_ZERO if command == b"zero" else CALIBRATION_SPAN
+        )
+        publish_weight_compensation_state()
+        send_status()
+    elif command == b"finish":
+        if not calibration:
+            send_status(400, "Weight compensation calibration is not started")
+            return
+
+        try:
+            compensation = calibration.finish()
+        except ValueError as e:
+            publish_weight_compensation_state()
+            send_status(400, str(e))
+            return
+
+        device.weight_compensation_calibration = None
+        device.parameters.weight_temperature_compensation = compensation
+        device.weight_sensor_compensated.compensation = compensation
+        send_status()
+    elif command == b"cancel":
+        device.weight_compensation_calibration = None
+        send_status()
+    else:
+        send_status(400, "Wrong weight compensation command")
+
+
+def handle_recipe_command(command):
+    recipe = device.recipe
+    if command == b"start":
+        if recipe.is_running:
+            send_status(400, "Recipe is already running")
+            return
+        if not recipe.steps:
+            send_status(400, "Recipe is empty")
+            return
+
+        # First ramp starts from the regulated temperature
+        current_temperature = get_pid_input_measurement()
+        if not current_temperature or not current_temperature.is_good:
+            send_status(400, "Temperature is not available")
+            return
+
+        recipe.start(current_temperature.value)
+        device.temperature_regulator.setpoint = recipe.setpoint
+        if device.parameters.mode != MODE_AUTO:
+            device.parameters.mode = MODE_AUTO
+        publish_recipe_state()
+        send_status()
+    elif command == b"stop":
+        if not recipe.is_running:
+            send_status(400, "Recipe is not running")
+            return
+        stop_recipe()
+        send_status()
+    else:
+        send_status(400, "Wrong recipe command")
+
+
+def stop_recipe():
+    """Stops recipe, regulator returns to bottom_temperature_sp."""
+    device.recipe.stop()
+    device.temperature_regulator.setpoint = device.parameters.bottom_temperature_sp
+    publish_recipe_state()
+
+
+def publish_recipe_state():
+    recipe_progress_scheduler.reset()
+    mqtt.publish(
+        make_mqtt_output_topic("/recipe"), ujson.dumps(device.recipe.to_dict())
     )
 
-    bottom_temperature_measurement = device.sensors_data.get(
-        device.bottom_temperature_sensor_calibrated.name
+
+def publish_weight_compensation_state():
+    if calibration := device.weight_compensation_calibration:
+        mqtt.publish(
+            make_mqtt_output_topic("/weight_compensation"),
+            ujson.dumps(calibration.to_dict()),
+        )
+
+
+def publish_autotune_state():
+    mqtt.publish(
+        make_mqtt_output_topic("/autotune"), ujson.dumps(autotuner.to_dict())
     )
 
-    if not bottom_temperature_measurement or bottom_temperature_measurement.is_bad:
-        disable_device()
-        send_status(500, "Device disabled! Bottom temperature sensor malfunction.")
-        return
 
-    if bottom_temperature_measurement.value >= parameters.bottom_temperature_ah:
-        disable_device()
-        send_status(500, "Device disabled! Bottom temperature above AH setpoint.")
-        return
+def read_sensors_data():
+    device.read_sensors_data()
 
-    if (
-        top_temperature_measurement
-        and top_temperature_measurement.is_good
-        and top_temperature_measurement.value >= parameters.top_temperature_ah
-    ):
+
+def publish_sensors_data():
+    sensors_data = ujson.dumps(
+        {k: v.to_dict() for k, v in network_sensors_data.items()}
+    )
+    if mqtt_connection.publish(make_mqtt_output_topic("/sensors"), sensors_data):
+        if _DIAGNOSTICS:
+            diagnostics.publish_done()
+    if _LAN_API:
+        lan_api.send_event("sensors", sensors_data)
+
+
+def publish_diagnostics():
+    mqtt_connection.publish(
+        make_mqtt_output_topic("/diagnostics"), diagnostics.to_json()
+    )
+    diagnostics.reset_window()
+
+
+def handle_safety():
+    tripped_rule = device.safety.evaluate(
+        device.sensors_data, device.parameters.mode != MODE_OFF
+    )
+    if tripped_rule:
         disable_device()
-        send_status(500, "Device disabled! Top temperature above AH setpoint.")
-        return
+        send_status(
+            500, f"Device disabled! {tripped_rule.message}", tripped_rule.reason
+        )
 
 
 def handle_sp():
-    if device.parameters.mode == MODE_OFF:
+    # Recipe has its own weight steps
+    if device.parameters.mode == MODE_OFF or device.recipe.is_running:
         return
 
     current_weight = device.sensors_data.get(device.wight_sensor_calibrated.name)
@@ -197,25 +588,89 @@ def handle_sp():
         send_status(500, "Device disabled! Weight sensor malfunction.")
         return
 
+    # Implausible weight, e.g. a knock on the tank, counting is held. Weight
+    # left uncompensated by failed top probe is uncertain too, but counted.
+    if device.weight_plausibility.is_suspicious:
+        return
+
     global weight_sp_count
     if current_weight.value > device.parameters.weight_sp:
         weight_sp_count = 0
     else:
         weight_sp_count += 1
 
-    if weight_sp_count >= 20:
+    # Fitted weight filters HX711 averaging steps and noise without counting delay
+    estimator = device.evaporation_estimator
+    if weight_sp_count >= 20 or (
+        estimator.is_ready and estimator.level <= device.parameters.weight_sp
+    ):
         weight_sp_count = 0
         disable_device()
         send_status(200, "Done! Weight setpoint reached.")
         return
 
 
+def handle_recipe():
+    recipe = device.recipe
+    if not recipe.is_running:
+        return
+
+    # Device disabled by user, safety rule or weight setpoint
+    if device.parameters.mode != MODE_AUTO:
+        stop_recipe()
+        return
+
+    temperature = get_pid_input_measurement()
+    weight = device.sensors_data.get(device.wight_sensor_calibrated.name)
+    estimator = device.evaporation_estimator
+    if estimator.is_ready:
+        weight_value = estimator.level
+    elif weight and not weight.is_bad and not device.weight_plausibility.is_suspicious:
+        weight_value = weight.value
+    else:
+        weight_value = None
+
+    changed = recipe.update(
+        temperature.value if temperature and temperature.is_good else None,
+        weight_value,
+    )
+    device.temperature_regulator.setpoint = recipe.setpoint
+
+    if recipe.state == RECIPE_DONE:
+        publish_recipe_state()
+        device.temperature_regulator.setpoint = device.parameters.bottom_temperature_sp
+        disable_device()
+        send_status(200, "Done! Recipe completed.")
+    elif changed or recipe_progress_scheduler.is_timeout():
+        publish_recipe_state()
+
+
+def handle_gain_schedule():
+    if device.parameters.mode != MODE_AUTO or not device.gain_schedule.is_enabled:
+        return
+
+    current_weight = device.sensors_data.get(device.wight_sensor_calibrated.name)
+    if not current_weight or not current_weight.is_good:
+        return
+
+    device.temperature_regulator.set_tunings_bumpless(
+        device.gain_schedule.gains(current_weight.value)
+    )
+
+
 def handle_off_mode():
     if device.parameters.mode != MODE_OFF:
         return
     disable_device()
 
 
+def get_pid_input_measurement():
+    """Regulated temperature, bottom probe or fused bulk temperature."""
+    if device.parameters.pid_input == PID_INPUT_BULK:
+        return device.sensors_data.get(device.bulk_temperature_sensor.name)
+    return device.sensors_data.get(device.bottom_temperature_sensor_calibrated.name)
+
+
 def handle_auto_mode():
     if device.parameters.mode != MODE_AUTO:
         if device.temperature_regulator.auto_mode:
@@ -232,21 +687,117 @@ def handle_auto_mode():
             True, last_output=current_power.value
         )
 
-    current_temperature = device.sensors_data.get(
-        device.bottom_temperature_sensor_calibrated.name
-    )
+    current_temperature = get_pid_input_measurement()
     if current_temperature.is_bad:
         disable_device()
-        send_status(500, "Device disabled! Bottom temperature sensor malfunction.")
+        send_status(
+            500,
+            f"Device disabled! {PID_INPUT_NAMES[device.parameters.pid_input]} malfunction.",
+        )
+        return
+
+    # Implausible temperature may be a real fast rise, heater is switched off
+    # until the value is confirmed or turns bad. Regulator is not updated.
+    if current_temperature.is_uncertain:
+        device.heater.set_power(0)
         return
 
+    # Ramp heater down ahead of weight setpoint, so the stop lands on it
+    output_limit = 100
+    lead_time = device.parameters.weight_sp_lead_time
+    if (
+        lead_time
+        and device.evaporation_estimator.is_ready
+        and not device.recipe.is_running
+    ):
+        seconds_left = device.evaporation_estimator.seconds_to(
+            device.parameters.weight_sp
+        )
+        if seconds_left is not None and seconds_left < lead_time:
+            output_limit = max(
+                WEIGHT_SP_RAMP_MIN_OUTPUT, 100 * seconds_left / lead_time
+            )
+    if device.temperature_regulator.output_limits[1] != output_limit:
+        device.temperature_regulator.output_limits = (0, output_limit)
+
     new_output = device.temperature_regulator(current_temperature.value)
     if new_output:
         device.heater.set_power(round(new_output))
 
 
+def handle_autotune_mode():
+    global autotuner
+    if device.parameters.mode != MODE_AUTOTUNE:
+        if autotuner and autotuner.state == AUTOTUNE_RUNNING:
+            autotuner = None
+        return
+
+    current_temperature = get_pid_input_measurement()
+    if not current_temperature or current_temperature.is_bad:
+        disable_device()
+        send_status(
+            500,
+            f"Device disabled! {PID_INPUT_NAMES[device.parameters.pid_input]} malfunction.",
+        )
+        return
+
+    if current_temperature.is_uncertain:
+        device.heater.set_power(0)
+        return
+
+    # Relay oscillates around setpoint, keep whole swing below alarm limit
+    ah_limit = device.parameters.bottom_temperature_ah - AUTOTUNE_HYSTERESIS
+
+    if not autotuner or autotuner.state != AUTOTUNE_RUNNING:
+        if device.parameters.bottom_temperature_sp + AUTOTUNE_HYSTERESIS >= ah_limit:
+            disable_device()
+            send_status(400, "Autotune setpoint is too close to AH setpoint.")
+            return
+        autotuner = RelayAutotuner(
+            device.parameters.bottom_temperature_sp, hysteresis=AUTOTUNE_HYSTERESIS
+        )
+        publish_autotune_state()
+
+    if current_temperature.value >= ah_limit:
+        autotuner = None
+        disable_device()
+        send_status(500, "Autotune aborted! Temperature is close to AH setpoint.")
+        return
+
+    completed_cycles = autotuner.completed_cycles
+    device.heater.set_power(autotuner.update(current_temperature.value))
+
+    if autotuner.state != AUTOTUNE_RUNNING:
+        publish_autotune_state()
+        disable_device()
+        if autotuner.state == AUTOTUNE_DONE:
+            send_status(200, "Autotune done! Confirm proposed gains.")
+        else:
+            send_status(500, f"Autotune failed! {autotuner.message}")
+    elif completed_cycles != autotuner.completed_cycles:
+        publish_autotune_state()
+
+
 def handle_remote_mode():
     if device.parameters.mode != MODE_REMOTE:
+        ping_sheduler.reset()
+        set_power_profile(None)
+        return
+
+    if power_profile:
+        new_power = power_profile.power(time.ticks_ms())
+        if new_power is None:
+            # Fail-safe, server did not send the next profile in time. Ping
+            # timeout counts from here.
+            set_power_profile(None)
+            device.heater.set_power(0)
+            ping_sheduler.reset()
+            send_status(500, "Heater power set to 0! Power profile expired.")
+            return
+
+        if new_power != device.heater.get_power():
+            device.heater.set_power(new_power)
+        # Profile has its own expiry, pings are not required while it runs
         ping_sheduler.reset()
         return
 
@@ -266,13 +817,110 @@ def disable_device():
         device.parameters.mode = MODE_OFF
 
 
-def reset_device_after_delay(delay_sec=60):
-    time.sleep(delay_sec)
-    machine.reset()
+def handle_mqtt_connected():
+    parameters.publish_parameters()
+
+
+def control_loop(read_sensors_data_scheduler):
+    """Dual core mode control thread: commands, sensors, alarms, regulators, output."""
+    first_loop = True
+    while True:
+        period_start_ticks = time.ticks_ms()
+        try:
+            for btopic, bmsg, received_ticks_us in commands.take_all():
+                mqtt_message_handler(btopic, bmsg, received_ticks_us)
+
+            # Commands are measured by handling time histogram
+            if _DIAGNOSTICS:
+                ticks = diagnostics.begin_iteration()
+
+            if read_sensors_data_scheduler.is_timeout() or first_loop:
+                read_sensors_data()
+                handle_sp()
+                handle_recipe()
+                handle_gain_schedule()
+                sensors_snapshot.store(device.sensors_data)
+                if _DIAGNOSTICS:
+                    ticks = diagnostics.stage_done(_STAGE_READ_SENSORS, ticks)
+
+                # Safety rules are evaluated once per new set of measurements
+                handle_safety()
+                if _DIAGNOSTICS:
+                    ticks = diagnostics.stage_done(_STAGE_SAFETY, ticks)
+
+            first_loop = False
+
+            handle_auto_mode()
+            handle_autotune_mode()
+            handle_remote_mode()
+            handle_off_mode()
+            if _DIAGNOSTICS:
+                ticks = diagnostics.stage_done(_STAGE_MODES, ticks)
+
+            handle_output()
+            if _DIAGNOSTICS:
+                diagnostics.stage_done(_STAGE_OUTPUT, ticks)
+
+            if _WATCHDOG:
+                watchdog.feed()
+                if _DIAGNOSTICS:
+                    diagnostics.watchdog_fed()
+
+            if _MEMORY_MANAGEMENT:
+                memory.collect_if_idle(device.heater.ms_until_next_edge())
+
+        except Exception as e:
+            if __debug__:
+                print(f"Error during control loop operations: {e}")
+
+        # Sleeping releases the interpreter lock for network thread
+        spent_ms = time.ticks_diff(time.ticks_ms(), period_start_ticks)
+        if spent_ms < _CONTROL_PERIOD_MS:
+            time.sleep_ms(_CONTROL_PERIOD_MS - spent_ms)
+
+
+def network_loop(publish_sensors_data_scheduler, publish_diagnostics_scheduler):
+    """Dual core mode network thread: MQTT, publishing and LAN API."""
+    snapshot_version = 0
+    while True:
+        try:
+            ticks = time.ticks_us()
+            mqtt_connection.poll()
+            mqtt.flush()
+            if _DIAGNOSTICS:
+                ticks = diagnostics.stage_done(_STAGE_MQTT, ticks)
+
+            if sensors_snapshot.version != snapshot_version:
+                snapshot_version = sensors_snapshot.load(network_sensors_data)
+
+            # Nothing to publish until control thread read sensors once
+            if snapshot_version and publish_sensors_data_scheduler.is_timeout():
+                publish_sensors_data()
+                publish_weight_compensation_state()
+                mqtt.flush()
+                if _DIAGNOSTICS:
+                    ticks = diagnostics.stage_done(_STAGE_PUBLISH_SENSORS, ticks)
+
+            if _LAN_API:
+                lan_api.poll()
+                if _DIAGNOSTICS:
+                    diagnostics.stage_done(_STAGE_LAN_API, ticks)
+
+            if _DIAGNOSTICS:
+                if publish_diagnostics_scheduler.is_timeout():
+                    publish_diagnostics()
+
+        except Exception as e:
+            if __debug__:
+                print(f"Error during network loop operations: {e}")
+
+        time.sleep_ms(_NETWORK_IDLE_MS)
 
 
 def main():
-    global mqtt_client_id, parameters, mqtt_client, device
+    global mqtt_client_id, parameters, mqtt_client, mqtt, device, diagnostics, watchdog
+    global lan_api, mqtt_connection, commands, sensors_snapshot, network_sensors_data
+    global parameters_topic_regex
 
     freq(160000000)
 
@@ -288,59 +936,138 @@ def main():
         settings.mqtt_port,
         settings.mqtt_user,
         settings.mqtt_password,
+        keepalive=60,
     )
-    mqtt_client.set_callback(mqtt_message_handler)
+    parameters_topic_regex = re.compile(make_mqtt_input_topic("/parameters/(.+)"))
+
+    mqtt_connection = MQTTConnectionManager(mqtt_client, clean_session=False)
+    mqtt_connection.subscribe(make_mqtt_input_topic("/#"))
+    if _DUAL_CORE:
+        commands = MessageQueue(_COMMAND_QUEUE_SIZE)
+        sensors_snapshot = SensorsSnapshot()
+        mqtt = Outbox(mqtt_connection, _OUTBOX_SIZE)
+        mqtt_client.set_callback(queue_command)
+    else:
+        mqtt = mqtt_connection
+        mqtt_client.set_callback(mqtt_message_handler)
 
-    try:
-        mqtt_client.connect(clean_session=False)
-        if __debug__:
-            print(f"Connected to MQTT broker at '{mqtt_host}'")
-        mqtt_client.subscribe(make_mqtt_input_topic("/#"))
+    parameters = ParameterManager(mqtt, make_mqtt_output_topic("/parameters"))
 
-    except Exception as e:
-        if __debug__:
-            print(f"Error connecting to MQTT broker: {e}")
-        disable_device()
-        reset_device_after_delay()
+    device = Device(parameters, wifi_manager)
+    network_sensors_data = {} if _DUAL_CORE else device.sensors_data
 
-    parameters = ParameterManager(mqtt_client, make_mqtt_output_topic("/parameters"))
+    if _LAN_API:
+        lan_api = LanApi(network_sensors_data, parameters)
+        lan_api.start()
 
-    device = Device(parameters, wifi_manager)
+    mqtt_connection.on_connect = handle_mqtt_connected
 
     read_sensors_data_scheduler = scheduler.Scheduler(1000)
     publish_sensors_data_scheduler = scheduler.Scheduler(5000)
+    publish_diagnostics_scheduler = None
+
+    if _DIAGNOSTICS:
+        publish_diagnostics_scheduler = scheduler.Scheduler(10000)
+        diagnostics = Diagnostics(
+            [
+                "mqtt",
+                "read_sensors",
+                "publish_sensors",
+                "safety",
+                "modes",
+                "output",
+                "lan_api",
+            ],
+            [
+                ("read_sensors", read_sensors_data_scheduler),
+                ("publish_sensors", publish_sensors_data_scheduler),
+            ],
+            mqtt_connection,
+            memory,
+            _WATCHDOG_TIMEOUT_MS if _WATCHDOG else 0,
+            wifi_manager,
+            ([("commands", commands), ("outbox", mqtt.queue)] if _DUAL_CORE else []),
+        )
+
+    if _MEMORY_MANAGEMENT:
+        memory.configure()
+
+    if _WATCHDOG:
+        watchdog = WDT(timeout=_WATCHDOG_TIMEOUT_MS)
+
+    if _DUAL_CORE:
+        _thread.stack_size(_NETWORK_STACK_SIZE)
+        _thread.start_new_thread(
+            network_loop,
+            (publish_sensors_data_scheduler, publish_diagnostics_scheduler),
+        )
+        control_loop(read_sensors_data_scheduler)
 
     first_loop = True
     while True:
         try:
-            mqtt_client.check_msg()
+            if _DIAGNOSTICS:
+                ticks = diagnostics.begin_iteration()
+
+            mqtt_connection.poll()
+            if _DIAGNOSTICS:
+                ticks = diagnostics.stage_done(_STAGE_MQTT, ticks)
 
             if read_sensors_data_scheduler.is_timeout() or first_loop:
                 read_sensors_data()
                 handle_sp()
+                handle_recipe()
+                handle_gain_schedule()
+                if _DIAGNOSTICS:
+                    ticks = diagnostics.stage_done(_STAGE_READ_SENSORS, ticks)
+
+                # Safety rules are evaluated once per new set of measurements
+                handle_safety()
+                if _DIAGNOSTICS:
+                    ticks = diagnostics.stage_done(_STAGE_SAFETY, ticks)
 
             if publish_sensors_data_scheduler.is_timeout() or first_loop:
                 publish_sensors_data()
+                publish_weight_compensation_state()
+                if _DIAGNOSTICS:
+                    ticks = diagnostics.stage_done(_STAGE_PUBLISH_SENSORS, ticks)
 
             first_loop = False
 
-            handle_ah()
             handle_auto_mode()
+            handle_autotune_mode()
             handle_remote_mode()
             handle_off_mode()
+            if _DIAGNOSTICS:
+                ticks = diagnostics.stage_done(_STAGE_MODES, ticks)
+
             handle_output()
+            if _DIAGNOSTICS:
+                ticks = diagnostics.stage_done(_STAGE_OUTPUT, ticks)
+
+            # Control stages completed, loop is alive. Fed before LAN API, so
+            # failing HTTP requests can not reset healthy control.
+            if _WATCHDOG:
+                watchdog.feed()
+                if _DIAGNOSTICS:
+                    diagnostics.watchdog_fed()
+
+            if _LAN_API:
+                lan_api.poll()
+                if _DIAGNOSTICS:
+                    diagnostics.stage_done(_STAGE_LAN_API, ticks)
+
+            if _DIAGNOSTICS:
+                if publish_diagnostics_scheduler.is_timeout():
+                    publish_diagnostics()
+
+            # Heater pulse edges are the only timing critical events left
+            if _MEMORY_MANAGEMENT:
+                memory.collect_if_idle(device.heater.ms_until_next_edge())
 
         except Exception as e:
             if __debug__:
                 print(f"Error during main loop operations: {e}")
-            time.sleep(2)
-            try:
-                mqtt_client.reconnect()
-            except Exception as reconnect_e:
-                if __debug__:
-                    print(f"Failed to reconnect: {reconnect_e}")
-                disable_device()
-                reset_device_after_delay()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+import gc
+import time
+
+
+# Largest probed allocation, bytes. Probing the whole free memory would leave
+# heap sized garbage and on split heap ports could grow the heap.
+LARGEST_BLOCK_PROBE = 16384
+
+
+def largest_free_block():
+    """
+    Size of the largest block which can be allocated up to
+    LARGEST_BLOCK_PROBE, bytes.
+
+    Allocations are probed from the limit down in halves with GC disabled,
+    so failed probes do not trigger a collection and only the first
+    successful probe leaves garbage behind. Failed probes happen only when
+    the heap is fragmented below the limit.
+    """
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    size = min(gc.mem_free(), LARGEST_BLOCK_PROBE)
+    try:
+        while size > 64:
+            try:
+                bytearray(size)
+                return size
+            except MemoryError:
+                size >>= 1
+        return 0
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+class MemoryManager:
+    """
+    Moves garbage collection out of timing critical code.
+
+    Collections are done explicitly from `collect_if_idle()` when enough
+    garbage was produced and caller has an idle window long enough for the
+    pause. Automatic collection threshold is raised so that it only works as
+    a safety net.
+    """
+
+    def __init__(self, collect_fraction=8, threshold_fraction=2, min_idle_ms=10):
+        self.collect_fraction = collect_fraction
+        self.threshold_fraction = threshold_fraction
+        self.min_idle_ms = min_idle_ms
+
+        self.scheduled_collections = 0
+        self.automatic_collections = 0
+        self.last_pause_us = 0
+        self.max_pause_us = 0
+
+        self._collect_bytes = 0
+        self._last_mem_alloc = gc.mem_alloc()
+        self._collected_mem_alloc = self._last_mem_alloc
+
+    def configure(self):
+        """Compacts boot time allocations and tunes GC threshold."""
+        self.collect()
+        free = gc.mem_free()
+        self._collect_bytes = free // self.collect_fraction
+        gc.threshold(free // self.threshold_fraction)
+
+    def check_automatic_collection(self):
+        # Automatic collections are not reported by the runtime, but every
+        # collection shows up as a drop of allocated memory.
+        mem_alloc = gc.mem_alloc()
+        if mem_alloc < self._last_mem_alloc:
+            self.automatic_collections += 1
+            self._collected_mem_alloc = mem_alloc
+        self._last_mem_alloc = mem_alloc
+
+    def collect(self):
+        start_ticks = time.ticks_us()
+        gc.collect()
+        pause_us = time.ticks_diff(time.ticks_us(), start_ticks)
+
+        self.scheduled_collections += 1
+        self.last_pause_us = pause_us
+        if pause_us > self.max_pause_us:
+            self.max_pause_us = pause_us
+        self._last_mem_alloc = gc.mem_alloc()
+        self._collected_mem_alloc = self._last_mem_alloc
+
+    def collect_if_idle(self, idle_ms: int):
+        self.check_automatic_collection()
+        if gc.mem_alloc() - self._collected_mem_alloc < self._collect_bytes:
+            return False
+
+        # Expected pause is twice the worst pause seen so far
+        if idle_ms < max(self.min_idle_ms, self.max_pause_us // 500):
+            return False
+
+        self.collect()
+        return True
+
+    def to_dict(self):
+        free = gc.mem_free()
+        largest_block = largest_free_block()
+        probed = min(free, LARGEST_BLOCK_PROBE)
+
+        return {
+            "collections": self.scheduled_collections + self.automatic_collections,
+            "scheduled_collections": self.scheduled_collections,
+            "automatic_collections": self.automatic_collections,
+            "last_pause_us": self.last_pause_us,
+            "max_pause_us": self.max_pause_us,
+            "free": free,
+            "largest_free_block": largest_block,
+            "fragmentation": 1 - largest_block / probed if probed else 0,
+        }
@@ -0,0 +1,283 @@
+import errno
+import random
+import select
+import socket
+import time
+
+from umqtt.simple import MQTTClient, MQTTException
+
+STATE_DISCONNECTED = 0
+STATE_CONNECTING = 1
+STATE_HANDSHAKE = 2
+STATE_CONNECTED = 3
+
+SOCKET_TIMEOUT_SEC = 2
+
+
+class MQTTConnectionManager:
+    """
+    Keeps MQTT connection alive without blocking the caller.
+
+    Connection is established step by step from `poll()`, every step takes a
+    bounded amount of time, so control loop keeps running while broker is
+    unreachable. Failed attempts are retried with exponential backoff.
+
+    Broker address is resolved once and reused by all later attempts. DNS
+    lookup blocks, so after a failed lookup the next one is done only after
+    `max_backoff_ms`. Connected socket operations time out after
+    `SOCKET_TIMEOUT_SEC`, connection is dropped when broker does not answer
+    a ping within `ping_timeout_ms`, so half-open connection is detected.
+    """
+
+    def __init__(
+        self,
+        client: MQTTClient,
+        clean_session=False,
+        min_backoff_ms=1000,
+        max_backoff_ms=60000,
+        connect_timeout_ms=5000,
+        ping_timeout_ms=10000,
+    ):
+        self.client = client
+        self.clean_session = clean_session
+        self.min_backoff_ms = min_backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        self.connect_timeout_ms = connect_timeout_ms
+        self.ping_timeout_ms = ping_timeout_ms
+        self.on_connect = None
+
+        self.state = STATE_DISCONNECTED
+        self.connect_attempts = 0
+        self.connections = 0
+        self.disconnects = 0
+
+        self._address = None
+        self._socket = None
+        self._poller = None
+        self._connack = b""
+        self._ping_ticks = None
+        self._subscriptions = []
+        self._backoff_ms = min_backoff_ms
+        self._next_attempt_ticks = time.ticks_ms()
+        self._state_ticks = self._next_attempt_ticks
+        self._last_activity_ticks = self._next_attempt_ticks
+
+    @property
+    def is_connected(self):
+        return self.state == STATE_CONNECTED
+
+    def subscribe(self, topic):
+        if topic not in self._subscriptions:
+            self._subscriptions.append(topic)
+
+        if self.is_connected:
+            try:
+                self.client.subscribe(topic)
+            except Exception as e:
+                self._handle_error(e)
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        if not self.is_connected:
+            return False
+
+        try:
+            self.client.publish(topic, msg, retain, qos)
+            self._last_activity_ticks = time.ticks_ms()
+            return True
+        except Exception as e:
+            self._handle_error(e)
+            return False
+
+    def poll(self):
+        if self.state == STATE_CONNECTED:
+            self._handle_connected()
+        elif self.state == STATE_DISCONNECTED:
+            if time.ticks_diff(time.ticks_ms(), self._next_attempt_ticks) >= 0:
+                self._start_connecting()
+        elif self._is_attempt_timed_out():
+            self._handle_error(OSError(errno.ETIMEDOUT))
+        elif self.state == STATE_CONNECTING:
+            self._handle_connecting()
+        elif self.state == STATE_HANDSHAKE:
+            self._handle_handshake()
+
+    def _handle_connected(self):
+        try:
+            if self._poller.poll(0):
+                # PINGRESP or any other packet shows broker is alive
+                self._ping_ticks = None
+                self.client.check_msg()
+                # check_msg() leaves socket blocking without timeout
+                self.client.sock.settimeout(SOCKET_TIMEOUT_SEC)
+
+            current_ticks = time.ticks_ms()
+            if self._ping_ticks is not None:
+                if time.ticks_diff(current_ticks, self._ping_ticks) >= (
+                    self.ping_timeout_ms
+                ):
+                    raise OSError(errno.ETIMEDOUT)
+                return
+
+            keepalive_ms = self.client.keepalive * 500
+            if keepalive_ms and (
+                time.ticks_diff(current_ticks, self._last_activity_ticks)
+                >= keepalive_ms
+            ):
+                self.client.ping()
+                self._ping_ticks = self._last_activity_ticks = time.ticks_ms()
+        except Exception as e:
+            self._handle_error(e)
+
+    def _start_connecting(self):
+        self.connect_attempts += 1
+        self._state_ticks = time.ticks_ms()
+
+        if not self._address:
+            try:
+                self._address = socket.getaddrinfo(
+                    self.client.server, self.client.port
+                )[0][-1]
+            except Exception as e:
+                self._backoff_ms = self.max_backoff_ms
+                self._handle_error(e)
+                return
+
+        try:
+            self._socket = socket.socket()
+            self._socket.setblocking(False)
+            try:
+                self._socket.connect(self._address)
+            except OSError as e:
+                if e.errno != errno.EINPROGRESS:
+                    raise
+
+            self._poller = select.poll()
+            self._poller.register(self._socket, select.POLLOUT)
+            self.state = STATE_CONNECTING
+        except Exception as e:
+            self._handle_error(e)
+
+    def _handle_connecting(self):
+        events = self._poller.poll(0)
+        if not events:
+            return
+
+        try:
+            if events[0][1] & (select.POLLERR | select.POLLHUP):
+                raise OSError(errno.ECONNREFUSED)
+
+            self._socket.write(self._make_connect_packet())
+            self._poller.modify(self._socket, select.POLLIN)
+            self._connack = b""
+            self.state = STATE_HANDSHAKE
+        except Exception as e:
+            self._handle_error(e)
+
+    def _handle_handshake(self):
+        events = self._poller.poll(0)
+        if not events:
+            return
+
+        try:
+            if events[0][1] & (select.POLLERR | select.POLLHUP):
+                raise OSError(errno.ECONNRESET)
+
+            # Non-blocking read may return only a part of CONNACK
+            data = self._socket.read(4 - len(self._connack))
+            if data is None:
+                return
+            if not data:
+                raise OSError(errno.ECONNRESET)
+            self._connack += data
+            if len(self._connack) < 4:
+                return
+
+            response = self._connack
+            if response[0] != 0x20 or response[1] != 0x02:
+                raise MQTTException("Unexpected CONNACK")
+            if response[3] != 0:
+                raise MQTTException(response[3])
+
+            self._socket.settimeout(SOCKET_TIMEOUT_SEC)
+            self.client.sock = self._socket
+            self._socket = None
+            self._ping_ticks = None
+            self.state = STATE_CONNECTED
+            self.connections += 1
+            self._backoff_ms = self.min_backoff_ms
+            self._last_activity_ticks = time.ticks_ms()
+
+            if __debug__:
+                print(f"Connected to MQTT broker at '{self.client.server}'")
+
+            for topic in self._subscriptions:
+                self.client.subscribe(topic)
+
+            if self.on_connect:
+                self.on_connect()
+        except Exception as e:
+            self._handle_error(e)
+
+    def _make_connect_packet(self):
+        # Same layout as umqtt.simple.MQTTClient.connect() (MQTT 3.1.1)
+        client = self.client
+        fields = [client.client_id]
+        flags = self.clean_session << 1
+        if client.user:
+            fields += [client.user, client.pswd]
+            flags |= 0xC0
+
+        payload = bytearray()
+        for field in fields:
+            if isinstance(field, str):
+                field = field.encode()
+            payload += len(field).to_bytes(2, "big")
+            payload += field
+
+        variable_header = bytearray(b"\x00\x04MQTT\x04")
+        variable_header.append(flags)
+        variable_header += client.keepalive.to_bytes(2, "big")
+
+        size = len(variable_header) + len(payload)
+        packet = bytearray(b"\x10")
+        while size > 0x7F:
+            packet.append((size & 0x7F) | 0x80)
+            size >>= 7
+        packet.append(size)
+        return packet + variable_header + payload
+
+    def _is_attempt_timed_out(self):
+        return (
+            time.ticks_diff(time.ticks_ms(), self._state_ticks)
+            >= self.connect_timeout_ms
+        )
+
+    def _close_socket(self, sock):
+        if sock:
+            try:
+                sock.close()
+            except Exception:
+                pass
+
+    def _handle_error(self, error):
+        if __debug__:
+            print(f"MQTT connection error: {error}")
+
+        if self.state == STATE_CONNECTED:
+            self.disconnects += 1
+            self._close_socket(self.client.sock)
+            self.client.sock = None
+
+        self._close_socket(self._socket)
+        self._socket = None
+        self._poller = None
+        self.state = STATE_DISCONNECTED
+
+        delay_ms = self._backoff_ms + random.getrandbits(16) % (
+            self._backoff_ms // 4 + 1
+        )
+        self._next_attempt_ticks = time.ticks_add(time.ticks_ms(), delay_ms)
+        self._backoff_ms = min(self._backoff_ms * 2, self.max_backoff_ms)
+
+        if __debug__:
+            print(f"Next MQTT connection attempt in {delay_ms} ms")
@@ -1,9 +1,16 @@
 import ujson
+from gain_schedule import GainSchedulePoint
 from sensors import CalibrationPoint
+from fusion import TemperatureFusionSettings
+from weight_compensation import WeightCompensation
 
 MODE_OFF = 0
 MODE_AUTO = 1
 MODE_REMOTE = 2
+MODE_AUTOTUNE = 3
+
+PID_INPUT_BOTTOM = 0
+PID_INPUT_BULK = 1
 
 STATE_JSON_FILE_NAME = "params.json"
 
@@ -18,12 +25,18 @@ class ParameterManager:
         self._pid_p = 1
         self._pid_i = 10
         self._pid_d = 0
+        self._pid_gain_schedule = []
+        # Regulated temperature, bottom probe or fused bulk temperature
+        self._pid_input = PID_INPUT_BOTTOM
         self._output_max_power = 70
         self._output_pwm_interval_ms = 1000
+        # Heater rated power for energy metering, watts, 0 - not metered
+        self._heater_rated_power = 0
         self._top_temperature_ah = 80
         self._bottom_temperature_ah = 90
         self._bottom_temperature_sp = 70
         self._weight_sp = 5000
+        self._weight_sp_lead_time = 0
 
         self._weight_calibration_points = [
             CalibrationPoint(0, 0),
@@ -40,8 +53,23 @@ class ParameterManager:
             CalibrationPoint(1, 1),
         ]
 
+        self._weight_temperature_compensation = WeightCompensation()
+        self._temperature_fusion = TemperatureFusionSettings()
+
+        # 0 - piecewise-linear, otherwise least squares polynomial degree
+        self._weight_calibration_degree = 0
+        self._bottom_temperature_calibration_degree = 0
+        self._top_temperature_calibration_degree = 0
+
+        # Configurable safety rules, list of dicts, see safety.make_rules()
+        self._safety_rules = []
+
+        # Temperature program for automatic mode, compact list of steps, see
+        # recipe.make_steps()
+        self._recipe = []
+
         self._load_parameters_from_file()
-        self._publish_parameters()
+        self.publish_parameters()
 
     def _load_calibration_points_from_dict(self, target_dict, key):
         if points_from_file := target_dict.get(key):
@@ -50,6 +78,10 @@ class ParameterManager:
     def _serialize_calibration_points_to_dict(self, points):
         return [p.to_dict() for p in points]
 
+    def _load_gain_schedule_from_dict(self, target_dict, key):
+        if points_from_file := target_dict.get(key):
+            return [GainSchedulePoint(**p) for p in points_from_file]
+
     def _load_from_json(self, json_string):
         state_dict = ujson.loads(json_string)
         self._mode = state_dict.get("mode", self._mode)
@@ -59,6 +91,9 @@ class ParameterManager:
         self._output_pwm_interval_ms = state_dict.get(
             "output_pwm_interval_ms", self._output_pwm_interval_ms
         )
+        self._heater_rated_power = state_dict.get(
+            "heater_rated_power", self._heater_rated_power
+        )
         self._bottom_temperature_ah = state_dict.get(
             "bottom_temperature_ah", self._bottom_temperature_ah
         )
@@ -69,9 +104,18 @@ class ParameterManager:
             "top_temperature_ah", self._top_temperature_ah
         )
         self._weight_sp = state_dict.get("weight_sp", self._weight_sp)
+        self._weight_sp_lead_time = state_dict.get(
+            "weight_sp_lead_time", self._weight_sp_lead_time
+        )
         self._pid_p = state_dict.get("pid_p", self._pid_p)
         self._pid_i = state_dict.get("pid_i", self._pid_i)
         self._pid_d = state_dict.get("pid_d", self._pid_d)
+        self._pid_input = state_dict.get("pid_input", self._pid_input)
+
+        if points := self._load_gain_schedule_from_dict(
+            state_dict, "pid_gain_schedule"
+        ):
+            self._pid_gain_schedule = points
 
         if cp := self._load_calibration_points_from_dict(
             state_dict, "weight_calibration_points"
@@ -88,19 +132,58 @@ class ParameterManager:
         ):
             self._top_temperature_calibration_points = cp
 
-    def _serialize_to_json(self):
+        if compensation := state_dict.get("weight_temperature_compensation"):
+            try:
+                self._weight_temperature_compensation = WeightCompensation(
+                    **compensation
+                )
+            except ValueError:
+                # Stored by older firmware without span drift check, other
+                # parameters are still loaded
+                pass
+
+        if fusion := state_dict.get("temperature_fusion"):
+            self._temperature_fusion = TemperatureFusionSettings(**fusion)
+
+        self._weight_calibration_degree = state_dict.get(
+            "weight_calibration_degree", self._weight_calibration_degree
+        )
+        self._bottom_temperature_calibration_degree = state_dict.get(
+            "bottom_temperature_calibration_degree",
+            self._bottom_temperature_calibration_degree,
+        )
+        self._top_temperature_calibration_degree = state_dict.get(
+            "top_temperature_calibration_degree",
+            self._top_temperature_calibration_degree,
+        )
+        self._safety_rules = state_dict.get("safety_rules", self._safety_rules)
+        self._recipe = state_dict.get("recipe", self._recipe)
+
+        # Degree stored by older firmware may be out of range, sensors could
+        # not be built with it
+        for sensor_name in ("weight", "bottom_temperature", "top_temperature"):
+            points = getattr(self, f"_{sensor_name}_calibration_points")
+            degree = getattr(self, f"_{sensor_name}_calibration_degree")
+            if not 0 <= degree < len(points):
+                setattr(self, f"_{sensor_name}_calibration_degree", 0)
+
+    def to_json(self):
         return ujson.dumps(
             {
                 "mode": self._mode,
                 "output_max_power": self._output_max_power,
                 "output_pwm_interval_ms": self._output_pwm_interval_ms,
+                "heater_rated_power": self._heater_rated_power,
                 "bottom_temperature_ah": self._bottom_temperature_ah,
                 "bottom_temperature_sp": self._bottom_temperature_sp,
                 "top_temperature_ah": self._top_temperature_ah,
                 "weight_sp": self._weight_sp,
+                "weight_sp_lead_time": self._weight_sp_lead_time,
                 "pid_p": self._pid_p,
                 "pid_i": self._pid_i,
                 "pid_d": self._pid_d,
+                "pid_gain_schedule": [p.to_dict() for p in self._pid_gain_schedule],
+                "pid_input": self._pid_input,
                 "weight_calibration_points": self._serialize_calibration_points_to_dict(
                     self._weight_calibration_points
                 ),
@@ -110,12 +193,19 @@ class ParameterManager:
                 "top_temperature_calibration_points": self._serialize_calibration_points_to_dict(
                     self._top_temperature_calibration_points
                 ),
+                "weight_calibration_degree": self._weight_calibration_degree,
+                "weight_temperature_compensation": self._weight_temperature_compensation.to_dict(),
+                "temperature_fusion": self._temperature_fusion.to_dict(),
+                "bottom_temperature_calibration_degree": self._bottom_temperature_calibration_degree,
+                "top_temperature_calibration_degree": self._top_temperature_calibration_degree,
+                "safety_rules": self._safety_rules,
+                "recipe": self._recipe,
             }
         )
 
     def _save_parameters_to_file(self):
         with open(STATE_JSON_FILE_NAME, "w") as f:
-            f.write(self._serialize_to_json())
+            f.write(self.to_json())
 
     def _load_parameters_from_file(self):
         try:
@@ -124,10 +214,10 @@ class ParameterManager:
         except Exception as e:
             self._save_parameters_to_file()
 
-    def _publish_parameters(self):
+    def publish_parameters(self):
         try:
             self.mqtt_client.publish(
-                self.topic, self._serialize_to_json(), retain=True
+                self.topic, self.to_json(), retain=True
             )
         except Exception as e:
             pass
@@ -138,11 +228,11 @@ class ParameterManager:
 
     @mode.setter
     def mode(self, new_value):
-        if new_value not in [MODE_OFF, MODE_AUTO, MODE_REMOTE]:
+        if new_value not in [MODE_OFF, MODE_AUTO, MODE_REMOTE, MODE_AUTOTUNE]:
             raise ValueError("Wrong mode value")
         self._mode = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
 
     @property
     def weight_calibration_points(self):
@@ -152,7 +242,7 @@ class ParameterManager:
     def weight_calibration_points(self, new_value):
         self._weight_calibration_points = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
 
     @property
     def bottom_temperature_calibration_points(self):
@@ -162,7 +252,7 @@ class ParameterManager:
     def bottom_temperature_calibration_points(self, new_value):
         self._bottom_temperature_calibration_points = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
 
     @property
     def top_temperature_calibration_points(self):
@@ -172,7 +262,77 @@ class ParameterManager:
     def top_temperature_calibration_points(self, new_value):
         self._top_temperature_calibration_points = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
+
+    @property
+    def weight_temperature_compensation(self):
+        return self._weight_temperature_compensation
+
+    @weight_temperature_compensation.setter
+    def weight_temperature_compensation(self, new_value):
+        self._weight_temperature_compensation = new_value
+        self._save_parameters_to_file()
+        self.publish_parameters()
+
+    @property
+    def temperature_fusion(self):
+        return self._temperature_fusion
+
+    @temperature_fusion.setter
+    def temperature_fusion(self, new_value):
+        self._temperature_fusion = new_value
+        self._save_parameters_to_file()
+        self.publish_parameters()
+
+    @property
+    def safety_rules(self):
+        return self._safety_rules
+
+    @safety_rules.setter
+    def safety_rules(self, new_value):
+        self._safety_rules = new_value
+        self._save_parameters_to_file()
+        self.publish_parameters()
+
+    @property
+    def recipe(self):
+        return self._recipe
+
+    @recipe.setter
+    def recipe(self, new_value):
+        self._recipe = new_value
+        self._save_parameters_to_file()
+        self.publish_parameters()
+
+    @property
+    def weight_calibration_degree(self):
+        return self._weight_calibration_degree
+
+    @weight_calibration_degree.setter
+    def weight_calibration_degree(self, new_value):
+        self._weight_calibration_degree = new_value
+        self._save_parameters_to_file()
+        self.publish_parameters()
+
+    @property
+    def bottom_temperature_calibration_degree(self):
+        return self._bottom_temperature_calibration_degree
+
+    @bottom_temperature_calibration_degree.setter
+    def bottom_temperature_calibration_degree(self, new_value):
+        self._bottom_temperature_calibration_degree = new_value
+        self._save_parameters_to_file()
+        self.publish_parameters()
+
+    @property
+    def top_temperature_calibration_degree(self):
+        return self._top_temperature_calibration_degree
+
+    @top_temperature_calibration_degree.setter
+    def top_temperature_calibration_degree(self, new_value):
+        self._top_temperature_calibration_degree = new_value
+        self._save_parameters_to_file()
+        self.publish_parameters()
 
     @property
     def output_max_power(self):
@@ -185,7 +345,7 @@ class ParameterManager:
 
         self._output_max_power = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
 
     @property
     def output_pwm_interval_ms(self):
@@ -198,7 +358,20 @@ class ParameterManager:
 
         self._output_pwm_interval_ms = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
+
+    @property
+    def heater_rated_power(self):
+        return self._heater_rated_power
+
+    @heater_rated_power.setter
+    def heater_rated_power(self, new_value):
+        if new_value < 0:
+            raise ValueError("Heater rated power should not be negative")
+
+        self._heater_rated_power = new_value
+        self._save_parameters_to_file()
+        self.publish_parameters()
 
     @property
     def bottom_temperature_ah(self):
@@ -208,7 +381,7 @@ class ParameterManager:
     def bottom_temperature_ah(self, new_value):
         self._bottom_temperature_ah = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
 
     @property
     def bottom_temperature_sp(self):
@@ -218,7 +391,7 @@ class ParameterManager:
     def bottom_temperature_sp(self, new_value):
         self._bottom_temperature_sp = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
 
     @property
     def top_temperature_ah(self):
@@ -228,7 +401,7 @@ class ParameterManager:
     def top_temperature_ah(self, new_value):
         self._top_temperature_ah = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
 
     @property
     def weight_sp(self):
@@ -238,7 +411,20 @@ class ParameterManager:
     def weight_sp(self, new_value):
         self._weight_sp = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
+
+    @property
+    def weight_sp_lead_time(self):
+        return self._weight_sp_lead_time
+
+    @weight_sp_lead_time.setter
+    def weight_sp_lead_time(self, new_value):
+        if new_value < 0:
+            raise ValueError("Weight setpoint lead time should be positive")
+
+        self._weight_sp_lead_time = new_value
+        self._save_parameters_to_file()
+        self.publish_parameters()
 
     @property
     def pid_i(self):
@@ -248,7 +434,7 @@ class ParameterManager:
     def pid_i(self, new_value):
         self._pid_i = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
 
     @property
     def pid_p(self):
@@ -258,7 +444,7 @@ class ParameterManager:
     def pid_p(self, new_value):
         self._pid_p = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
 
     @property
     def pid_d(self):
@@ -268,4 +454,24 @@ class ParameterManager:
     def pid_d(self, new_value):
         self._pid_d = new_value
         self._save_parameters_to_file()
-        self._publish_parameters()
+        self.publish_parameters()
+
+    @property
+    def pid_input(self):
+        return self._pid_input
+
+    @pid_input.setter
+    def pid_input(self, new_value):
+        self._pid_input = new_value
+        self._save_parameters_to_file()
+        self.publish_parameters()
+
+    @property
+    def pid_gain_schedule(self):
+        return self._pid_gain_schedule
+
+    @pid_gain_schedule.setter
+    def pid_gain_schedule(self, new_value):
+        self._pid_gain_schedule = new_value
+        self._save_parameters_to_file()
+        self.publish_parameters()
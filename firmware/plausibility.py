@@ -0,0 +1,175 @@
+from sensors import QUALITY_BAD, QUALITY_UNCERTAIN, Measurement
+
+
+class RunningStatistics:
+    """
+    Welford's online mean and variance. Sample count is capped at `window`,
+    after that old samples are forgotten exponentially, so statistics follow
+    slowly changing signals.
+    """
+
+    def __init__(self, window=60):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0
+        self._m2 = 0
+
+    def add(self, value: float):
+        if self.count < self.window:
+            self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if self.count == self.window:
+            # Keep m2 consistent with the capped count
+            self._m2 *= (self.window - 1) / self.window
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else 0
+
+    @property
+    def std(self):
+        return self.variance**0.5
+
+
+class PlausibilityFilter:
+    """
+    Streaming fault detection for measurements of one sensor.
+
+    Good measurements are checked against the last accepted value:
+
+    - spikes larger than `max_step` and steps with z-score above `z_limit`
+      make measurement uncertain. Known bad values (e.g. DS18B20 power-on
+      85 °C) are only suspicious before the first accepted value, later they
+      are checked like any other value, so a real level at 85 °C is
+      accepted, while jump to it is not. Step statistics are sample to sample changes,
+      they stay stationary while the value ramps. `min_std` is the floor of
+      step standard deviation, resolution of quantized sensors;
+    - uncertain run of `settle_samples` values agreeing within the z-score
+      band is accepted as a new level (e.g. product added), run of values
+      with steps agreeing within the band is accepted as a new trend (e.g.
+      real fast heating);
+    - `bad_after` uncertain values without `settle_samples` good values in
+      a row in between and value exactly repeated for
+      `flatline_samples` samples (0 - disabled) make measurement bad.
+
+    Measurement value is never changed, only quality. `is_suspicious` tells
+    whether the last value was made uncertain by the filter, not by its
+    source.
+    """
+
+    def __init__(
+        self,
+        max_step=None,
+        z_limit=6,
+        min_std=0,
+        known_bad_values=(),
+        flatline_samples=0,
+        settle_samples=3,
+        bad_after=30,
+        warmup_samples=10,
+    ):
+        self.max_step = max_step
+        self.z_limit = z_limit
+        self.min_std = min_std
+        self.known_bad_values = known_bad_values
+        self.flatline_samples = flatline_samples
+        self.settle_samples = settle_samples
+        self.bad_after = bad_after
+        self.warmup_samples = warmup_samples
+
+        self.steps = RunningStatistics()
+        self.reset()
+
+    def reset(self):
+        self.is_suspicious = False
+        self.steps.reset()
+        self._last_good = None
+        self._run_min = None
+        self._run_max = None
+        self._run_tail = []
+        self._run_length = 0
+        self._good_streak = 0
+        self._last_value = None
+        self._repeats = 0
+
+    def _step_limit(self):
+        return self.z_limit * max(self.steps.std, self.min_std)
+
+    def _is_plausible(self, value):
+        if self._last_good is None:
+            return value not in self.known_bad_values
+
+        step = value - self._last_good
+        if self.max_step is not None and abs(step) > self.max_step:
+            return False
+        if self.steps.count >= self.warmup_samples:
+            return abs(step - self.steps.mean) <= self._step_limit()
+        return True
+
+    def _is_consistent_run(self):
+        if self._run_length < self.settle_samples:
+            return False
+        limit = self._step_limit()
+        if self._run_max - self._run_min <= limit:
+            return True
+        tail = self._run_tail
+        steps = [b - a for a, b in zip(tail, tail[1:])]
+        return max(steps) - min(steps) <= limit
+
+    def _accept(self, value):
+        if self._last_good is not None:
+            self.steps.add(value - self._last_good)
+        self._last_good = value
+
+    def check(self, measurement: Measurement) -> Measurement:
+        if measurement.is_bad:
+            self.reset()
+            return measurement
+
+        self.is_suspicious = False
+        value = measurement.value
+        if value == self._last_value:
+            self._repeats += 1
+        else:
+            self._repeats = 0
+        self._last_value = value
+        if self.flatline_samples and self._repeats >= self.flatline_samples:
+            return Measurement(value, QUALITY_BAD)
+
+        if self._is_plausible(value):
+            self._accept(value)
+            # Single plausible values of an erratic sensor do not end the run
+            self._good_streak += 1
+            if self._good_streak >= self.settle_samples:
+                self._run_length = 0
+            return measurement
+
+        self._good_streak = 0
+        if not self._run_length:
+            self._run_min = self._run_max = value
+            self._run_tail = []
+        else:
+            self._run_min = min(self._run_min, value)
+            self._run_max = max(self._run_max, value)
+        self._run_length += 1
+        self._run_tail.append(value)
+        if len(self._run_tail) > self.settle_samples:
+            self._run_tail.pop(0)
+
+        if self._is_consistent_run():
+            # Value settled at a new level or trend, statistics restart from it
+            self.steps.reset()
+            self._last_good = None
+            self._accept(value)
+            self._run_length = 0
+            return measurement
+
+        if self._run_length >= self.bad_after:
+            return Measurement(value, QUALITY_BAD)
+        self.is_suspicious = True
+        return Measurement(value, QUALITY_UNCERTAIN)
@@ -0,0 +1,324 @@
+import asyncio
+import socket
+
+from http_request import ENCODING, HTTPRequest
+from wifi_settings import SETTINGS_FILE_NAME, WiFiSettings, read_settings, write_settings
+
+DNS_POLL_INTERVAL_S = 0.05
+
+# Connectivity checks of Android, iOS and Windows are redirected to the portal
+CAPTIVE_PROBE_PATHS = (
+    "/generate_204",
+    "/gen_204",
+    "/hotspot-detect.html",
+    "/library/test/success.html",
+    "/connecttest.txt",
+    "/ncsi.txt",
+    "/redirect",
+    "/canonical.html",
+    "/success.txt",
+)
+
+PAGE_HEAD = """<!DOCTYPE html>
+<html lang="en">
+    <head>
+        <title>{title}</title>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1">
+        <link rel="icon" href="data:,">
+        <style>
+            label {{ display: inline-block; width: 100px}}
+            .i {{ display: inline-block; width: 150px }}
+        </style>
+    </head>
+    <body>
+"""
+
+PAGE_TAIL = """
+    </body>
+</html>
+"""
+
+FORM_HEAD = """
+        <h1>Smart tank configuration</h1>
+        <form action="/configure" method="post" accept-charset="utf-8">
+            <fieldset>
+            <legend>WiFi settings</legend>
+            <p><label for="ssid">SSID</label><select id="ssid" name="ssid" class="i">
+"""
+
+FORM_OPTION = """
+                <option value="{0}"{1}>{0}</option>"""
+
+FORM_TAIL = """
+            </select></p>
+            <p><label for="password">Password</label><input type="password" id="password" name="password" class="i" value="{password}"></p>
+            <p><label for="s_ip">Static IP</label><input type="checkbox" id="s_ip" name="s_ip"{static_ip}> reuse DHCP address</p>
+            </fieldset>
+            <fieldset>
+            <legend>MQTT settings</legend>
+            <p><label for="d_n">Device name</label><input type="text" id="d_n" name="d_n" class="i" required="" value="{device_name}"></p>
+            <p><label for="b_h">Broker host</label><input type="text" id="b_h" name="b_h" class="i" required="" value="{mqtt_host}"></p>
+            <p><label for="b_prt">Broker port</label><input type="text" id="b_prt" name="b_prt" class="i" required="" value="{mqtt_port}"></p>
+            <p><label for="b_l">Login</label><input type="text" id="b_l" name="b_l" class="i" value="{mqtt_user}"></p>
+            <p><label for="b_pwd">Password</label><input type="password" id="b_pwd" name="b_pwd" class="i" value="{mqtt_password}"></p>
+            </fieldset>
+            <p><input type="submit" value="Save" class="i"></p>
+        </form>
+"""
+
+
+def html_escape(value):
+    return (
+        str(value)
+        .replace("&", "&amp;")
+        .replace("<", "&lt;")
+        .replace(">", "&gt;")
+        .replace('"', "&quot;")
+    )
+
+
+def dns_response(query, ip_address: bytes):
+    """Answers the first question of DNS query with `ip_address`, None for non queries."""
+    if len(query) < 12 or query[2] & 0x80 or not (query[4] or query[5]):
+        return None
+
+    # Skip question name labels, then type and class
+    end = 12
+    while end < len(query) and query[end]:
+        end += query[end] + 1
+    end += 5
+    if end > len(query):
+        return None
+
+    return (
+        query[:2]
+        + b"\x81\x80"  # response, recursion desired and available, no error
+        + b"\x00\x01\x00\x01\x00\x00\x00\x00"  # 1 question, 1 answer
+        + query[12:end]
+        + b"\xc0\x0c"  # pointer to the question name
+        + b"\x00\x01\x00\x01"  # type A, class IN
+        + b"\x00\x00\x00\x3c"  # TTL 60 s
+        + b"\x00\x04"
+        + ip_address
+    )
+
+
+class CaptivePortal:
+    """
+    Asynchronous configuration portal, serves many connections at once with
+    HTTP keep-alive. DNS responder resolves every name to the portal address,
+    so phones and laptops open the portal by themselves.
+
+    WLAN access is passed as callables, so portal runs on any platform:
+
+    - `networks()` returns list of SSIDs to choose from;
+    - `connect(settings)` coroutine tries to connect with new settings and
+      returns IP address or None;
+    - optional `refresh_networks()` is called every second while there are no
+      connections, it may block for a network scan.
+    """
+
+    def __init__(
+        self,
+        networks,
+        connect,
+        ip_address="192.168.4.1",
+        port=80,
+        dns_port=53,
+        refresh_networks=None,
+        settings_file_name=SETTINGS_FILE_NAME,
+        keep_alive_timeout_s=5,
+    ):
+        self.networks = networks
+        self.connect = connect
+        self.ip_address = ip_address
+        self.port = port
+        self.dns_port = dns_port
+        self.refresh_networks = refresh_networks
+        self.settings_file_name = settings_file_name
+        self.keep_alive_timeout_s = keep_alive_timeout_s
+
+        self.connections = 0
+        self._running = False
+
+    async def serve(self, is_done=None):
+        """Serves until `is_done()` returns True."""
+        self._running = True
+        server = await asyncio.start_server(self._handle_client, "0.0.0.0", self.port)
+        dns_task = asyncio.create_task(self._dns_server()) if self.dns_port else None
+        try:
+            while not (is_done and is_done()):
+                await asyncio.sleep(1)
+                if self.refresh_networks and not self.connections:
+                    self.refresh_networks()
+        finally:
+            self._running = False
+            server.close()
+            await server.wait_closed()
+            if dns_task:
+                await dns_task
+
+    async def _dns_server(self):
+        ip_address = bytes([int(part) for part in self.ip_address.split(".")])
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("0.0.0.0", self.dns_port))
+        sock.setblocking(False)
+        try:
+            while self._running:
+                try:
+                    query, address = sock.recvfrom(512)
+                except OSError:
+                    await asyncio.sleep(DNS_POLL_INTERVAL_S)
+                    continue
+
+                if response := dns_response(query, ip_address):
+                    sock.sendto(response, address)
+        finally:
+            sock.close()
+
+    async def _handle_client(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request = HTTPRequest()
+                try:
+                    while not request.is_complete:
+                        data = await asyncio.wait_for(
+                            reader.read(512), self.keep_alive_timeout_s
+                        )
+                        if not data:
+                            return
+                        request.feed(data)
+                except ValueError as error:
+                    await self._send_page(writer, f"<p>{error}</p>", 400, False)
+                    return
+
+                if __debug__:
+                    print(request.method, request.path)
+                keep_alive = request.keep_alive
+                await self._dispatch(request, writer, keep_alive)
+                if not keep_alive:
+                    return
+        except (asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _dispatch(self, request, writer, keep_alive):
+        path = request.path.rstrip("/")
+        if path == "":
+            await self._send_root(writer, keep_alive)
+        elif path == "/configure":
+            await self._send_configure(request, writer, keep_alive)
+        elif path in CAPTIVE_PROBE_PATHS:
+            await self._send_header(
+                writer,
+                302,
+                keep_alive,
+                f"Location: http://{self.ip_address}/\r\nContent-Length: 0\r\n",
+            )
+        else:
+            await self._send_page(writer, "<p>Page not found!</p>", 404, keep_alive)
+
+    async def _send_header(self, writer, status_code, keep_alive, extra_headers):
+        writer.write(
+            (
+                f"HTTP/1.1 {status_code} OK\r\n"
+                "Content-Type: text/html\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                f"{extra_headers}\r\n"
+            ).encode(ENCODING)
+        )
+        await writer.drain()
+
+    async def _send_page(self, writer, payload, status_code=200, keep_alive=True):
+        body = (
+            PAGE_HEAD.format(title="WiFi Manager") + payload + PAGE_TAIL
+        ).encode(ENCODING)
+        await self._send_header(
+            writer, status_code, keep_alive, f"Content-Length: {len(body)}\r\n"
+        )
+        writer.write(body)
+        await writer.drain()
+
+    async def _send_chunk(self, writer, chunk):
+        chunk = chunk.encode(ENCODING)
+        writer.write(("%x\r\n" % len(chunk)).encode(ENCODING) + chunk + b"\r\n")
+        await writer.drain()
+
+    async def _send_root(self, writer, keep_alive):
+        # Page is streamed in chunks, it is never held in memory as a whole
+        settings = read_settings(self.settings_file_name)
+        await self._send_header(
+            writer, 200, keep_alive, "Transfer-Encoding: chunked\r\n"
+        )
+        await self._send_chunk(
+            writer, PAGE_HEAD.format(title="Smart tank configuration") + FORM_HEAD
+        )
+        for ssid in self.networks():
+            await self._send_chunk(
+                writer,
+                FORM_OPTION.format(
+                    html_escape(ssid), " selected" if ssid == settings.ssid else ""
+                ),
+            )
+        await self._send_chunk(
+            writer,
+            FORM_TAIL.format(
+                password=html_escape(settings.password),
+                static_ip=" checked" if settings.static_ip else "",
+                device_name=html_escape(settings.device_name),
+                mqtt_host=html_escape(settings.mqtt_host),
+                mqtt_port=html_escape(settings.mqtt_port),
+                mqtt_user=html_escape(settings.mqtt_user),
+                mqtt_password=html_escape(settings.mqtt_password),
+            )
+            + PAGE_TAIL,
+        )
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _send_configure(self, request, writer, keep_alive):
+        form = request.form()
+        settings = WiFiSettings(
+            form.get("ssid", ""),
+            form.get("password", ""),
+            form.get("d_n", ""),
+            form.get("b_h", ""),
+            form.get("b_prt", ""),
+            form.get("b_l", ""),
+            form.get("b_pwd", ""),
+            "s_ip" in form,
+        )
+
+        if not settings.ssid:
+            await self._send_page(
+                writer,
+                "<p>SSID must be provided!</p><p>Go back and try again!</p>",
+                400,
+                keep_alive,
+            )
+        elif ip_address := await self.connect(settings):
+            write_settings(settings, self.settings_file_name)
+            await self._send_page(
+                writer,
+                f"<p>Successfully connected to</p><h1>{html_escape(settings.ssid)}</h1>"
+                f"<p>IP address: {ip_address}</p>",
+                200,
+                keep_alive,
+            )
+        else:
+            await self._send_page(
+                writer,
+                f"<p>Could not connect to</p><h1>{html_escape(settings.ssid)}</h1>"
+                "<p>Go back and try again!</p>",
+                200,
+                keep_alive,
+            )
@@ -0,0 +1,55 @@
+import time
+
+MAX_PROFILE_POINTS = 64
+# Ping supervision is off while profile runs, so it may not run for long.
+# Seconds.
+MAX_PROFILE_EXPIRY = 300
+
+
+class PowerProfile:
+    """
+    Heater power profile for remote mode, executed against device monotonic
+    clock from the moment it is received, so client and device clocks need
+    not be synchronized. `points` are [offset, power] pairs, offset is
+    seconds, power is percents, every power holds until the next point.
+    After `expires` seconds profile is over and power should drop to 0.
+    """
+
+    def __init__(self, points, expires: float):
+        if not points or len(points) > MAX_PROFILE_POINTS:
+            raise ValueError("Wrong power profile points count")
+        if expires <= 0 or expires > MAX_PROFILE_EXPIRY:
+            raise ValueError("Power profile expiry should be within 0...300 s")
+
+        self._offsets_ms = []
+        self._powers = []
+        for offset, power in points:
+            offset_ms = int(offset * 1000)
+            if offset_ms < 0 or (
+                self._offsets_ms and offset_ms <= self._offsets_ms[-1]
+            ):
+                raise ValueError("Power profile offsets should be increasing")
+            if power < 0 or power > 100:
+                raise ValueError("Power should be within 0...100 %")
+            self._offsets_ms.append(offset_ms)
+            self._powers.append(int(power))
+
+        self.expires_ms = int(expires * 1000)
+        self.start_ticks = time.ticks_ms()
+        self._index = 0
+
+    def power(self, ticks: int):
+        """Power at `ticks`, 0 before the first point, None after expiry."""
+        elapsed_ms = time.ticks_diff(ticks, self.start_ticks)
+        if elapsed_ms >= self.expires_ms:
+            return None
+
+        # Points are passed in order, so only the next one is checked
+        while (
+            self._index < len(self._offsets_ms) - 1
+            and elapsed_ms >= self._offsets_ms[self._index + 1]
+        ):
+            self._index += 1
+        if elapsed_ms < self._offsets_ms[self._index]:
+            return 0
+        return self._powers[self._index]
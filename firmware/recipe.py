@@ -0,0 +1,193 @@
+import time
+
+RECIPE_IDLE = "idle"
+RECIPE_RUNNING = "running"
+RECIPE_DONE = "done"
+RECIPE_STOPPED = "stopped"
+
+# Consecutive readings at or below weight of the weight step
+WEIGHT_STEP_READINGS = 20
+
+
+class RampStep:
+    """Setpoint moves to `sp` at `rate` °C per minute, done when it is reached."""
+
+    code = "r"
+
+    def __init__(self, sp: float, rate: float):
+        if rate <= 0:
+            raise ValueError("Ramp rate should be positive")
+        self.sp = sp
+        self.rate = rate
+
+    def start(self, setpoint: float, ticks: int):
+        self._start_setpoint = setpoint
+        self._start_ticks = ticks
+
+    def update(self, ticks: int, temperature, weight):
+        """Returns (setpoint, done)."""
+        minutes = time.ticks_diff(ticks, self._start_ticks) / 60000
+        change = self.rate * minutes
+        if abs(self.sp - self._start_setpoint) <= change:
+            return self.sp, True
+        if self.sp > self._start_setpoint:
+            return self._start_setpoint + change, False
+        return self._start_setpoint - change, False
+
+    def remaining(self, ticks: int):
+        """Seconds to the end of the step, None if unknown."""
+        minutes = abs(self.sp - self._start_setpoint) / self.rate
+        return max(0, minutes * 60 - time.ticks_diff(ticks, self._start_ticks) / 1000)
+
+
+class SoakStep:
+    """
+    Holds `sp` for `duration` seconds. With non zero `band` time is counted
+    only while good temperature is within `band` of the setpoint (guaranteed
+    soak), so a slow heat up does not shorten the soak.
+    """
+
+    code = "s"
+
+    def __init__(self, sp: float, duration: float, band: float = 0):
+        if duration < 0 or band < 0:
+            raise ValueError("Soak duration and band should not be negative")
+        self.sp = sp
+        self.duration_ms = int(duration * 1000)
+        self.band = band
+
+    def start(self, setpoint: float, ticks: int):
+        self._last_ticks = ticks
+        self._soaked_ms = 0
+
+    def update(self, ticks: int, temperature, weight):
+        if not self.band or (
+            temperature is not None and abs(temperature - self.sp) <= self.band
+        ):
+            self._soaked_ms += time.ticks_diff(ticks, self._last_ticks)
+        self._last_ticks = ticks
+        return self.sp, self._soaked_ms >= self.duration_ms
+
+    def remaining(self, ticks: int):
+        return max(0, (self.duration_ms - self._soaked_ms) / 1000)
+
+
+class WeightStep:
+    """Holds `sp` until weight drops to `weight` grams."""
+
+    code = "w"
+
+    def __init__(self, sp: float, weight: float):
+        self.sp = sp
+        self.weight = weight
+
+    def start(self, setpoint: float, ticks: int):
+        self._readings = 0
+
+    def update(self, ticks: int, temperature, weight):
+        if weight is not None:
+            self._readings = self._readings + 1 if weight <= self.weight else 0
+        return self.sp, self._readings >= WEIGHT_STEP_READINGS
+
+    def remaining(self, ticks: int):
+        return None
+
+
+STEP_TYPES = {
+    step_type.code: step_type for step_type in (RampStep, SoakStep, WeightStep)
+}
+
+
+def make_steps(config):
+    """
+    Builds steps from compact list as stored in `recipe` parameter, every
+    step is [code, setpoint, argument, ...], e.g. ["r", 65, 1.5] - ramp to
+    65 °C at 1.5 °C/min, ["s", 65, 600, 0.5] - soak for 600 s within 0.5 °C,
+    ["w", 100, 5000] - hold 100 °C until weight is 5000 g. Raises ValueError
+    or TypeError on bad configuration.
+    """
+    steps = []
+    for step_config in config:
+        step_type = STEP_TYPES.get(step_config[0])
+        if not step_type:
+            raise ValueError("Unknown recipe step type")
+        steps.append(step_type(*step_config[1:]))
+    return steps
+
+
+class RecipeEngine:
+    """
+    Runs recipe steps one by one, providing temperature regulator setpoint.
+    Ramp of the first step starts from the current temperature, next steps
+    start from the setpoint of the previous one.
+    """
+
+    def __init__(self, steps=()):
+        self.steps = list(steps)
+        self.state = RECIPE_IDLE
+        self.step_index = 0
+        self.setpoint = None
+        self._step_ticks = 0
+        self._ticks = 0
+
+    @property
+    def is_running(self):
+        return self.state == RECIPE_RUNNING
+
+    def configure(self, steps):
+        self.steps = list(steps)
+        self.state = RECIPE_IDLE
+        self.step_index = 0
+
+    def start(self, temperature: float):
+        if not self.steps:
+            raise ValueError("Recipe is empty")
+        self.state = RECIPE_RUNNING
+        self.setpoint = temperature
+        self._start_step(0, time.ticks_ms())
+
+    def stop(self):
+        if self.is_running:
+            self.state = RECIPE_STOPPED
+
+    def _start_step(self, index: int, ticks: int):
+        self.step_index = index
+        self._step_ticks = ticks
+        self.steps[index].start(self.setpoint, ticks)
+
+    def update(self, temperature=None, weight=None) -> bool:
+        """
+        Advances the recipe with good temperature and weight values (None if
+        not good). Returns True when step changed or recipe is done.
+        """
+        if not self.is_running:
+            return False
+
+        self._ticks = time.ticks_ms()
+        self.setpoint, done = self.steps[self.step_index].update(
+            self._ticks, temperature, weight
+        )
+        if not done:
+            return False
+
+        if self.step_index + 1 < len(self.steps):
+            self._start_step(self.step_index + 1, self._ticks)
+        else:
+            self.state = RECIPE_DONE
+        return True
+
+    def to_dict(self):
+        running = self.is_running
+        step = self.steps[self.step_index] if running else None
+        return {
+            "state": self.state,
+            "step": self.step_index,
+            "steps": len(self.steps),
+            "setpoint": self.setpoint,
+            "step_elapsed": (
+                time.ticks_diff(self._ticks, self._step_ticks) / 1000
+                if running
+                else None
+            ),
+            "step_remaining": step.remaining(self._ticks) if running else None,
+        }
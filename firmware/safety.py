@@ -0,0 +1,375 @@
+import time
+
+HEATER_POWER_SENSOR = "heater_output_power"
+
+
+class _Window:
+    """Samples of the last `window_ms` milliseconds, oldest first."""
+
+    def __init__(self, window_ms: int):
+        self.window_ms = window_ms
+        self.samples = []
+
+    def add(self, ticks: int, value: float):
+        self.samples.append((ticks, value))
+        while time.ticks_diff(ticks, self.samples[0][0]) > self.window_ms:
+            self.samples.pop(0)
+
+    def span_ms(self):
+        if not self.samples:
+            return 0
+        return time.ticks_diff(self.samples[-1][0], self.samples[0][0])
+
+    def clear(self):
+        self.samples = []
+
+
+def _good_value(sensors_data, sensor):
+    m = sensors_data.get(sensor)
+    if not m or not m.is_good:
+        return None
+    return m.value
+
+
+def _check_power(min_power):
+    if min_power < 0 or min_power > 100:
+        raise ValueError("Heater power should be within 0...100 %")
+
+
+def _usable_value(sensors_data, sensor):
+    """Good or uncertain value, uncertain one may be a real fast change."""
+    m = sensors_data.get(sensor)
+    if not m or m.is_bad:
+        return None
+    return m.value
+
+
+class Rule:
+    """
+    Safety rule, `update()` is called with every new set of measurements and
+    returns True when the rule is tripped. `reason` is a machine readable
+    trip code, `message` is a text for the status reply.
+    """
+
+    def __init__(self, sensor: str, reason: str):
+        self.sensor = sensor
+        self.reason = reason
+
+    @property
+    def message(self):
+        return f"{self.reason} alarm on {self.sensor}."
+
+    def update(self, sensors_data, ticks: int) -> bool:
+        return False
+
+    def reset(self):
+        pass
+
+
+class SensorFaultRule(Rule):
+    """Trips when measurement is missing or bad, uncertain one is not a fault."""
+
+    def __init__(self, sensor: str, reason="sensor_fault", message=None):
+        super().__init__(sensor, reason)
+        self._message = message
+
+    @property
+    def message(self):
+        return self._message or f"Sensor {self.sensor} malfunction."
+
+    def update(self, sensors_data, ticks):
+        m = sensors_data.get(self.sensor)
+        return not m or m.is_bad
+
+
+class LimitRule(Rule):
+    """
+    Trips when measurement is at or above `high` or at or below `low`.
+    Uncertain values are checked too, limit is never missed while
+    plausibility check waits for confirmation.
+    """
+
+    def __init__(self, sensor: str, high=None, low=None, reason="limit", message=None):
+        if high is None and low is None:
+            raise ValueError("Limit rule needs high or low limit")
+        super().__init__(sensor, reason)
+        self.high = high
+        self.low = low
+        self._message = message
+
+    @property
+    def message(self):
+        return self._message or f"Sensor {self.sensor} out of limits."
+
+    def limits(self):
+        return self.low, self.high
+
+    def update(self, sensors_data, ticks):
+        value = _usable_value(sensors_data, self.sensor)
+        if value is None:
+            return False
+        low, high = self.limits()
+        return (high is not None and value >= high) or (
+            low is not None and value <= low
+        )
+
+
+class ParameterLimitRule(LimitRule):
+    """High limit is read from `parameters` attribute, so changes apply at once."""
+
+    def __init__(self, sensor: str, parameters, parameter_name: str, message=None):
+        super().__init__(
+            sensor,
+            high=getattr(parameters, parameter_name),
+            reason=parameter_name,
+            message=message,
+        )
+        self.parameters = parameters
+        self.parameter_name = parameter_name
+
+    def limits(self):
+        return None, getattr(self.parameters, self.parameter_name)
+
+
+class RateOfRiseRule(Rule):
+    """Trips when value rises faster than `max_rate` per second over `window` s."""
+
+    def __init__(self, sensor: str, max_rate: float, window=10, reason="rate_of_rise"):
+        if max_rate <= 0 or window <= 0:
+            raise ValueError("Rate and window should be positive")
+        super().__init__(sensor, reason)
+        self.max_rate = max_rate
+        self._window = _Window(int(window * 1000))
+
+    @property
+    def message(self):
+        return f"{self.sensor} rises faster than {self.max_rate} per second."
+
+    def update(self, sensors_data, ticks):
+        value = _good_value(sensors_data, self.sensor)
+        if value is None:
+            return False
+
+        self._window.add(ticks, value)
+        span_ms = self._window.span_ms()
+        # Rate is not reliable until window is mostly filled
+        if not span_ms or span_ms < self._window.window_ms // 2:
+            return False
+        rise = value - self._window.samples[0][1]
+        return rise * 1000 / span_ms > self.max_rate
+
+    def reset(self):
+        self._window.clear()
+
+
+class StuckRule(Rule):
+    """
+    Trips when value stays within `tolerance` for `duration` seconds while heater
+    power is at least `min_power` percents.
+    """
+
+    def __init__(
+        self, sensor: str, duration: float, tolerance=0, min_power=0, reason="stuck"
+    ):
+        if duration <= 0 or tolerance < 0:
+            raise ValueError("Duration should be positive, tolerance not negative")
+        _check_power(min_power)
+        super().__init__(sensor, reason)
+        self.duration_ms = int(duration * 1000)
+        self.tolerance = tolerance
+        self.min_power = min_power
+        self.reset()
+
+    @property
+    def message(self):
+        return f"{self.sensor} value is stuck."
+
+    def reset(self):
+        self._start_ticks = None
+        self._min = None
+        self._max = None
+
+    def update(self, sensors_data, ticks):
+        value = _good_value(sensors_data, self.sensor)
+        power = _good_value(sensors_data, HEATER_POWER_SENSOR) or 0
+        if value is None or power < self.min_power:
+            self.reset()
+            return False
+
+        if self._start_ticks is None:
+            self._start_ticks = ticks
+            self._min = self._max = value
+            return False
+
+        self._min = min(self._min, value)
+        self._max = max(self._max, value)
+        if self._max - self._min > self.tolerance:
+            self._start_ticks = ticks
+            self._min = self._max = value
+            return False
+        return time.ticks_diff(ticks, self._start_ticks) >= self.duration_ms
+
+
+class DryBoilRule(Rule):
+    """
+    Trips when heater power is at least `min_power` percents for `duration`
+    seconds and temperature did not rise for `min_rise` degrees over the
+    lowest value in this period.
+    """
+
+    def __init__(
+        self,
+        sensor: str,
+        duration: float,
+        min_rise=1,
+        min_power=50,
+        reason="dry_boil",
+    ):
+        if duration <= 0 or min_rise <= 0:
+            raise ValueError("Duration and rise should be positive")
+        _check_power(min_power)
+        super().__init__(sensor, reason)
+        self.duration_ms = int(duration * 1000)
+        self.min_rise = min_rise
+        self.min_power = min_power
+        self.reset()
+
+    @property
+    def message(self):
+        return f"Heater is on, but {self.sensor} does not rise."
+
+    def reset(self):
+        self._start_ticks = None
+        self._min = None
+
+    def update(self, sensors_data, ticks):
+        value = _good_value(sensors_data, self.sensor)
+        power = _good_value(sensors_data, HEATER_POWER_SENSOR) or 0
+        if value is None or power < self.min_power:
+            self.reset()
+            return False
+
+        if self._start_ticks is None or value < self._min:
+            if self._start_ticks is None:
+                self._start_ticks = ticks
+            self._min = value
+        if value - self._min >= self.min_rise:
+            # Temperature responds, watch the next period
+            self._start_ticks = ticks
+            self._min = value
+            return False
+        return time.ticks_diff(ticks, self._start_ticks) >= self.duration_ms
+
+
+class WeightDropRule(Rule):
+    """Trips when weight drops more than `max_drop` below maximum of `window` s."""
+
+    def __init__(self, sensor: str, max_drop: float, window=10, reason="weight_drop"):
+        if max_drop <= 0 or window <= 0:
+            raise ValueError("Drop and window should be positive")
+        super().__init__(sensor, reason)
+        self.max_drop = max_drop
+        self._window = _Window(int(window * 1000))
+
+    @property
+    def message(self):
+        return f"{self.sensor} dropped more than {self.max_drop} in a short time."
+
+    def update(self, sensors_data, ticks):
+        value = _good_value(sensors_data, self.sensor)
+        if value is None:
+            return False
+
+        self._window.add(ticks, value)
+        return max(v for _, v in self._window.samples) - value > self.max_drop
+
+    def reset(self):
+        self._window.clear()
+
+
+RULE_TYPES = {
+    "limit": LimitRule,
+    "rate_of_rise": RateOfRiseRule,
+    "stuck": StuckRule,
+    "dry_boil": DryBoilRule,
+    "weight_drop": WeightDropRule,
+}
+
+
+class ConfigurationErrorRule(Rule):
+    """Always tripped, replaces stored rules which can not be built."""
+
+    def __init__(self):
+        super().__init__("safety_rules", "safety_rules")
+
+    @property
+    def message(self):
+        return "Safety rules configuration is invalid."
+
+    def update(self, sensors_data, ticks):
+        return True
+
+
+def make_rules(config, sensor_names=None):
+    """
+    Builds rules from list of dicts as stored in `safety_rules` parameter,
+    e.g. {"type": "rate_of_rise", "sensor": "bottom_temperature_calibrated",
+    "max_rate": 0.5}. Sensor should be one of `sensor_names` if given, a
+    misspelled rule would never trip. Raises ValueError or TypeError on bad
+    configuration.
+    """
+    rules = []
+    for rule_config in config:
+        rule_config = dict(rule_config)
+        rule_type = RULE_TYPES.get(rule_config.pop("type", None))
+        if not rule_type:
+            raise ValueError("Unknown safety rule type")
+        if sensor_names is not None and rule_config.get("sensor") not in sensor_names:
+            raise ValueError("Unknown safety rule sensor")
+        rules.append(rule_type(**rule_config))
+    return rules
+
+
+class SafetyEngine:
+    """
+    Evaluates safety rules on every new set of measurements.
+
+    Built-in rules (sensor faults and alarm setpoints) are fixed, configurable
+    rules come from `safety_rules` parameter. Limit rules check uncertain
+    measurements too, history based rules see only good ones until
+    plausibility check confirms or rejects uncertain values. Rules keep
+    their state while device is disabled and are reset when it is armed
+    again, so history recorded before enabling can not trip it at once.
+    """
+
+    def __init__(self, builtin_rules, rules=()):
+        self.builtin_rules = builtin_rules
+        self.rules = list(rules)
+        self.last_trip = None
+        self._armed = False
+
+    def configure(self, rules):
+        self.rules = list(rules)
+
+    def evaluate(self, sensors_data, armed=True):
+        """Updates all rules, returns the first tripped rule if armed."""
+        if armed and not self._armed:
+            for rule in self.builtin_rules + self.rules:
+                rule.reset()
+        self._armed = armed
+
+        ticks = time.ticks_ms()
+        tripped = None
+        for rule in self.builtin_rules + self.rules:
+            # Broken rule trips, it can not switch off the other ones
+            try:
+                is_tripped = rule.update(sensors_data, ticks)
+            except Exception as e:
+                is_tripped = True
+            if is_tripped and tripped is None:
+                tripped = rule
+
+        if tripped and armed:
+            self.last_trip = tripped.reason
+            return tripped
+        return None
@@ -6,13 +6,15 @@ class Scheduler:
     def __init__(self, interval):
         self.__interval = interval
         self.__last_execution_ticks = time.ticks_ms()
+        self.overruns = 0
 
     def is_timeout(self):
         current_ticks = time.ticks_ms()
-        if (
-            time.ticks_diff(current_ticks, self.__last_execution_ticks)
-            >= self.__interval
-        ):
+        spent_ticks = time.ticks_diff(current_ticks, self.__last_execution_ticks)
+        if spent_ticks >= self.__interval:
+            # Whole interval was missed, loop is too slow for this schedule
+            if spent_ticks >= 2 * self.__interval:
+                self.overruns += 1
             self.__last_execution_ticks = current_ticks
             return True
         return False
@@ -8,6 +8,8 @@ from heater import Heater
 
 QUALITY_GOOD = 0
 QUALITY_BAD = 1
+# Implausible value, e.g. a spike, control holds until it is good or bad again
+QUALITY_UNCERTAIN = 2
 
 
 class Measurement:
@@ -22,7 +24,11 @@ class Measurement:
 
     @property
     def is_bad(self):
-        return not self.is_good
+        return self.quality == QUALITY_BAD
+
+    @property
+    def is_uncertain(self):
+        return self.quality == QUALITY_UNCERTAIN
 
     def to_dict(self):
         return {"value": self.value, "quality": self.quality}
@@ -230,6 +236,143 @@ class HeaterOutputPowerSensor(Sensor):
         return Measurement(self._heater.get_power(), QUALITY_GOOD)
 
 
+class HeaterPowerSensor(Sensor):
+    """Average heater power over PWM interval, watts."""
+
+    def __init__(self, name: str, heater: Heater, meter):
+        self._heater = heater
+        self._meter = meter
+        super().__init__(name)
+
+    def get_measurement(self):
+        if not self._meter.rated_power:
+            return Measurement(0, QUALITY_BAD)
+        return Measurement(
+            self._meter.rated_power * self._heater.get_duty_cycle(), QUALITY_GOOD
+        )
+
+
+class EnergySensor(Sensor):
+    """Value of energy `counter` attribute of the meter in `unit_wh` units."""
+
+    def __init__(self, name: str, meter, counter: str, unit_wh=1):
+        self._meter = meter
+        self._counter = counter
+        self._unit_wh = unit_wh
+        super().__init__(name)
+
+    def get_measurement(self):
+        if not self._meter.rated_power:
+            return Measurement(0, QUALITY_BAD)
+        counter = getattr(self._meter, self._counter)
+        return Measurement(counter.value_wh / self._unit_wh, QUALITY_GOOD)
+
+
+class TemperatureCompensatedSensor(Sensor):
+    """
+    Corrects raw values of `sensor` for temperature drift, see
+    WeightCompensation. Temperature measurement is taken from
+    `temperature_sensor` unless passed explicitly. Without temperature raw
+    value is returned uncertain, so a failed probe does not stop the batch.
+    """
+
+    def __init__(self, name: str, sensor, temperature_sensor, compensation):
+        self.sensor = sensor
+        self.temperature_sensor = temperature_sensor
+        self.compensation = compensation
+        super().__init__(name)
+
+    def get_measurement(
+        self,
+        raw_measurement: Measurement = None,
+        temperature_measurement: Measurement = None,
+    ):
+        if not raw_measurement:
+            raw_measurement = self.sensor.get_measurement()
+        if not self.compensation.is_enabled:
+            return raw_measurement
+
+        if not temperature_measurement:
+            temperature_measurement = self.temperature_sensor.get_measurement()
+        if raw_measurement.is_bad:
+            return raw_measurement
+        if temperature_measurement.is_bad:
+            return Measurement(raw_measurement.value, QUALITY_UNCERTAIN)
+
+        return Measurement(
+            self.compensation.compensate(
+                raw_measurement.value, temperature_measurement.value
+            ),
+            (
+                QUALITY_GOOD
+                if raw_measurement.is_good and temperature_measurement.is_good
+                else QUALITY_UNCERTAIN
+            ),
+        )
+
+
+class EvaporationRateSensor(Sensor):
+
+    def __init__(self, name: str, estimator):
+        self._estimator = estimator
+        super().__init__(name)
+
+    def get_measurement(self):
+        if not self._estimator.is_ready:
+            return Measurement(0, QUALITY_BAD)
+        return Measurement(self._estimator.evaporation_rate, QUALITY_GOOD)
+
+
+class BulkTemperatureSensor(Sensor):
+    """Fused bulk temperature, quality follows the bottom probe."""
+
+    def __init__(self, name: str, fusion):
+        self._fusion = fusion
+        super().__init__(name)
+
+    def get_measurement(self):
+        if self._fusion.temperature is None:
+            return Measurement(0, QUALITY_BAD)
+        return Measurement(self._fusion.temperature, self._fusion.bottom_quality)
+
+
+class StratificationSensor(Sensor):
+    """Top minus bottom temperature of the liquid, lag compensated."""
+
+    def __init__(self, name: str, fusion):
+        self._fusion = fusion
+        super().__init__(name)
+
+    def get_measurement(self):
+        fusion = self._fusion
+        if not fusion.has_stratification or fusion.top_quality == QUALITY_BAD:
+            return Measurement(0, QUALITY_BAD)
+        quality = (
+            QUALITY_GOOD
+            if fusion.top_quality == QUALITY_GOOD
+            and fusion.bottom_quality == QUALITY_GOOD
+            else QUALITY_UNCERTAIN
+        )
+        return Measurement(fusion.stratification, quality)
+
+
+class WeightSetpointETASensor(Sensor):
+
+    def __init__(self, name: str, estimator, parameters):
+        self._estimator = estimator
+        self._parameters = parameters
+        super().__init__(name)
+
+    def get_measurement(self):
+        if not self._estimator.is_ready:
+            return Measurement(0, QUALITY_BAD)
+
+        seconds_left = self._estimator.seconds_to(self._parameters.weight_sp)
+        if seconds_left is None:
+            return Measurement(0, QUALITY_BAD)
+        return Measurement(seconds_left, QUALITY_GOOD)
+
+
 class CalibrationPoint:
 
     def __init__(self, raw_value: float, calibrated_value: float):
@@ -243,28 +386,111 @@ class CalibrationPoint:
         return ujson.dumps(self.to_dict)
 
 
-class CalibratedSensor(Sensor):
+def _solve_linear_system(a, b):
+    """Gaussian elimination with partial pivoting, `a` and `b` are modified."""
+    n = len(b)
+    for column in range(n):
+        pivot = max(range(column, n), key=lambda row: abs(a[row][column]))
+        if a[pivot][column] == 0:
+            raise ValueError("Calibration points are degenerate")
+        a[column], a[pivot] = a[pivot], a[column]
+        b[column], b[pivot] = b[pivot], b[column]
 
-    def __init__(
-        self,
-        sensor,
-        calibration_point_1: CalibrationPoint,
-        calibration_point_2: CalibrationPoint,
-    ):
+        for row in range(column + 1, n):
+            factor = a[row][column] / a[column][column]
+            for i in range(column, n):
+                a[row][i] -= factor * a[column][i]
+            b[row] -= factor * b[column]
+
+    x = [0] * n
+    for row in range(n - 1, -1, -1):
+        x[row] = (
+            b[row] - sum(a[row][i] * x[i] for i in range(row + 1, n))
+        ) / a[row][row]
+    return x
+
+
+class CalibratedSensor(Sensor):
+    """
+    Piecewise-linear calibration through calibration points, outer segments
+    are extrapolated. With non zero `degree` least squares polynomial of that
+    degree is fitted to the points instead. Raw values are normalized to
+    [-1, 1] before fitting, single precision floats of the MCU are not enough
+    for powers of raw HX711 codes.
+    """
+
+    def __init__(self, sensor, *calibration_points: CalibrationPoint, degree=0):
+        points = sorted(calibration_points, key=lambda p: p.raw_value)
+        if len(points) < 2:
+            raise ValueError("At least two calibration points are required")
+        for i in range(1, len(points)):
+            if points[i].raw_value == points[i - 1].raw_value:
+                raise ValueError("Calibration points raw values should be unique")
+
+        if degree < 0 or degree >= len(points):
+            raise ValueError(
+                "Polynomial degree should be within 0...calibration points count - 1"
+            )
 
         self.sensor = sensor
-        self._k = (
-            calibration_point_2.calibrated_value - calibration_point_1.calibrated_value
-        ) / (calibration_point_2.raw_value - calibration_point_1.raw_value)
-        self._b = (
-            self._k * calibration_point_1.raw_value
-            - calibration_point_1.calibrated_value
-        )
+        self._coefficients = None
+        if degree:
+            self._fit_polynomial(points, degree)
+        else:
+            # Segment i starts at _raw_values[i], value = (raw - start) * k + offset
+            self._raw_values = [p.raw_value for p in points[:-1]]
+            self._offsets = [p.calibrated_value for p in points[:-1]]
+            self._k = [
+                (p2.calibrated_value - p1.calibrated_value)
+                / (p2.raw_value - p1.raw_value)
+                for p1, p2 in zip(points, points[1:])
+            ]
         super().__init__(f"{sensor.name}_calibrated")
 
+    def _fit_polynomial(self, points, degree):
+        self._center = (points[0].raw_value + points[-1].raw_value) / 2
+        self._scale = (points[-1].raw_value - points[0].raw_value) / 2
+
+        # Normal equations of the least squares problem
+        size = degree + 1
+        a = [[0] * size for _ in range(size)]
+        b = [0] * size
+        for p in points:
+            x = (p.raw_value - self._center) / self._scale
+            powers = [x**i for i in range(size)]
+            for row in range(size):
+                b[row] += powers[row] * p.calibrated_value
+                for column in range(size):
+                    a[row][column] += powers[row] * powers[column]
+
+        # Highest power first for Horner's scheme
+        self._coefficients = _solve_linear_system(a, b)[::-1]
+
+    def _segment(self, raw_value):
+        # Binary search for the last segment starting at or below raw value
+        raw_values = self._raw_values
+        low, high = 0, len(raw_values) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if raw_values[middle] <= raw_value:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
     def get_measurement(self, raw_measurement: Measurement = None):
         if not raw_measurement:
             raw_measurement = self.sensor.get_measurement()
 
-        calibrated_value = self._k * raw_measurement.value - self._b
+        raw_value = raw_measurement.value
+        if self._coefficients:
+            x = (raw_value - self._center) / self._scale
+            calibrated_value = 0
+            for c in self._coefficients:
+                calibrated_value = calibrated_value * x + c
+        else:
+            i = self._segment(raw_value) if len(self._k) > 1 else 0
+            calibrated_value = (raw_value - self._raw_values[i]) * self._k[
+                i
+            ] + self._offsets[i]
         return Measurement(calibrated_value, raw_measurement.quality)
@@ -0,0 +1,186 @@
+import ujson
+
+CALIBRATION_IDLE = 0
+CALIBRATION_ZERO = 1
+CALIBRATION_SPAN = 2
+
+# Minimal temperature change during calibration phase, °C
+MIN_TEMPERATURE_RANGE = 5
+MIN_SAMPLES = 30
+
+# Temperatures the model is valid for, °C. Span factor 1 + span_drift * dT
+# should stay above MIN_SPAN_FACTOR within it.
+OPERATING_TEMPERATURE_RANGE = (-20, 120)
+MIN_SPAN_FACTOR = 0.5
+
+
+class WeightCompensation:
+    """
+    Load cells temperature drift model, raw values are ADC codes:
+
+        raw = reference_zero + zero_drift * dT + load * (1 + span_drift * dT)
+
+    where dT = temperature - reference_temperature and load is raw code
+    increase caused by product at reference temperature. Zero coefficients
+    disable compensation.
+    """
+
+    def __init__(
+        self,
+        reference_temperature: float = 20,
+        reference_zero: float = 0,
+        zero_drift: float = 0,
+        span_drift: float = 0,
+    ):
+        for temperature in OPERATING_TEMPERATURE_RANGE:
+            dt = temperature - reference_temperature
+            if 1 + span_drift * dt < MIN_SPAN_FACTOR:
+                raise ValueError("Span drift is too large for operating temperatures")
+
+        self.reference_temperature = reference_temperature
+        self.reference_zero = reference_zero
+        self.zero_drift = zero_drift
+        self.span_drift = span_drift
+
+    @property
+    def is_enabled(self):
+        return self.zero_drift != 0 or self.span_drift != 0
+
+    def compensate(self, raw_value: float, temperature: float):
+        """Raw value as it would be at reference temperature."""
+        # Implausible temperatures are clamped, span factor is positive there
+        low, high = OPERATING_TEMPERATURE_RANGE
+        temperature = min(max(temperature, low), high)
+        dt = temperature - self.reference_temperature
+        return self.reference_zero + (
+            raw_value - self.reference_zero - self.zero_drift * dt
+        ) / (1 + self.span_drift * dt)
+
+    def to_dict(self):
+        return {
+            "reference_temperature": self.reference_temperature,
+            "reference_zero": self.reference_zero,
+            "zero_drift": self.zero_drift,
+            "span_drift": self.span_drift,
+        }
+
+    def to_json(self):
+        return ujson.dumps(self.to_dict())
+
+
+class _LineFit:
+    """
+    Running least squares fit of y = intercept + slope * x. Sums are kept
+    relative to the first sample, raw ADC codes squared do not fit single
+    precision floats.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.min_x = None
+        self.max_x = None
+
+    def add(self, x: float, y: float):
+        if not self.count:
+            self._x0, self._y0 = x, y
+            self._sx = self._sy = self._sxx = self._sxy = 0
+            self.min_x = self.max_x = x
+
+        self.count += 1
+        self.min_x = min(self.min_x, x)
+        self.max_x = max(self.max_x, x)
+        x -= self._x0
+        y -= self._y0
+        self._sx += x
+        self._sy += y
+        self._sxx += x * x
+        self._sxy += x * y
+
+    @property
+    def is_ready(self):
+        return (
+            self.count >= MIN_SAMPLES
+            and self.max_x - self.min_x >= MIN_TEMPERATURE_RANGE
+        )
+
+    @property
+    def mean_x(self):
+        return self._x0 + self._sx / self.count
+
+    def fit(self):
+        """Returns (value at mean x, slope)."""
+        n = self.count
+        slope = (n * self._sxy - self._sx * self._sy) / (
+            n * self._sxx - self._sx * self._sx
+        )
+        return self._y0 + self._sy / n, slope
+
+    def to_dict(self):
+        return {
+            "samples": self.count,
+            "min_temperature": self.min_x,
+            "max_temperature": self.max_x,
+        }
+
+
+class WeightCompensationCalibration:
+    """
+    Guided calibration of WeightCompensation.
+
+    Zero phase collects uncompensated raw weight of the empty tank, span phase
+    collects raw weight with a constant known load on the tank. In both phases
+    temperature should sweep at least MIN_TEMPERATURE_RANGE. Span phase is
+    optional, without it only zero drift is compensated.
+    """
+
+    def __init__(self):
+        self.phase = CALIBRATION_IDLE
+        self._zero = _LineFit()
+        self._span = _LineFit()
+
+    def start_phase(self, phase: int):
+        self.phase = phase
+
+    def add_sample(self, raw_value: float, temperature: float):
+        if self.phase == CALIBRATION_ZERO:
+            self._zero.add(temperature, raw_value)
+        elif self.phase == CALIBRATION_SPAN:
+            self._span.add(temperature, raw_value)
+
+    def finish(self):
+        """Returns fitted WeightCompensation, raises ValueError if data is not sufficient."""
+        self.phase = CALIBRATION_IDLE
+        if not self._zero.is_ready:
+            raise ValueError(
+                "Zero phase needs more samples or wider temperature range"
+            )
+
+        reference_temperature = self._zero.mean_x
+        reference_zero, zero_drift = self._zero.fit()
+        span_drift = 0
+        if self._span.count:
+            if not self._span.is_ready:
+                raise ValueError(
+                    "Span phase needs more samples or wider temperature range"
+                )
+
+            span_mean, span_slope = self._span.fit()
+            # Load line is the difference of span and zero lines
+            dt = self._span.mean_x - reference_temperature
+            load = span_mean - reference_zero - zero_drift * dt
+            load_slope = span_slope - zero_drift
+            reference_load = load - load_slope * dt
+            if reference_load == 0:
+                raise ValueError("Span phase load is zero")
+            span_drift = load_slope / reference_load
+
+        return WeightCompensation(
+            reference_temperature, reference_zero, zero_drift, span_drift
+        )
+
+    def to_dict(self):
+        return {
+            "phase": self.phase,
+            "zero": self._zero.to_dict(),
+            "span": self._span.to_dict(),
+        }
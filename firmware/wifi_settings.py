@@ -0,0 +1,70 @@
+import json
+
+SETTINGS_FILE_NAME = "wifi_settings.json"
+
+
+class WiFiSettings:
+
+    def __init__(
+        self,
+        ssid: str = "",
+        password: str = "",
+        device_name: str = "smart_tank",
+        mqtt_host: str = "",
+        mqtt_port: int = 0,
+        mqtt_user: str = "",
+        mqtt_password: str = "",
+        static_ip: bool = False,
+        bssid: str = "",
+        channel: int = 0,
+        ip_config=None,
+    ):
+        self.ssid = ssid
+        self.password = password
+        self.device_name = device_name
+        self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
+        self.mqtt_user = mqtt_user
+        self.mqtt_password = mqtt_password
+        # Last good connection, used to connect without scan on boot. With
+        # static_ip the last DHCP lease is applied as static configuration.
+        self.static_ip = static_ip
+        self.bssid = bssid
+        self.channel = channel
+        self.ip_config = ip_config
+
+    def _to_dict(self):
+        return {
+            "ssid": self.ssid,
+            "password": self.password,
+            "device_name": self.device_name,
+            "mqtt_host": self.mqtt_host,
+            "mqtt_port": self.mqtt_port,
+            "mqtt_user": self.mqtt_user,
+            "mqtt_password": self.mqtt_password,
+            "static_ip": self.static_ip,
+            "bssid": self.bssid,
+            "channel": self.channel,
+            "ip_config": self.ip_config,
+        }
+
+    def to_json(self):
+        return json.dumps(self._to_dict())
+
+    @staticmethod
+    def from_json(json_string):
+        json_dict = json.loads(json_string)
+        return WiFiSettings(**json_dict)
+
+
+def write_settings(settings: WiFiSettings, file_name=SETTINGS_FILE_NAME):
+    with open(file_name, "w") as file:
+        file.write(settings.to_json())
+
+
+def read_settings(file_name=SETTINGS_FILE_NAME) -> WiFiSettings:
+    try:
+        with open(file_name) as file:
+            return WiFiSettings.from_json(file.read())
+    except OSError:
+        return WiFiSettings()
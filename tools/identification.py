@@ -0,0 +1,389 @@
+"""
+Plant model identification from recorded sensors telemetry.
+
+Input is a JSON lines file, one `{device_name}/from_device/sensors` message
+per line. Sample time is taken from optional top level "timestamp" field
+(seconds), otherwise from device uptime. Recording is streamed in chunks,
+normal equations of the least squares problem are accumulated for every
+candidate dead time at once, so long recordings are never fully loaded.
+
+First order model (mass as covariate, heat loss to ambient):
+
+    mass * dT/dt = heat_gain * u(t - dead_time) - heat_loss * (T - ambient)
+
+Second order model (additional lag between heater and product), fitted with
+instrumental variables:
+
+    mass * dT[k+1] = alpha * mass * dT[k] + (beta * u[k - d] + gamma * T[k] + delta) * dt
+
+Fitted model is written as plant model JSON accepted by pid_tuner.py.
+
+Example:
+
+    $ uv run identification.py sensors.jsonl --output-max-power 70 --output model.json
+"""
+
+import argparse
+import json
+
+import numpy as np
+from plant import SecondOrderModel, ThermalModel, save_model
+
+POWER_KEY = "heater_output_power"
+TEMPERATURE_KEY = "bottom_temperature_calibrated"
+WEIGHT_KEY = "weight_calibrated"
+QUALITY_GOOD = 0
+
+
+def read_samples(file_name, chunk_size=10000):
+    """Yields chunks of samples as dict of arrays: time, power, temperature, mass, valid."""
+    rows = []
+
+    def make_chunk():
+        data = np.array(rows, dtype=np.float64).reshape(-1, 5)
+        return {
+            "time": data[:, 0],
+            "power": data[:, 1],
+            "temperature": data[:, 2],
+            "mass": data[:, 3] / 1000,
+            "valid": data[:, 4] > 0,
+        }
+
+    with open(file_name) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+
+            message = json.loads(line)
+            # Default of get() would be evaluated even when timestamp is present
+            if "timestamp" in message:
+                sample_time = message["timestamp"]
+            else:
+                sample_time = message["uptime"]["value"]
+            values = []
+            valid = True
+            for key in (POWER_KEY, TEMPERATURE_KEY, WEIGHT_KEY):
+                measurement = message.get(key)
+                if not measurement or measurement["quality"] != QUALITY_GOOD:
+                    valid = False
+                    values.append(0.0)
+                else:
+                    values.append(float(measurement["value"]))
+            valid = valid and values[2] > 0
+
+            rows.append((float(sample_time), *values, valid))
+            if len(rows) >= chunk_size:
+                yield make_chunk()
+                rows = []
+
+    if rows:
+        yield make_chunk()
+
+
+def _concatenate(history, chunk):
+    if history is None:
+        return chunk
+    return {key: np.concatenate((history[key], chunk[key])) for key in chunk}
+
+
+class _RegressionStream:
+    """
+    Accumulates X'X, X'y, y'y for every candidate delay (in samples) over a
+    stream of sample chunks.
+    """
+
+    def __init__(self, order, delays, max_gap, power_scale):
+        self.order = order
+        self.delays = np.asarray(delays)
+        self.max_gap = max_gap
+        self.power_scale = power_scale
+
+        features = 3 if order == 1 else 4
+        self.xtx = np.zeros((len(delays), features, features))
+        self.xty = np.zeros((len(delays), features))
+        self.ztx = np.zeros((len(delays), features, features))
+        self.zty = np.zeros((len(delays), features))
+        self.yty = np.zeros(len(delays))
+        self.sum_y = np.zeros(len(delays))
+        self.count = np.zeros(len(delays), dtype=np.int64)
+        self.sample_intervals = []
+
+        self._history = None
+        self._first_row = 0
+
+    def rows(self, data, delay):
+        """Regression rows of `data` for rows k in [first_row, len - 2]."""
+        t = data["time"]
+        u = data["power"] * self.power_scale
+        temperature = data["temperature"]
+        mass = data["mass"]
+        valid = data["valid"]
+
+        k = np.arange(self._first_row, len(t) - 1)
+        dt = t[k + 1] - t[k]
+        mask = valid[k] & valid[k + 1] & (dt > 0) & (dt <= self.max_gap)
+        mask &= k - delay >= 0
+        if self.order == 2:
+            mask &= k - 3 >= 0
+        k = k[mask]
+        dt = dt[mask]
+        if not len(k):
+            return k, None, None, None
+
+        u_delayed = u[k - delay]
+        mask = valid[k - delay]
+        if self.order == 2:
+            lagged_dt = np.stack([t[k - j] - t[k - j - 1] for j in range(3)])
+            mask &= valid[k - 1] & valid[k - 2] & valid[k - 3]
+            mask &= np.all((lagged_dt > 0) & (lagged_dt <= self.max_gap), axis=0)
+        k, dt, u_delayed = k[mask], dt[mask], u_delayed[mask]
+        if not len(k):
+            return k, None, None, None
+
+        if self.order == 1:
+            y = mass[k] * (temperature[k + 1] - temperature[k]) / dt
+            x = np.column_stack((u_delayed, temperature[k], np.ones(len(k))))
+            return k, x, y, x
+
+        y = mass[k] * (temperature[k + 1] - temperature[k])
+        x = np.column_stack(
+            (
+                mass[k] * (temperature[k] - temperature[k - 1]),
+                u_delayed * dt,
+                temperature[k] * dt,
+                dt,
+            )
+        )
+        # Temperature differences are dominated by sensor noise, least squares
+        # would be biased. Instruments lagged by two samples are not
+        # correlated with noise of samples used in the row.
+        z = np.column_stack(
+            (
+                mass[k] * (temperature[k - 2] - temperature[k - 3]),
+                u_delayed * dt,
+                temperature[k - 2] * dt,
+                dt,
+            )
+        )
+        return k, x, y, z
+
+    def extend(self, chunk):
+        """Prepends samples kept from previous chunk, delayed rows need them."""
+        return _concatenate(self._history, chunk)
+
+    def keep_history(self, data):
+        history_size = int(self.delays.max()) + 4
+        self._history = {key: value[-history_size:] for key, value in data.items()}
+        self._first_row = len(self._history["time"]) - 1
+
+    def add_chunk(self, chunk):
+        data = self.extend(chunk)
+
+        for i, delay in enumerate(self.delays):
+            k, x, y, z = self.rows(data, delay)
+            if x is None:
+                continue
+            self.xtx[i] += x.T @ x
+            self.xty[i] += x.T @ y
+            self.ztx[i] += z.T @ x
+            self.zty[i] += z.T @ y
+            self.yty[i] += y @ y
+            self.sum_y[i] += y.sum()
+            self.count[i] += len(y)
+
+        intervals = np.diff(data["time"][self._first_row :])
+        if np.any(intervals > 0):
+            self.sample_intervals.append(np.median(intervals[intervals > 0]))
+
+        self.keep_history(data)
+
+    def solve(self):
+        """Returns (delay index, coefficients, r2) of the best fitting delay."""
+        best = None
+        for i in range(len(self.delays)):
+            if self.count[i] <= self.xtx.shape[1]:
+                continue
+            coefficients, *_ = np.linalg.lstsq(self.ztx[i], self.zty[i], rcond=None)
+            residual = (
+                self.yty[i]
+                - 2 * coefficients @ self.xty[i]
+                + coefficients @ self.xtx[i] @ coefficients
+            )
+            total = self.yty[i] - self.sum_y[i] ** 2 / self.count[i]
+            r2 = 1 - residual / total if total > 0 else 0.0
+            if best is None or r2 > best[2]:
+                best = (i, coefficients, r2)
+
+        if best is None:
+            raise ValueError("Not enough valid samples for identification")
+        return best
+
+    @property
+    def sample_interval(self):
+        return float(np.median(self.sample_intervals))
+
+
+def _make_model(order, coefficients, dead_time, mass, sample_interval):
+    if order == 1:
+        heat_gain, minus_heat_loss, intercept = coefficients
+        heat_loss = -minus_heat_loss
+        if heat_loss <= 0:
+            raise ValueError(
+                "Fitted heat loss is not positive, recording is not exciting enough"
+            )
+        if mass / heat_loss < sample_interval:
+            raise ValueError(
+                "Fitted time constant is shorter than sample interval, recording is too noisy"
+            )
+        return ThermalModel(
+            heat_gain, heat_loss, mass, dead_time, intercept / heat_loss
+        )
+
+    alpha, beta, gamma, delta = coefficients
+    if gamma >= 0:
+        raise ValueError(
+            "Fitted heat loss is not positive, recording is not exciting enough"
+        )
+
+    # T[k+1] = a1 * T[k] + a2 * T[k-1] + ... for given mass and sample interval
+    a1 = 1 + alpha + gamma * sample_interval / mass
+    a2 = -alpha
+    poles = np.roots((1, -a1, -a2))
+    if np.any(np.iscomplex(poles)) or np.any((poles.real <= 0) | (poles.real >= 1)):
+        raise ValueError("Fitted second order model is not overdamped and stable")
+
+    wall_time_constant, time_constant = sorted(-sample_interval / np.log(poles.real))
+    if wall_time_constant < sample_interval:
+        raise ValueError(
+            "Fitted time constant is shorter than sample interval, recording is too noisy"
+        )
+    return SecondOrderModel(
+        beta / -gamma,
+        float(time_constant),
+        float(wall_time_constant),
+        dead_time,
+        delta / -gamma,
+    )
+
+
+def _prediction_rmse(file_name, model, stream, delay, chunk_size):
+    """One step ahead temperature prediction error, °C."""
+    check = _RegressionStream(stream.order, [delay], stream.max_gap, stream.power_scale)
+    squared_error = 0.0
+    count = 0
+
+    for chunk in read_samples(file_name, chunk_size):
+        data = check.extend(chunk)
+        k, x, y, _ = check.rows(data, delay)
+        if x is not None:
+            predicted = x @ model
+            mass = data["mass"][k]
+            if stream.order == 1:
+                dt = data["time"][k + 1] - data["time"][k]
+                error = (y - predicted) * dt / mass
+            else:
+                error = (y - predicted) / mass
+            squared_error += error @ error
+            count += len(error)
+
+        check.keep_history(data)
+
+    return float(np.sqrt(squared_error / count)) if count else None
+
+
+def identify(
+    file_name,
+    order=1,
+    max_dead_time=300,
+    power_limit_percent=100,
+    mass=None,
+    chunk_size=10000,
+    max_gap_factor=3,
+):
+    """
+    Fits plant model to recording. Returns (model, report), model uses `mass`
+    (kg) or median mass of the recording. Raises ValueError when recording
+    has no valid samples or fitted model does not explain it (R² <= 0 or time
+    constant shorter than sample interval).
+    """
+    # Sample interval is estimated on the first chunk to build delay grid
+    first_chunk = next(read_samples(file_name, chunk_size))
+    intervals = np.diff(first_chunk["time"])
+    if not np.any(intervals > 0):
+        raise ValueError("Recording has no increasing sample times")
+    sample_interval = float(np.median(intervals[intervals > 0]))
+    delays = np.arange(int(max_dead_time / sample_interval) + 1)
+
+    stream = _RegressionStream(
+        order, delays, sample_interval * max_gap_factor, power_limit_percent / 100
+    )
+    masses = []
+    for chunk in read_samples(file_name, chunk_size):
+        stream.add_chunk(chunk)
+        if np.any(chunk["valid"]):
+            masses.append(np.median(chunk["mass"][chunk["valid"]]))
+
+    delay_index, coefficients, r2 = stream.solve()
+    if r2 <= 0:
+        raise ValueError(
+            f"Fitted model does not explain recording (R² = {r2:.2f}), "
+            "recording is too noisy or not exciting enough"
+        )
+    delay = int(delays[delay_index])
+    sample_interval = stream.sample_interval
+    if mass is None:
+        mass = float(np.median(masses))
+
+    model = _make_model(
+        order, coefficients, delay * sample_interval, mass, sample_interval
+    )
+    report = {
+        "order": order,
+        "samples": int(stream.count[delay_index]),
+        "sample_interval": sample_interval,
+        "dead_time": delay * sample_interval,
+        "coefficients": coefficients.tolist(),
+        "r2": float(r2),
+        "rmse_temperature": _prediction_rmse(
+            file_name, coefficients, stream, delay, chunk_size
+        ),
+    }
+    return model, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("file_name", help="JSON lines file with sensors messages")
+    parser.add_argument("--order", type=int, choices=(1, 2), default=1)
+    parser.add_argument("--max-dead-time", type=float, default=300, help="s")
+    parser.add_argument(
+        "--output-max-power",
+        type=float,
+        default=70,
+        help="output_max_power parameter during recording, %%",
+    )
+    parser.add_argument("--mass", type=float, help="Model mass, kg")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--output", help="Plant model JSON file")
+    args = parser.parse_args()
+
+    try:
+        model, report = identify(
+            args.file_name,
+            order=args.order,
+            max_dead_time=args.max_dead_time,
+            power_limit_percent=args.output_max_power,
+            mass=args.mass,
+            chunk_size=args.chunk_size,
+        )
+    except ValueError as e:
+        parser.exit(1, f"Model is not identified: {e}\n")
+    if args.output:
+        save_model(model, args.output)
+
+    print(json.dumps({"model": model.to_dict(), "fit": report}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+"""
+Load generator for broker, dashboard and recorder capacity testing.
+
+Simulates N tanks in one asyncio process. Every virtual device has its own
+MQTT connection and speaks the firmware topic protocol: retained
+`{device}/from_device/parameters` on connect, `/from_device/sensors` every
+interval, `/from_device/pong` for pings and `/from_device/status` replies for
+parameter changes, commands with request envelope get replies echoing it.
+Observer connection (dashboard stand-in) subscribes to all devices, pings them
+and measures latencies:
+
+- sensors latency - from publishing to receiving by observer, messages are
+  matched by device name and uptime value;
+- ping latency - round trip from ping to pong, matched by request id.
+
+Without --host bundled in-process broker stand-in is used, so no external
+services are needed.
+
+Example:
+
+    $ uv run load_generator.py --devices 500 --interval 5 --duration 60
+    $ uv run load_generator.py --host 192.168.1.10 --devices 200 --record fleet.db
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import numpy as np
+from mqtt import Broker, MQTTClient
+from recorder import Recorder, Storage
+
+# firmware/parameter_manager.py defaults
+DEFAULT_PARAMETERS = {
+    "mode": 0,
+    "output_max_power": 70,
+    "output_pwm_interval_ms": 1000,
+    "bottom_temperature_ah": 90,
+    "bottom_temperature_sp": 70,
+    "top_temperature_ah": 80,
+    "weight_sp": 5000,
+    "weight_sp_lead_time": 0,
+    "pid_p": 1,
+    "pid_i": 10,
+    "pid_d": 0,
+    "pid_gain_schedule": [],
+    "weight_calibration_points": [
+        {"raw_value": 0, "calibrated_value": 0},
+        {"raw_value": 1, "calibrated_value": 1},
+    ],
+    "bottom_temperature_calibration_points": [
+        {"raw_value": 0, "calibrated_value": 0},
+        {"raw_value": 1, "calibrated_value": 1},
+    ],
+    "top_temperature_calibration_points": [
+        {"raw_value": 0, "calibrated_value": 0},
+        {"raw_value": 1, "calibrated_value": 1},
+    ],
+}
+
+NUMERIC_PARAMETERS = (
+    "mode",
+    "output_max_power",
+    "output_pwm_interval_ms",
+    "bottom_temperature_ah",
+    "bottom_temperature_sp",
+    "top_temperature_ah",
+    "weight_sp",
+    "weight_sp_lead_time",
+    "pid_p",
+    "pid_i",
+    "pid_d",
+)
+
+
+def parse_command_envelope(payload):
+    """Returns (bare payload, request) as firmware main.py does."""
+    if not payload.startswith(b"{"):
+        return payload, None
+    try:
+        envelope = json.loads(payload)
+    except ValueError:
+        return payload, None
+    if "request_id" not in envelope:
+        return payload, None
+
+    value = envelope.get("value", "")
+    if not isinstance(value, str):
+        value = json.dumps(value) if isinstance(value, (list, dict)) else str(value)
+    return value.encode(), {
+        "request_id": envelope["request_id"],
+        "client_time": envelope.get("client_time"),
+        "device_ticks_ms": int(time.monotonic() * 1000),
+        "handling_us": 0,
+    }
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values) * 1000
+    p50, p90, p99 = np.percentile(values, (50, 90, 99))
+    return {
+        "count": len(values),
+        "p50_ms": float(p50),
+        "p90_ms": float(p90),
+        "p99_ms": float(p99),
+        "max_ms": float(values.max()),
+    }
+
+
+class VirtualDevice:
+
+    def __init__(self, name, interval=5.0):
+        self.name = name
+        self.interval = interval
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        self.client = MQTTClient(name)
+        self.published = 0
+
+        self._started = None
+        self._temperature = random.uniform(15, 25)
+        self._weight = random.uniform(5000, 9000)
+
+    def output_topic(self, path):
+        return f"{self.name}/from_device{path}"
+
+    def input_topic(self, path):
+        return f"{self.name}/to_device{path}"
+
+    def sensors_payload(self, uptime):
+        self._temperature += random.uniform(-0.05, 0.1)
+        self._weight -= random.uniform(0, 0.5)
+        temperature = round(self._temperature / 0.0625) * 0.0625
+        return json.dumps(
+            {
+                "heater_output_power": {"value": 0, "quality": 0},
+                "top_temperature": {"value": temperature - 1, "quality": 0},
+                "top_temperature_calibrated": {"value": temperature - 1, "quality": 0},
+                "bottom_temperature": {"value": temperature, "quality": 0},
+                "bottom_temperature_calibrated": {"value": temperature, "quality": 0},
+                "weight": {"value": round(self._weight * 193), "quality": 0},
+                "weight_calibrated": {"value": self._weight, "quality": 0},
+                "ip_address": {"value": "127.0.0.1", "quality": 0},
+                "free_memory": {"value": 97744, "quality": 0},
+                "uptime": {"value": uptime, "quality": 0},
+            }
+        )
+
+    def publish(self, path, payload, retain=False):
+        self.client.publish(self.output_topic(path), payload, retain)
+        self.published += 1
+
+    def send_status(self, status_code=200, message="ok", request=None):
+        status = {"status": status_code, "message": message}
+        if request:
+            status.update(request)
+        self.publish("/status", json.dumps(status))
+
+    async def run(self, host, port, stop, on_sensors_sent):
+        await self.client.connect(host, port)
+        await self.client.subscribe(self.input_topic("/#"))
+        self.publish("/parameters", json.dumps(self.parameters), retain=True)
+        listener = asyncio.create_task(self._listen())
+
+        self._started = time.monotonic()
+        # Random phase, real devices are not powered on at the same moment
+        next_publish = self._started + random.uniform(0, self.interval)
+        try:
+            while not stop.is_set():
+                try:
+                    await asyncio.wait_for(
+                        stop.wait(), max(0, next_publish - time.monotonic())
+                    )
+                    break
+                except TimeoutError:
+                    pass
+
+                uptime = round(time.monotonic() - self._started, 3)
+                on_sensors_sent(self.name, uptime)
+                self.publish("/sensors", self.sensors_payload(uptime))
+                await self.client.drain()
+                next_publish += self.interval
+        finally:
+            listener.cancel()
+            await self.client.close()
+
+    async def _listen(self):
+        prefix = self.input_topic("")
+        async for topic, payload in self.client.messages():
+            path = topic[len(prefix) :]
+            payload, request = parse_command_envelope(payload)
+            if path == "/ping":
+                self.publish("/pong", json.dumps(request) if request else "")
+            elif path.startswith("/parameters/"):
+                name = path[len("/parameters/") :]
+                try:
+                    if name not in NUMERIC_PARAMETERS:
+                        raise ValueError(name)
+                    self.parameters[name] = float(payload)
+                except ValueError:
+                    self.send_status(
+                        400, "Bad parameter name or parameter value", request
+                    )
+                else:
+                    self.publish(
+                        "/parameters", json.dumps(self.parameters), retain=True
+                    )
+                    self.send_status(request=request)
+            elif path == "/heater_power":
+                if self.parameters["mode"] == 2:
+                    self.send_status(request=request)
+                else:
+                    self.send_status(400, "Wrong device mode", request)
+            await self.client.drain()
+
+
+class Observer:
+    """Dashboard stand-in, measures sensors and ping latencies."""
+
+    def __init__(self):
+        self.client = MQTTClient("load_generator_observer")
+        self.received = 0
+        self.sensor_latencies = []
+        self.ping_latencies = []
+        self._sent = {}
+        self._pings = {}  # request id -> sent time
+        self._request_id = 0
+
+    def sensors_sent(self, device, uptime):
+        self._sent[(device, uptime)] = time.perf_counter()
+
+    @property
+    def lost(self):
+        return len(self._sent)
+
+    async def listen(self):
+        await self.client.subscribe("+/from_device/#")
+        async for topic, payload in self.client.messages():
+            received = time.perf_counter()
+            self.received += 1
+            device, _, kind = topic.rpartition("/from_device/")
+            if kind == "sensors":
+                uptime = json.loads(payload)["uptime"]["value"]
+                if (sent := self._sent.pop((device, uptime), None)) is not None:
+                    self.sensor_latencies.append(received - sent)
+            elif kind == "pong" and payload:
+                request_id = json.loads(payload)["request_id"]
+                if (sent := self._pings.pop(request_id, None)) is not None:
+                    self.ping_latencies.append(received - sent)
+
+    async def ping(self, devices, interval, stop):
+        while not stop.is_set():
+            for device in devices:
+                self._request_id += 1
+                self._pings[self._request_id] = time.perf_counter()
+                self.client.publish(
+                    f"{device}/to_device/ping",
+                    json.dumps(
+                        {"request_id": self._request_id, "client_time": time.time()}
+                    ),
+                )
+            await self.client.drain()
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except TimeoutError:
+                pass
+
+
+async def run_load(
+    devices=100,
+    interval=5.0,
+    duration=60.0,
+    ping_interval=10.0,
+    host=None,
+    port=1883,
+    record=None,
+    prefix="tank",
+):
+    broker = None
+    if not host:
+        broker = Broker()
+        host, port = "127.0.0.1", await broker.start()
+
+    observer = Observer()
+    await observer.client.connect(host, port)
+    listener = asyncio.create_task(observer.listen())
+
+    recorder = None
+    if record:
+        storage = Storage(record)
+        recorder_client = MQTTClient("load_generator_recorder")
+        await recorder_client.connect(host, port)
+        recorder = Recorder(storage)
+        recorder_task = asyncio.create_task(recorder.run(recorder_client))
+
+    # Subscriptions are processed before devices start
+    await asyncio.sleep(0.1)
+
+    stop = asyncio.Event()
+    virtual_devices = [VirtualDevice(f"{prefix}_{i}", interval) for i in range(devices)]
+    started = time.perf_counter()
+    device_tasks = [
+        asyncio.create_task(d.run(host, port, stop, observer.sensors_sent))
+        for d in virtual_devices
+    ]
+    pinger = asyncio.create_task(
+        observer.ping([d.name for d in virtual_devices], ping_interval, stop)
+    )
+
+    await asyncio.sleep(duration)
+    stop.set()
+    await asyncio.gather(*device_tasks, pinger)
+    elapsed = time.perf_counter() - started
+    # Messages in flight
+    await asyncio.sleep(1)
+
+    listener.cancel()
+    await observer.client.close()
+    report = {
+        "devices": devices,
+        "seconds": elapsed,
+        "published": sum(d.published for d in virtual_devices),
+        "published_per_second": sum(d.published for d in virtual_devices) / elapsed,
+        "received_by_observer": observer.received,
+        "lost_sensors_messages": observer.lost,
+        "sensors_latency": percentiles(observer.sensor_latencies),
+        "ping_latency": percentiles(observer.ping_latencies),
+    }
+
+    if recorder:
+        await recorder_client.close()
+        await recorder_task
+        storage.close()
+        report["recorder"] = recorder.stats()
+    if broker:
+        await broker.stop()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument(
+        "--interval", type=float, default=5, help="Sensors publish interval, s"
+    )
+    parser.add_argument("--duration", type=float, default=60, help="s")
+    parser.add_argument("--ping-interval", type=float, default=10, help="s")
+    parser.add_argument(
+        "--host", help="Broker host, bundled broker stand-in if omitted"
+    )
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--prefix", default="tank", help="Virtual device names prefix")
+    parser.add_argument(
+        "--record", metavar="DATABASE", help="Run recorder.py into database"
+    )
+    args = parser.parse_args()
+
+    report = asyncio.run(
+        run_load(
+            args.devices,
+            args.interval,
+            args.duration,
+            args.ping_interval,
+            args.host,
+            args.port,
+            args.record,
+            args.prefix,
+        )
+    )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Minimal asyncio MQTT 3.1.1 client and in-process broker, QoS 0 only.
+
+Broker is a stand-in for tests and benchmarks of host tools: it keeps
+retained messages and routes publications to matching subscriptions
+(`+` and `#` wildcards), nothing else.
+"""
+
+import asyncio
+import struct
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+SUBSCRIBE = 8
+SUBACK = 9
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+class MQTTError(Exception):
+    pass
+
+
+def _encode_string(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return struct.pack("!H", len(value)) + value
+
+
+def _decode_string(data, offset):
+    (length,) = struct.unpack_from("!H", data, offset)
+    start = offset + 2
+    return data[start : start + length], start + length
+
+
+def encode_packet(packet_type, flags, body):
+    header = bytearray([packet_type << 4 | flags])
+    length = len(body)
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes(header) + body
+
+
+async def read_packet(reader):
+    """Returns (packet_type, flags, body), raises IncompleteReadError on EOF."""
+    first = (await reader.readexactly(1))[0]
+    length = 0
+    shift = 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+        if shift > 21:
+            raise MQTTError("Malformed remaining length")
+    body = await reader.readexactly(length) if length else b""
+    return first >> 4, first & 0x0F, body
+
+
+def publish_packet(topic, payload, retain=False):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return encode_packet(PUBLISH, 1 if retain else 0, _encode_string(topic) + payload)
+
+
+def parse_publish(flags, body):
+    """Returns (topic, payload, retain) of QoS 0 or 1 publish packet."""
+    topic, offset = _decode_string(body, 0)
+    if (flags >> 1) & 0x03:
+        offset += 2  # packet identifier
+    return topic.decode(), body[offset:], bool(flags & 0x01)
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class MQTTClient:
+    """
+    Connection to broker. Received publications are read with
+    `async for topic, payload in client.messages()`.
+    """
+
+    def __init__(self, client_id, keepalive=60):
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self._reader = None
+        self._writer = None
+        self._packet_id = 0
+        self._ping_task = None
+
+    async def connect(self, host="127.0.0.1", port=1883, username=None, password=None):
+        self._reader, self._writer = await asyncio.open_connection(host, port)
+
+        flags = 0x02  # clean session
+        payload = _encode_string(self.client_id)
+        if username:
+            flags |= 0x80
+            payload += _encode_string(username)
+            if password:
+                flags |= 0x40
+                payload += _encode_string(password)
+        body = (
+            _encode_string("MQTT")
+            + bytes([4, flags])
+            + struct.pack("!H", self.keepalive)
+            + payload
+        )
+        self._writer.write(encode_packet(CONNECT, 0, body))
+        await self._writer.drain()
+
+        packet_type, _, body = await read_packet(self._reader)
+        if packet_type != CONNACK or body[1] != 0:
+            raise MQTTError(f"Connection refused, code {body[1] if body else None}")
+
+        if self.keepalive:
+            self._ping_task = asyncio.create_task(self._ping())
+
+    async def _ping(self):
+        while True:
+            await asyncio.sleep(self.keepalive / 2)
+            self._writer.write(encode_packet(PINGREQ, 0, b""))
+
+    async def subscribe(self, *topic_filters):
+        self._packet_id = self._packet_id % 0xFFFF + 1
+        body = struct.pack("!H", self._packet_id)
+        for topic_filter in topic_filters:
+            body += _encode_string(topic_filter) + b"\x00"
+        self._writer.write(encode_packet(SUBSCRIBE, 0x02, body))
+        await self._writer.drain()
+
+    def publish(self, topic, payload, retain=False):
+        """Writes to the socket buffer, call `drain()` for flow control."""
+        self._writer.write(publish_packet(topic, payload, retain))
+
+    async def drain(self):
+        await self._writer.drain()
+
+    async def messages(self):
+        """Yields (topic, payload) until connection is closed."""
+        try:
+            while True:
+                packet_type, flags, body = await read_packet(self._reader)
+                if packet_type == PUBLISH:
+                    topic, payload, _ = parse_publish(flags, body)
+                    yield topic, payload
+        except asyncio.IncompleteReadError:
+            return
+
+    async def close(self):
+        if self._ping_task:
+            self._ping_task.cancel()
+        if self._writer:
+            try:
+                self._writer.write(encode_packet(DISCONNECT, 0, b""))
+                self._writer.close()
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+class Broker:
+
+    def __init__(self):
+        self.retained = {}
+        self.published = 0
+        self._subscriptions = {}  # writer -> list of filters
+        # Filters indexed by literal first level, e.g. "tank_1/to_device/#",
+        # so routing does not scan subscriptions of every device
+        self._by_first_level = {}  # level -> list of (writer, filter)
+        self._wildcard_first_level = []  # (writer, filter)
+        self._server = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Starts listening, returns port (random free port by default)."""
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        for writer in list(self._subscriptions):
+            writer.close()
+        await self._server.wait_closed()
+
+    async def _handle_client(self, reader, writer):
+        self._subscriptions[writer] = []
+        try:
+            while True:
+                packet_type, flags, body = await read_packet(reader)
+                if packet_type == CONNECT:
+                    writer.write(encode_packet(CONNACK, 0, b"\x00\x00"))
+                elif packet_type == PUBLISH:
+                    await self._route(*parse_publish(flags, body))
+                elif packet_type == SUBSCRIBE:
+                    await self._subscribe(writer, body)
+                elif packet_type == PINGREQ:
+                    writer.write(encode_packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._unsubscribe_all(writer)
+            writer.close()
+
+    async def _subscribe(self, writer, body):
+        packet_id = body[:2]
+        offset = 2
+        filters = []
+        while offset < len(body):
+            topic_filter, offset = _decode_string(body, offset)
+            offset += 1  # requested QoS
+            filters.append(topic_filter.decode())
+        self._subscriptions[writer].extend(filters)
+        for topic_filter in filters:
+            first_level = topic_filter.split("/", 1)[0]
+            if first_level in ("+", "#"):
+                self._wildcard_first_level.append((writer, topic_filter))
+            else:
+                self._by_first_level.setdefault(first_level, []).append(
+                    (writer, topic_filter)
+                )
+        writer.write(encode_packet(SUBACK, 0, packet_id + b"\x00" * len(filters)))
+
+        for topic_filter in filters:
+            first_level = topic_filter.split("/", 1)[0]
+            prefix = "" if first_level in ("+", "#") else first_level + "/"
+            for topic, payload in self.retained.items():
+                if topic.startswith(prefix) and topic_matches(topic_filter, topic):
+                    writer.write(publish_packet(topic, payload, retain=True))
+        await writer.drain()
+
+    def _unsubscribe_all(self, writer):
+        for topic_filter in self._subscriptions.pop(writer):
+            first_level = topic_filter.split("/", 1)[0]
+            if first_level not in ("+", "#"):
+                entries = self._by_first_level[first_level]
+                entries.remove((writer, topic_filter))
+                if not entries:
+                    del self._by_first_level[first_level]
+        self._wildcard_first_level = [
+            entry for entry in self._wildcard_first_level if entry[0] is not writer
+        ]
+
+    async def _route(self, topic, payload, retain):
+        self.published += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+
+        packet = publish_packet(topic, payload)
+        candidates = self._by_first_level.get(topic.split("/", 1)[0], [])
+        receivers = []
+        for writer, topic_filter in candidates + self._wildcard_first_level:
+            if writer not in receivers and topic_matches(topic_filter, topic):
+                receivers.append(writer)
+        for writer in receivers:
+            writer.write(packet)
+        # Slow subscribers slow down publishers, as with TCP to a real broker
+        for writer in receivers:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
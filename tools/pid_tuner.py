@@ -0,0 +1,231 @@
+"""
+Offline PID tuning for the smart tank temperature regulator.
+
+Thousands of candidate gain sets are simulated at once against a plant model,
+every candidate is a column of the same arrays. Controller, heater and sensor
+behaviour mirrors the firmware (PID.py, heater.py, main.handle_auto_mode), so
+Pareto-optimal gains found here can be published to the device as is.
+
+Example:
+
+    $ uv run pid_tuner.py --model model.json --setpoint 70 --device smart_tank
+"""
+
+import argparse
+import json
+
+import numpy as np
+from plant import FOPDTModel, load_model
+
+# firmware/heater.py
+PERIOD_FOR_50HZ = 20
+
+
+def heater_output(power_percent, power_limit_percent, pwm_interval_ms):
+    """Effective heater power in percents of rated power, see Heater.set_power()."""
+    pulse_width = pwm_interval_ms * power_percent * power_limit_percent * 0.0001
+    pulse_width = np.where(pulse_width < PERIOD_FOR_50HZ, 0, pulse_width)
+    pulse_width = np.where(
+        pulse_width > pwm_interval_ms - PERIOD_FOR_50HZ, pwm_interval_ms, pulse_width
+    )
+    return pulse_width * 100 / pwm_interval_ms
+
+
+class VectorPID:
+    """
+    PID.__call__() for many gain sets: proportional on error, derivative on
+    measurement, integral and output clamped to output limits.
+    """
+
+    def __init__(self, kp, ki, kd, setpoint, output_limits=(0, 100), last_output=0):
+        self.kp = np.asarray(kp, dtype=np.float64)
+        self.ki = np.asarray(ki, dtype=np.float64)
+        self.kd = np.asarray(kd, dtype=np.float64)
+        self.setpoint = setpoint
+        self.output_limits = output_limits
+
+        # PID.set_auto_mode(True, last_output=...)
+        self.integral = np.clip(
+            np.full(self.kp.shape, last_output, dtype=np.float64), *output_limits
+        )
+        self.last_input = None
+
+    def __call__(self, input_, dt: float):
+        dt = dt or 1e-16
+        error = self.setpoint - input_
+        d_input = input_ - self.last_input if self.last_input is not None else 0
+
+        proportional = self.kp * error
+        self.integral = np.clip(
+            self.integral + self.ki * error * dt, *self.output_limits
+        )
+        derivative = -self.kd * d_input / dt
+
+        self.last_input = input_
+        return np.clip(proportional + self.integral + derivative, *self.output_limits)
+
+
+def simulate(
+    model,
+    kp,
+    ki,
+    kd,
+    setpoint: float,
+    initial_temperature: float,
+    duration: float,
+    sample_time: float = 5,
+    read_interval: float = 1,
+    output_limits=(0, 100),
+    power_limit_percent: float = 70,
+    pwm_interval_ms: int = 1000,
+    heater_rated_power: float = 2000,
+    sensor_resolution: float = 0.0625,
+    settling_band: float = 0.5,
+):
+    """
+    Simulates regulator with every gain set and returns metrics arrays:
+    overshoot (°C), settling time (s) and heater energy (Wh).
+    """
+    n = len(kp)
+    state = model.initial_state(n, initial_temperature)
+    pid = VectorPID(kp, ki, kd, setpoint, output_limits)
+
+    delay_steps = int(round(model.dead_time / read_interval))
+    delay_line = np.zeros((delay_steps + 1, n))
+
+    power = np.zeros(n)
+    max_temperature = np.full(n, initial_temperature, dtype=np.float64)
+    settling_time = np.zeros(n)
+    energy = np.zeros(n)
+    last_update_time = None
+
+    steps = int(duration / read_interval)
+    for step in range(steps):
+        current_time = step * read_interval
+        temperature = model.temperature(state)
+        measured = np.round(temperature / sensor_resolution) * sensor_resolution
+
+        if last_update_time is None or current_time - last_update_time >= sample_time:
+            dt = 0 if last_update_time is None else current_time - last_update_time
+            output = pid(measured, dt)
+            # handle_auto_mode() sets power only for non zero output
+            power = np.where(output != 0, np.round(output), power)
+            last_update_time = current_time
+
+        effective_power = heater_output(power, power_limit_percent, pwm_interval_ms)
+        delay_line[step % (delay_steps + 1)] = effective_power
+        applied_power = delay_line[(step + 1) % (delay_steps + 1)]
+
+        state = model.step(state, applied_power, read_interval)
+        temperature = model.temperature(state)
+
+        np.maximum(max_temperature, temperature, out=max_temperature)
+        outside_band = np.abs(temperature - setpoint) > settling_band
+        settling_time[outside_band] = current_time + read_interval
+        energy += effective_power * (heater_rated_power * read_interval / 360000)
+
+    overshoot = np.maximum(max_temperature - setpoint, 0)
+    return overshoot, settling_time, energy
+
+
+def pareto_front(objectives, chunk_size=256):
+    """Indexes of non-dominated rows of `objectives` (all objectives are minimized)."""
+    objectives = np.asarray(objectives)
+    non_dominated = np.ones(len(objectives), dtype=bool)
+
+    for start in range(0, len(objectives), chunk_size):
+        chunk = objectives[start : start + chunk_size, None, :]
+        not_worse = np.all(objectives[None, :, :] <= chunk, axis=2)
+        better = np.any(objectives[None, :, :] < chunk, axis=2)
+        non_dominated[start : start + chunk_size] = ~np.any(not_worse & better, axis=1)
+
+    return np.flatnonzero(non_dominated)
+
+
+def make_candidates(count, kp_range, ki_range, kd_range, seed=None):
+    """Log-uniform Kp and Ki, uniform Kd (Kd range may start from 0)."""
+    rng = np.random.default_rng(seed)
+    kp = np.exp(rng.uniform(*np.log(kp_range), count))
+    ki = np.exp(rng.uniform(*np.log(ki_range), count))
+    kd = rng.uniform(*kd_range, count)
+    return kp, ki, kd
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    model_group = parser.add_argument_group("plant model")
+    model_group.add_argument("--model", help="Plant model JSON file")
+    model_group.add_argument("--gain", type=float, default=1.2, help="°C per %%")
+    model_group.add_argument("--time-constant", type=float, default=1800, help="s")
+    model_group.add_argument("--dead-time", type=float, default=60, help="s")
+    model_group.add_argument("--ambient-temperature", type=float, default=20)
+
+    parser.add_argument("--setpoint", type=float, default=70)
+    parser.add_argument("--initial-temperature", type=float, default=20)
+    parser.add_argument("--duration", type=float, default=4 * 3600, help="s")
+    parser.add_argument("--sample-time", type=float, default=5, help="s")
+    parser.add_argument("--output-max-power", type=float, default=70, help="%%")
+    parser.add_argument("--output-pwm-interval-ms", type=int, default=1000)
+    parser.add_argument("--heater-rated-power", type=float, default=2000, help="W")
+    parser.add_argument("--settling-band", type=float, default=0.5, help="°C")
+
+    parser.add_argument("--candidates", type=int, default=4096)
+    parser.add_argument("--kp-range", type=float, nargs=2, default=(0.1, 20))
+    parser.add_argument("--ki-range", type=float, nargs=2, default=(1e-4, 1))
+    parser.add_argument("--kd-range", type=float, nargs=2, default=(0, 200))
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--device", help="Device name, adds MQTT topics to publish gains to"
+    )
+    args = parser.parse_args()
+
+    if args.model:
+        model = load_model(args.model)
+    else:
+        model = FOPDTModel(
+            args.gain, args.time_constant, args.dead_time, args.ambient_temperature
+        )
+
+    kp, ki, kd = make_candidates(
+        args.candidates, args.kp_range, args.ki_range, args.kd_range, args.seed
+    )
+    overshoot, settling_time, energy = simulate(
+        model,
+        kp,
+        ki,
+        kd,
+        args.setpoint,
+        args.initial_temperature,
+        args.duration,
+        sample_time=args.sample_time,
+        power_limit_percent=args.output_max_power,
+        pwm_interval_ms=args.output_pwm_interval_ms,
+        heater_rated_power=args.heater_rated_power,
+        settling_band=args.settling_band,
+    )
+
+    front = pareto_front(np.column_stack((overshoot, settling_time, energy)))
+    front = front[np.argsort(settling_time[front])]
+
+    results = []
+    for i in front:
+        result = {
+            "pid_p": float(kp[i]),
+            "pid_i": float(ki[i]),
+            "pid_d": float(kd[i]),
+            "overshoot": float(overshoot[i]),
+            "settling_time": float(settling_time[i]),
+            "energy_wh": float(energy[i]),
+        }
+        if args.device:
+            result["topics"] = {
+                f"{args.device}/to_device/parameters/{name}": result[name]
+                for name in ("pid_p", "pid_i", "pid_d")
+            }
+        results.append(result)
+
+    print(json.dumps({"model": model.to_dict(), "pareto_front": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import json
+
+import numpy as np
+
+
+class FOPDTModel:
+    """
+    First order plus dead time thermal model:
+
+        time_constant * dT/dt = -(T - ambient_temperature) + gain * u(t - dead_time)
+
+    `u` is heater power in percents of rated heater power, `gain` is steady
+    state temperature rise per percent, times are in seconds.
+    """
+
+    type = "fopdt"
+
+    def __init__(
+        self,
+        gain: float,
+        time_constant: float,
+        dead_time: float = 0.0,
+        ambient_temperature: float = 20.0,
+    ):
+        self.gain = gain
+        self.time_constant = time_constant
+        self.dead_time = dead_time
+        self.ambient_temperature = ambient_temperature
+
+    def initial_state(self, n: int, temperature: float):
+        return np.full(n, temperature, dtype=np.float64)
+
+    def temperature(self, state):
+        return state
+
+    def step(self, state, power, dt: float):
+        # Exact discretization for power held constant during the step
+        steady_state = self.ambient_temperature + self.gain * power
+        return steady_state + (state - steady_state) * np.exp(-dt / self.time_constant)
+
+    def to_dict(self):
+        return {
+            "type": self.type,
+            "gain": self.gain,
+            "time_constant": self.time_constant,
+            "dead_time": self.dead_time,
+            "ambient_temperature": self.ambient_temperature,
+        }
+
+
+class ThermalModel(FOPDTModel):
+    """
+    First order heat balance of the product with mass as a parameter:
+
+        mass * dT/dt = heat_gain * u(t - dead_time) - heat_loss * (T - ambient_temperature)
+
+    Mass is in kilograms. For fixed mass it is the FOPDT model with
+    gain = heat_gain / heat_loss and time_constant = mass / heat_loss.
+    """
+
+    type = "thermal"
+
+    def __init__(
+        self,
+        heat_gain: float,
+        heat_loss: float,
+        mass: float,
+        dead_time: float = 0.0,
+        ambient_temperature: float = 20.0,
+    ):
+        self.heat_gain = heat_gain
+        self.heat_loss = heat_loss
+        self.mass = mass
+        super().__init__(
+            heat_gain / heat_loss, mass / heat_loss, dead_time, ambient_temperature
+        )
+
+    def with_mass(self, mass: float):
+        return ThermalModel(
+            self.heat_gain,
+            self.heat_loss,
+            mass,
+            self.dead_time,
+            self.ambient_temperature,
+        )
+
+    def to_dict(self):
+        return {
+            "type": self.type,
+            "heat_gain": self.heat_gain,
+            "heat_loss": self.heat_loss,
+            "mass": self.mass,
+            "dead_time": self.dead_time,
+            "ambient_temperature": self.ambient_temperature,
+        }
+
+
+class SecondOrderModel:
+    """
+    Two first order lags in series, heater wall and product:
+
+        wall_time_constant * dW/dt = -(W - ambient_temperature) + gain * u(t - dead_time)
+        time_constant * dT/dt = -(T - W)
+    """
+
+    type = "second_order"
+
+    def __init__(
+        self,
+        gain: float,
+        time_constant: float,
+        wall_time_constant: float,
+        dead_time: float = 0.0,
+        ambient_temperature: float = 20.0,
+    ):
+        self.gain = gain
+        self.time_constant = time_constant
+        self.wall_time_constant = wall_time_constant
+        self.dead_time = dead_time
+        self.ambient_temperature = ambient_temperature
+
+    def initial_state(self, n: int, temperature: float):
+        return np.full((2, n), temperature, dtype=np.float64)
+
+    def temperature(self, state):
+        return state[1]
+
+    def step(self, state, power, dt: float):
+        wall, product = state
+        wall_steady_state = self.ambient_temperature + self.gain * power
+        new_wall = wall_steady_state + (wall - wall_steady_state) * np.exp(
+            -dt / self.wall_time_constant
+        )
+        # Wall temperature is taken as the average over the step
+        wall_average = (wall + new_wall) / 2
+        new_product = wall_average + (product - wall_average) * np.exp(
+            -dt / self.time_constant
+        )
+        return np.stack((new_wall, new_product))
+
+    def to_dict(self):
+        return {
+            "type": self.type,
+            "gain": self.gain,
+            "time_constant": self.time_constant,
+            "wall_time_constant": self.wall_time_constant,
+            "dead_time": self.dead_time,
+            "ambient_temperature": self.ambient_temperature,
+        }
+
+
+MODEL_TYPES = {m.type: m for m in (FOPDTModel, ThermalModel, SecondOrderModel)}
+
+
+def model_from_dict(model_dict):
+    model_dict = dict(model_dict)
+    model_type = MODEL_TYPES.get(model_dict.pop("type", FOPDTModel.type))
+    if not model_type:
+        raise ValueError("Unknown plant model type")
+    return model_type(**model_dict)
+
+
+def load_model(file_name):
+    with open(file_name) as f:
+        return model_from_dict(json.load(f))
+
+
+def save_model(model, file_name):
+    with open(file_name, "w") as f:
+        json.dump(model.to_dict(), f, indent=2)
@@ -0,0 +1,399 @@
+"""
+Fleet telemetry recorder.
+
+Subscribes to `+/from_device/sensors` and `+/from_device/parameters` of all
+devices and stores messages in SQLite database (WAL mode). Messages are
+queued by the MQTT reader and inserted by a writer in batches, one
+transaction per batch. Queue is bounded: while it is full MQTT socket is not
+read, so broker flow control slows publishers down instead of growing memory.
+
+Examples:
+
+    $ uv run recorder.py record --host 192.168.1.10 --database fleet.db
+    $ uv run recorder.py query --database fleet.db --device smart_tank --last 3600
+    $ uv run recorder.py benchmark --devices 100 --messages 200
+"""
+
+import argparse
+import asyncio
+import json
+import sqlite3
+import tempfile
+import time
+
+from mqtt import Broker, MQTTClient
+
+SENSORS_TOPIC = "+/from_device/sensors"
+PARAMETERS_TOPIC = "+/from_device/parameters"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS sensors (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS measurements (
+    device_id INTEGER NOT NULL,
+    sensor_id INTEGER NOT NULL,
+    time REAL NOT NULL,
+    value,
+    quality INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS measurements_device_time
+    ON measurements (device_id, time);
+CREATE TABLE IF NOT EXISTS parameters (
+    device_id INTEGER NOT NULL,
+    time REAL NOT NULL,
+    parameters TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS parameters_device_time
+    ON parameters (device_id, time);
+"""
+
+
+def connect_database(file_name):
+    connection = sqlite3.connect(file_name, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # WAL keeps database consistent, on power loss only the last batches are lost
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class Storage:
+    """Database access, write methods are called from a single writer thread."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._connection = connect_database(file_name)
+        self._device_ids = dict(
+            self._connection.execute("SELECT name, id FROM devices")
+        )
+        self._sensor_ids = dict(
+            self._connection.execute("SELECT name, id FROM sensors")
+        )
+
+    def _id(self, table, cache, name):
+        if (row_id := cache.get(name)) is None:
+            row_id = self._connection.execute(
+                f"INSERT INTO {table} (name) VALUES (?)", (name,)
+            ).lastrowid
+            cache[name] = row_id
+        return row_id
+
+    def write_batch(self, batch):
+        """Inserts list of (time, device, kind, payload), returns rows inserted."""
+        measurements = []
+        parameters = []
+        with self._connection:
+            for received, device, kind, payload in batch:
+                try:
+                    data = json.loads(payload)
+                except ValueError:
+                    continue
+                # Valid JSON of other shape, e.g. from a misbehaving client
+                if not isinstance(data, dict):
+                    continue
+
+                device_id = self._id("devices", self._device_ids, device)
+                if kind == "parameters":
+                    parameters.append((device_id, received, payload.decode()))
+                    continue
+
+                for name, measurement in data.items():
+                    if not isinstance(measurement, dict):
+                        continue
+                    measurements.append(
+                        (
+                            device_id,
+                            self._id("sensors", self._sensor_ids, name),
+                            received,
+                            measurement.get("value"),
+                            measurement.get("quality", 0),
+                        )
+                    )
+
+            self._connection.executemany(
+                "INSERT INTO measurements VALUES (?, ?, ?, ?, ?)", measurements
+            )
+            self._connection.executemany(
+                "INSERT INTO parameters VALUES (?, ?, ?)", parameters
+            )
+        return len(measurements) + len(parameters)
+
+    def close(self):
+        self._connection.close()
+
+
+class Recorder:
+
+    def __init__(self, storage, queue_size=10000, batch_size=1000, flush_interval=1.0):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(queue_size)
+
+        self.received = 0
+        self.written_messages = 0
+        self.written_rows = 0
+        self.batches = 0
+        self.queue_full_waits = 0
+
+    async def receive(self, client):
+        """Moves messages from MQTT client to the queue until connection is closed."""
+        async for topic, payload in client.messages():
+            device, _, kind = topic.rpartition("/from_device/")
+            if not device:
+                continue
+
+            item = (time.time(), device, kind, payload)
+            try:
+                self.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self.queue_full_waits += 1
+                await self.queue.put(item)
+            self.received += 1
+
+    async def write(self):
+        """Writer loop, runs until cancelled."""
+        while True:
+            batch = [await self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except TimeoutError:
+                        break
+
+            # SQLite blocks, event loop keeps reading MQTT meanwhile
+            self.written_rows += await asyncio.to_thread(
+                self.storage.write_batch, batch
+            )
+            self.written_messages += len(batch)
+            self.batches += 1
+            for _ in batch:
+                self.queue.task_done()
+
+    async def _receive_all(self, client):
+        await self.receive(client)
+        await self.queue.join()
+
+    async def run(self, client):
+        await client.subscribe(SENSORS_TOPIC, PARAMETERS_TOPIC)
+        writer = asyncio.create_task(self.write())
+        receiver = asyncio.create_task(self._receive_all(client))
+        try:
+            # Writer runs until cancelled, it finishes only on error, which
+            # would leave the queue never joined
+            await asyncio.wait((receiver, writer), return_when=asyncio.FIRST_COMPLETED)
+            if writer.done():
+                writer.result()
+            await receiver
+        finally:
+            receiver.cancel()
+            writer.cancel()
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "written_messages": self.written_messages,
+            "written_rows": self.written_rows,
+            "batches": self.batches,
+            "queue_full_waits": self.queue_full_waits,
+        }
+
+
+class Query:
+    """Read access, WAL lets it run while recorder writes."""
+
+    def __init__(self, file_name):
+        self._connection = connect_database(file_name)
+
+    def devices(self):
+        return [
+            name
+            for (name,) in self._connection.execute(
+                "SELECT name FROM devices ORDER BY name"
+            )
+        ]
+
+    def measurements(self, device, start, end, sensors=None):
+        """Returns list of (time, sensor, value, quality) in start <= time < end."""
+        query = """
+            SELECT m.time, s.name, m.value, m.quality
+            FROM measurements m
+            JOIN devices d ON d.id = m.device_id
+            JOIN sensors s ON s.id = m.sensor_id
+            WHERE d.name = ? AND m.time >= ? AND m.time < ?
+        """
+        arguments = [device, start, end]
+        if sensors:
+            query += f" AND s.name IN ({', '.join('?' * len(sensors))})"
+            arguments.extend(sensors)
+        return self._connection.execute(
+            query + " ORDER BY m.time", arguments
+        ).fetchall()
+
+    def parameters(self, device, start, end):
+        """Returns list of (time, parameters dict) in start <= time < end."""
+        rows = self._connection.execute(
+            """
+            SELECT p.time, p.parameters
+            FROM parameters p
+            JOIN devices d ON d.id = p.device_id
+            WHERE d.name = ? AND p.time >= ? AND p.time < ?
+            ORDER BY p.time
+            """,
+            (device, start, end),
+        )
+        return [(t, json.loads(p)) for t, p in rows]
+
+
+async def record(args):
+    storage = Storage(args.database)
+    client = MQTTClient(args.client_id)
+    await client.connect(args.host, args.port, args.user, args.password)
+    recorder = Recorder(storage, args.queue_size, args.batch_size)
+    try:
+        await recorder.run(client)
+    finally:
+        await client.close()
+        storage.close()
+
+
+def query(args):
+    end = args.end if args.end is not None else time.time()
+    start = args.start if args.start is not None else end - args.last
+    database = Query(args.database)
+    if not args.device:
+        print(json.dumps(database.devices()))
+        return
+    for row in database.measurements(args.device, start, end, args.sensor):
+        print(json.dumps(row))
+
+
+def _sensors_payload(i):
+    return json.dumps(
+        {
+            "heater_output_power": {"value": i % 100, "quality": 0},
+            "bottom_temperature": {"value": 20 + i * 0.01, "quality": 0},
+            "bottom_temperature_calibrated": {"value": 20 + i * 0.01, "quality": 0},
+            "top_temperature": {"value": 19 + i * 0.01, "quality": 0},
+            "top_temperature_calibrated": {"value": 19 + i * 0.01, "quality": 0},
+            "weight": {"value": 1121544 - i, "quality": 0},
+            "weight_calibrated": {"value": 6974.6 - i * 0.01, "quality": 0},
+            "free_memory": {"value": 97744, "quality": 0},
+            "uptime": {"value": i * 5.0, "quality": 0},
+        }
+    )
+
+
+async def benchmark(args):
+    """Publishes messages of virtual devices through in-process broker, returns stats."""
+    broker = Broker()
+    port = await broker.start()
+    # Fake devices are never written to a real database
+    database_directory = tempfile.TemporaryDirectory()
+    storage = Storage(f"{database_directory.name}/benchmark.db")
+
+    recorder_client = MQTTClient("recorder")
+    await recorder_client.connect(port=port)
+    recorder = Recorder(storage, args.queue_size, args.batch_size)
+    recorder_task = asyncio.create_task(recorder.run(recorder_client))
+    # Subscription is processed before publishing starts
+    await asyncio.sleep(0.1)
+
+    publishers = []
+    for i in range(args.devices):
+        client = MQTTClient(f"tank_{i}")
+        await client.connect(port=port)
+        publishers.append(client)
+
+    async def publish(index, client):
+        topic = f"tank_{index}/from_device/sensors"
+        for i in range(args.messages):
+            client.publish(topic, _sensors_payload(i))
+            await client.drain()
+
+    total = args.devices * args.messages
+    started = time.perf_counter()
+    await asyncio.gather(*(publish(i, c) for i, c in enumerate(publishers)))
+    while recorder.written_messages < total:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    for client in publishers:
+        await client.close()
+    await recorder_client.close()
+    await recorder_task
+    await broker.stop()
+    storage.close()
+    database_directory.cleanup()
+
+    return {
+        "messages": total,
+        "seconds": elapsed,
+        "messages_per_second": total / elapsed,
+        "rows_per_second": recorder.written_rows / elapsed,
+        **recorder.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="Record telemetry from broker")
+    record_parser.add_argument("--host", default="127.0.0.1")
+    record_parser.add_argument("--port", type=int, default=1883)
+    record_parser.add_argument("--user")
+    record_parser.add_argument("--password")
+    record_parser.add_argument("--client-id", default="smart_tank_recorder")
+
+    query_parser = subparsers.add_parser(
+        "query", help="Print recorded measurements as JSON lines"
+    )
+    query_parser.add_argument("--device", help="Device name, lists devices if omitted")
+    query_parser.add_argument(
+        "--sensor", action="append", help="Sensor name, may be repeated"
+    )
+    query_parser.add_argument("--start", type=float, help="Unix time")
+    query_parser.add_argument("--end", type=float, help="Unix time, now by default")
+    query_parser.add_argument(
+        "--last", type=float, default=3600, help="s, if --start is omitted"
+    )
+
+    benchmark_parser = subparsers.add_parser(
+        "benchmark", help="Measure throughput with in-process broker"
+    )
+    benchmark_parser.add_argument("--devices", type=int, default=100)
+    benchmark_parser.add_argument(
+        "--messages", type=int, default=200, help="Per device"
+    )
+
+    for subparser in (record_parser, benchmark_parser):
+        subparser.add_argument("--queue-size", type=int, default=10000)
+        subparser.add_argument("--batch-size", type=int, default=1000)
+    for subparser in (record_parser, query_parser):
+        subparser.add_argument("--database", default="fleet.db")
+
+    args = parser.parse_args()
+    if args.command == "record":
+        asyncio.run(record(args))
+    elif args.command == "query":
+        query(args)
+    else:
+        print(json.dumps(asyncio.run(benchmark(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()